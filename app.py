@@ -17,6 +17,7 @@ MultilensStack(
     line_credential=LineApiCredential(
         access_token=os.getenv("LINE_API_ACCESS_TOKEN"),
         secret=os.getenv("LINE_API_SECRET"),
+        login_channel_id=os.getenv("LINE_LOGIN_CHANNEL_ID"),
     ),
     env=cdk.Environment(
         account=os.getenv("CDK_DEFAULT_ACCOUNT"),
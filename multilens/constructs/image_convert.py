@@ -1,10 +1,16 @@
+import json
 import typing
 from dataclasses import dataclass
 from pathlib import Path
 
 import aws_cdk as cdk
 from aws_cdk import (
+    aws_apigateway as apigateway,
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
+    aws_dynamodb as dynamodb,
     aws_lambda as lambda_,
+    aws_lambda_destinations as destinations,
     aws_lambda_event_sources as event_source,
     aws_lambda_python_alpha as lambda_python,
     aws_logs as logs,
@@ -16,6 +22,8 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from multilens.constructs.pipeline_dashboard import METRICS_NAMESPACE
+
 here = Path(__file__).absolute().parent
 
 
@@ -23,6 +31,34 @@ here = Path(__file__).absolute().parent
 class ConvertProps:
     format: str
     resize: str
+    # perceptual hash and other per-image features are computed by one
+    # variant only, preferably a small one
+    image_features: bool = False
+    # adaptive encoding, see ConvertConfig in the function
+    target_bytes: typing.Optional[int] = None
+    min_ssim: typing.Optional[float] = None
+    # "pillow", or "vips" to shrink large originals on load with libvips
+    engine: str = "pillow"
+    # small variants of JPEG originals from their EXIF thumbnail, which
+    # needs only the first part of the original
+    exif_thumbnail: bool = False
+    # small variants appended into shared segments per user instead of an
+    # object each, located through the index table
+    pack: bool = False
+    # "plain", or "sharded" to write under a hashed prefix per image
+    key_layout: str = "plain"
+    # budgets of animated output and of the frames decoded for it, and
+    # "subsample" or "poster" over them
+    max_frames: typing.Optional[int] = None
+    max_animation_pixels: typing.Optional[int] = None
+    max_source_frames: typing.Optional[int] = None
+    animation_fallback: str = "subsample"
+    # metadata of the source kept in the variant: EXIF orientation applied
+    # to the pixels, ICC profile "srgb" to convert to or "keep", and EXIF
+    # "drop" or "no-gps"
+    auto_orient: bool = True
+    icc_policy: str = "srgb"
+    exif_policy: str = "drop"
 
     def camel_name(self) -> str:
         return f"{self.format.capitalize()}{self.resize.capitalize()}"
@@ -30,6 +66,56 @@ class ConvertProps:
     def snake_name(self) -> str:
         return f"{self.format}_{self.resize}"
 
+    def variant_name(self) -> str:
+        return f"{self.format}/{self.resize}"
+
+    def environment(self) -> typing.Dict[str, str]:
+        """Variables of the variant for `config_from_environ` of the
+        function, which also configures the previews of the LINE callback.
+        """
+        return {
+            "APP_FORMAT": self.format,
+            "APP_RESIZE": self.resize,
+            "APP_IMAGE_FEATURES": str(self.image_features),
+            "APP_TARGET_BYTES": str(self.target_bytes or ""),
+            "APP_MIN_SSIM": str(self.min_ssim or ""),
+            "APP_ENGINE": self.engine,
+            "APP_EXIF_THUMBNAIL": str(self.exif_thumbnail),
+            "APP_PACK": str(self.pack),
+            "APP_KEY_LAYOUT": self.key_layout,
+            "APP_MAX_FRAMES": _optional_str(self.max_frames),
+            "APP_MAX_ANIMATION_PIXELS": _optional_str(
+                self.max_animation_pixels
+            ),
+            "APP_MAX_SOURCE_FRAMES": _optional_str(self.max_source_frames),
+            "APP_ANIMATION_FALLBACK": self.animation_fallback,
+            "APP_AUTO_ORIENT": str(self.auto_orient),
+            "APP_ICC_POLICY": self.icc_policy,
+            "APP_EXIF_POLICY": self.exif_policy,
+        }
+
+
+DEFAULT_CONVERT_PROPS = [
+    ConvertProps(format="original", resize="original"),
+    ConvertProps(format="jpeg", resize="400", image_features=True),
+    ConvertProps(format="webp", resize="original"),
+    ConvertProps(format="webp", resize="400"),
+]
+
+
+def _optional_str(value: typing.Optional[typing.Any]) -> str:
+    # 0 is a valid sample rate, unlike an empty value
+    return "" if value is None else str(value)
+
+
+# output keys are derived from the source key, not the content: overwritten
+# originals, re-conversions and backfills with --overwrite rewrite the same
+# key, so caches hold a variant for a day rather than for good
+VARIANT_CACHE_CONTROL = "public, max-age=86400"
+
+# PACK_COMPACTED_TAG of the function, segments replaced by compaction
+COMPACTED_TAG = "multilens:compacted"
+
 
 class ImageConvert(Construct):
     def __init__(
@@ -41,9 +127,18 @@ class ImageConvert(Construct):
         input_bucket_props: typing.Optional[s3.BucketProps] = None,
         output_bucket: typing.Optional[s3.Bucket] = None,
         output_bucket_props: typing.Optional[s3.BucketProps] = None,
+        index_table: typing.Optional[dynamodb.ITable] = None,
+        use_cdn: bool = False,
+        convert_props: typing.Optional[typing.Sequence[ConvertProps]] = None,
+        on_demand_props: typing.Optional[typing.Sequence[ConvertProps]] = None,
         lambda_tracing: bool = False,
         lambda_log_level: typing.Optional[str] = None,
+        lambda_log_sample_rate: typing.Optional[float] = None,
         lambda_sentry_dsn: typing.Optional[str] = None,
+        lambda_traces_sample_rate: typing.Optional[float] = None,
+        lambda_traces_slow_ms: typing.Optional[int] = None,
+        lambda_profile_sample_rate: typing.Optional[float] = None,
+        profile_bucket: typing.Optional[s3.IBucket] = None,
     ) -> None:
         super().__init__(scope, id)
 
@@ -53,6 +148,11 @@ class ImageConvert(Construct):
             raise ValueError(
                 "requires `output_bucket` or `output_bucket_props`"
             )
+        if lambda_profile_sample_rate and profile_bucket is None:
+            raise ValueError("requires `profile_bucket` to write profiles")
+        if any(props.pack for props in on_demand_props or []):
+            # the renderer serves the variant from its own key
+            raise ValueError("requires `on_demand_props` without `pack`")
 
         self.input_bucket = input_bucket or s3.Bucket(
             self,
@@ -64,6 +164,20 @@ class ImageConvert(Construct):
             "OutputBucket",
             **output_bucket_props._values,  # type: ignore
         )
+        self.index_table = index_table
+        self.profile_bucket = profile_bucket
+        self.profile_sample_rate = lambda_profile_sample_rate
+
+        cache_control = VARIANT_CACHE_CONTROL if use_cdn else None
+        self.cache_control = cache_control
+
+        # Sentry sampling and the like, shared with the LINE callback
+        self.telemetry_layer = lambda_python.PythonLayerVersion(
+            self,
+            "TelemetryLayer",
+            entry=str(here / "telemetry_layer"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+        )
 
         self.topic = sns.Topic(
             self,
@@ -74,12 +188,57 @@ class ImageConvert(Construct):
             dest=notifications.SnsDestination(self.topic),
         )
 
-        convert_props = [
-            ConvertProps(format="original", resize="original"),
-            ConvertProps(format="jpeg", resize="400"),
-            ConvertProps(format="webp", resize="original"),
-            ConvertProps(format="webp", resize="400"),
-        ]
+        # failures are kept apart per message shape, and per variant where
+        # the message does not name it, so each can be redriven into the
+        # queue of its variant: with SQS, a dead-letter queue per variant
+        # holds its S3 events; without, the failure queue holds the records
+        # the functions send, S3 events with a Variant attribute, and the
+        # invocation failure queue the records of Lambda failing a whole
+        # invocation, with the SNS event in requestPayload and the function
+        # of the variant in requestContext
+        self.dead_letter_queues: typing.Dict[str, sqs.Queue] = {}
+        self.failure_queue: typing.Optional[sqs.Queue] = None
+        self.invocation_failure_queue: typing.Optional[sqs.Queue] = None
+        if not use_sqs:
+            self.failure_queue = sqs.Queue(
+                self,
+                "FailureQueue",
+                retention_period=cdk.Duration.days(14),
+            )
+            self.invocation_failure_queue = sqs.Queue(
+                self,
+                "InvocationFailureQueue",
+                retention_period=cdk.Duration.days(14),
+            )
+
+        # last S3 sequencer converted into each output key, so that late
+        # events of an overwritten original are dropped
+        self.sequence_table = dynamodb.Table(
+            self,
+            "SequenceTable",
+            partition_key=dynamodb.Attribute(
+                name="Key",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        if convert_props is None:
+            convert_props = DEFAULT_CONVERT_PROPS
+        self.convert_props = list(convert_props)
+        if any(props.pack for props in convert_props):
+            if self.index_table is None:
+                raise ValueError("requires `index_table` to pack variants")
+            # segments replaced by multilens.tools.compact are tagged, and
+            # kept for a day for the pages listed before
+            self.output_bucket.add_lifecycle_rule(
+                id="CompactedSegments",
+                prefix="packs/",
+                tag_filters={COMPACTED_TAG: "true"},
+                expiration=cdk.Duration.days(1),
+            )
 
         for props in convert_props:
             function = self._add_convert_function(
@@ -87,29 +246,195 @@ class ImageConvert(Construct):
                 use_sqs=use_sqs,
                 input_bucket=self.input_bucket,
                 output_bucket=self.output_bucket,
+                index_table=self.index_table,
+                cache_control=cache_control,
                 tracing=lambda_tracing,
                 log_level=lambda_log_level,
+                log_sample_rate=lambda_log_sample_rate,
                 sentry_dsn=lambda_sentry_dsn,
+                traces_sample_rate=lambda_traces_sample_rate,
+                traces_slow_ms=lambda_traces_slow_ms,
+            )
+            self._enable_profiling(
+                function,
+                f"profiles/ImageConvert/{props.snake_name()}/",
             )
             if use_sqs:
-                self._connect_with_sqs(self.topic, function, props.camel_name())
+                self.dead_letter_queues[
+                    props.variant_name()
+                ] = self._connect_with_sqs(
+                    self.topic, function, props.camel_name()
+                )
             else:
                 self._connect_direct(self.topic, function)
 
+        self.render_function: typing.Optional[lambda_.Function] = None
+        self.render_api: typing.Optional[apigateway.RestApi] = None
+        if on_demand_props:
+            self._add_render_api(
+                on_demand_props=on_demand_props,
+                cache_control=cache_control,
+                tracing=lambda_tracing,
+                log_level=lambda_log_level,
+                log_sample_rate=lambda_log_sample_rate,
+                sentry_dsn=lambda_sentry_dsn,
+                traces_sample_rate=lambda_traces_sample_rate,
+                traces_slow_ms=lambda_traces_slow_ms,
+            )
+
+        self.distribution: typing.Optional[cloudfront.Distribution] = None
+        if use_cdn:
+            self.distribution = self._add_distribution()
+
+    def _enable_profiling(
+        self, function: lambda_.Function, prefix: str
+    ) -> None:
+        if not self.profile_sample_rate or self.profile_bucket is None:
+            return
+        function.add_environment(
+            "APP_PROFILE_SAMPLE_RATE",
+            str(self.profile_sample_rate),
+        )
+        function.add_environment(
+            "APP_PROFILE_BUCKET",
+            self.profile_bucket.bucket_name,
+        )
+        function.add_environment("APP_PROFILE_PREFIX", prefix)
+        self.profile_bucket.grant_put(function, prefix + "*")
+
+    def _add_distribution(self) -> cloudfront.Distribution:
+        origin: cloudfront.IOrigin = origins.S3Origin(self.output_bucket)
+        if self.render_api:
+            # a missing variant is a 403 from S3 since the origin identity
+            # cannot list the bucket; either way, fall back to rendering it
+            origin = origins.OriginGroup(
+                primary_origin=origin,
+                fallback_origin=origins.HttpOrigin(
+                    cdk.Fn.select(2, cdk.Fn.split("/", self.render_api.url)),
+                    origin_path=(
+                        f"/{self.render_api.deployment_stage.stage_name}"
+                    ),
+                ),
+                fallback_status_codes=[403, 404],
+            )
+        return cloudfront.Distribution(
+            self,
+            "Distribution",
+            default_behavior=cloudfront.BehaviorOptions(
+                origin=origin,
+                viewer_protocol_policy=(
+                    cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS
+                ),
+                cache_policy=cloudfront.CachePolicy.CACHING_OPTIMIZED,
+            ),
+        )
+
+    def _add_render_api(
+        self,
+        on_demand_props: typing.Sequence[ConvertProps],
+        cache_control: typing.Optional[str] = None,
+        tracing: bool = False,
+        log_level: typing.Optional[str] = None,
+        log_sample_rate: typing.Optional[float] = None,
+        sentry_dsn: typing.Optional[str] = None,
+        traces_sample_rate: typing.Optional[float] = None,
+        traces_slow_ms: typing.Optional[int] = None,
+    ) -> None:
+        lock_table = dynamodb.Table(
+            self,
+            "RenderLockTable",
+            partition_key=dynamodb.Attribute(
+                name="Key",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+        self.render_function = lambda_python.PythonFunction(
+            self,
+            "RenderFunction",
+            entry=str(here / "image_convert_function"),
+            index="index.py",
+            handler="render_handler",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            environment={
+                "APP_RENDER_VARIANTS": json.dumps(
+                    {
+                        props.variant_name(): props.environment()
+                        for props in on_demand_props
+                    }
+                ),
+                "APP_CACHE_CONTROL": cache_control or "",
+                "LOG_LEVEL": log_level or "INFO",
+                "APP_DEBUG_SAMPLE_RATE": str(log_sample_rate or ""),
+                "POWERTOOLS_SERVICE_NAME": "ImageConvert",
+                "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
+                "BUCKET_NAME": self.output_bucket.bucket_name,
+                "INPUT_BUCKET_NAME": self.input_bucket.bucket_name,
+                "LOCK_TABLE_NAME": lock_table.table_name,
+                "SENTRY_DSN": sentry_dsn or "",
+                "APP_TRACES_SAMPLE_RATE": _optional_str(traces_sample_rate),
+                "APP_TRACES_SLOW_MS": _optional_str(traces_slow_ms),
+                # responses are image bytes, far too large for trace metadata
+                "POWERTOOLS_TRACER_CAPTURE_RESPONSE": "false",
+                "INDEX_TABLE_NAME": (
+                    self.index_table.table_name if self.index_table else ""
+                ),
+            },
+            layers=[self.telemetry_layer],
+            memory_size=1024,
+            timeout=cdk.Duration.seconds(25),
+            log_retention=logs.RetentionDays.ONE_MONTH,
+            tracing=(
+                lambda_.Tracing.ACTIVE if tracing else lambda_.Tracing.DISABLED
+            ),
+        )
+        self.input_bucket.grant_read(self.render_function)
+        self.output_bucket.grant_read_write(self.render_function)
+        lock_table.grant_read_write_data(self.render_function)
+        self._enable_profiling(
+            self.render_function,
+            "profiles/ImageConvert/render/",
+        )
+        if self.index_table:
+            self.index_table.grant_read_write_data(self.render_function)
+
+        self.render_api = apigateway.RestApi(
+            self,
+            "RenderApi",
+            rest_api_name="ImageRender",
+            binary_media_types=["*/*"],
+        )
+        self.render_api.root.add_resource("{format}").add_resource(
+            "{resize}"
+        ).add_resource("{user_id}").add_resource("{image_id}").add_method(
+            http_method="GET",
+            integration=apigateway.LambdaIntegration(
+                handler=self.render_function,
+            ),
+        )
+
     def _add_convert_function(
         self,
         convert_props: ConvertProps,
         use_sqs: bool,
         input_bucket: s3.Bucket,
         output_bucket: s3.Bucket,
+        index_table: typing.Optional[dynamodb.ITable] = None,
+        cache_control: typing.Optional[str] = None,
         tracing: bool = False,
         log_level: typing.Optional[str] = None,
+        log_sample_rate: typing.Optional[float] = None,
         sentry_dsn: typing.Optional[str] = None,
+        traces_sample_rate: typing.Optional[float] = None,
+        traces_slow_ms: typing.Optional[int] = None,
     ) -> lambda_.Function:
         construct_id = f"Function{convert_props.camel_name()}"
         directory_name = "image_convert_function"
         log_level = log_level or "INFO"
         sentry_dsn = sentry_dsn or ""
+        cache_control = cache_control or ""
         function = lambda_python.PythonFunction(
             self,
             construct_id,
@@ -118,14 +443,24 @@ class ImageConvert(Construct):
             handler="lambda_handler",
             runtime=lambda_.Runtime.PYTHON_3_9,
             environment={
-                "APP_FORMAT": convert_props.format,
-                "APP_RESIZE": convert_props.resize,
+                **convert_props.environment(),
                 "APP_USE_SQS": str(use_sqs),
+                "APP_CACHE_CONTROL": cache_control,
                 "LOG_LEVEL": log_level,
+                "APP_DEBUG_SAMPLE_RATE": str(log_sample_rate or ""),
                 "POWERTOOLS_SERVICE_NAME": "ImageConvert",
+                "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
                 "BUCKET_NAME": output_bucket.bucket_name,
                 "SENTRY_DSN": sentry_dsn,
+                "APP_TRACES_SAMPLE_RATE": _optional_str(traces_sample_rate),
+                "APP_TRACES_SLOW_MS": _optional_str(traces_slow_ms),
+                "POWERTOOLS_TRACER_CAPTURE_RESPONSE": "false",
+                "INDEX_TABLE_NAME": (
+                    index_table.table_name if index_table else ""
+                ),
+                "SEQUENCE_TABLE_NAME": self.sequence_table.table_name,
             },
+            layers=[self.telemetry_layer],
             memory_size=512,
             timeout=cdk.Duration.seconds(15),
             log_retention=logs.RetentionDays.ONE_MONTH,
@@ -135,12 +470,27 @@ class ImageConvert(Construct):
         )
         input_bucket.grant_read(function)
         output_bucket.grant_read_write(function)
+        self.sequence_table.grant_read_write_data(function)
+        if index_table:
+            index_table.grant_write_data(function)
 
         return function
 
     def _connect_direct(
         self, topic: sns.Topic, function: lambda_.Function
     ) -> None:
+        assert self.failure_queue and self.invocation_failure_queue
+        # the function sends the records that fail by themselves, the
+        # destination gets the events of invocations that fail as a whole
+        function.add_environment(
+            "APP_FAILURE_QUEUE_URL", self.failure_queue.queue_url
+        )
+        self.failure_queue.grant_send_messages(function)
+        function.configure_async_invoke(
+            on_failure=destinations.SqsDestination(
+                self.invocation_failure_queue
+            ),
+        )
         function.add_event_source(event_source.SnsEventSource(topic))
 
     def _connect_with_sqs(
@@ -148,10 +498,20 @@ class ImageConvert(Construct):
         topic: sns.Topic,
         function: lambda_.Function,
         queue_id: str,
-    ) -> None:
+    ) -> sqs.Queue:
+        # a dead-letter queue per variant, redriven into its own queue
+        dead_letter_queue = sqs.Queue(
+            self,
+            f"{queue_id}DeadLetterQueue",
+            retention_period=cdk.Duration.days(14),
+        )
         queue = sqs.Queue(
             self,
             queue_id,
+            dead_letter_queue=sqs.DeadLetterQueue(
+                queue=dead_letter_queue,
+                max_receive_count=3,
+            ),
         )
         topic.add_subscription(
             subscriptions.SqsSubscription(
@@ -159,4 +519,10 @@ class ImageConvert(Construct):
                 raw_message_delivery=True,
             )
         )
-        function.add_event_source(event_source.SqsEventSource(queue))
+        function.add_event_source(
+            event_source.SqsEventSource(
+                queue,
+                report_batch_item_failures=True,
+            )
+        )
+        return dead_letter_queue
@@ -1,15 +1,27 @@
+import functools
+import hashlib
 import json
 import os
+import struct
+import threading
+import time
 import typing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from distutils.util import strtobool
 from enum import Enum
 from io import SEEK_SET, BytesIO
 from uuid import uuid4
 
 import boto3
+import numpy as np
 import sentry_sdk
-from aws_lambda_powertools import Logger, Tracer
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.event_handler.api_gateway import (
+    ApiGatewayResolver,
+    Response,
+)
+from aws_lambda_powertools.logging import correlation_paths
+from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.batch import (
     BatchProcessor,
     EventType,
@@ -17,17 +29,89 @@ from aws_lambda_powertools.utilities.batch import (
 )
 from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from PIL import Image
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from PIL import Image, ImageCms, ImageSequence
 from sentry_sdk import capture_exception
-from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+try:
+    import pyvips
+except (ImportError, OSError):  # libvips is only needed by the vips engine
+    pyvips = None
+
+try:
+    import telemetry  # the telemetry layer
+except ImportError:
+    from multilens.constructs.telemetry_layer import telemetry
 
 logger = Logger()
 tracer = Tracer()
+metrics = Metrics(
+    namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "Multilens")
+)
+app = ApiGatewayResolver()
 
 
 class Format(Enum):
     JPEG = "jpeg"
     WEBP = "webp"
+    # whichever of JPEG and WebP comes out smaller for the image
+    AUTO = "auto"
+
+
+class AnimationFallback(Enum):
+    # drop frames evenly, the kept ones lasting as long as the dropped ones
+    SUBSAMPLE = "subsample"
+    # the first frame as a still image
+    POSTER = "poster"
+
+
+class IccPolicy(Enum):
+    # pixels converted to sRGB and the profile dropped, as browsers assume
+    SRGB = "srgb"
+    # the profile of the source embedded as is
+    KEEP = "keep"
+
+
+class ExifPolicy(Enum):
+    DROP = "drop"
+    # all but the GPS IFD and the embedded thumbnail
+    NO_GPS = "no-gps"
+
+
+class KeyLayout(Enum):
+    # {format}/{resize}/{userid}/{imageid}
+    PLAIN = "plain"
+    # the same under a prefix hashed from user and image, so that a burst of
+    # writes spreads over S3 partitions from the start
+    SHARDED = "sharded"
+
+
+class Engine(Enum):
+    PILLOW = "pillow"
+    # libvips, shrinks on load and streams the rest of the pipeline
+    VIPS = "vips"
+
+
+# a hundred frames of 500x500 at most
+DEFAULT_MAX_FRAMES = 100
+DEFAULT_MAX_ANIMATION_PIXELS = 25_000_000
+# every frame of the source is decoded even when few are kept, longer
+# animations are posters whatever the fallback
+DEFAULT_MAX_SOURCE_FRAMES = 500
+
+
+@dataclass
+class ConvertResult:
+    key: str
+    body: bytes
+    content_type: str
+    width: int
+    height: int
+    source_width: int
+    source_height: int
+    features: typing.Dict[str, str] = field(default_factory=dict)
+    quality: typing.Optional[int] = None
 
 
 @dataclass
@@ -35,152 +119,2416 @@ class ConvertConfig:
     bucket_name: str
     format: typing.Optional[Format] = None
     resize: typing.Optional[int] = None
+    index_table_name: typing.Optional[str] = None
+    cache_control: typing.Optional[str] = None
+    image_features: bool = False
+    # adaptive encoding: search the encoder quality for the smallest output
+    # that stays above `min_ssim`, without going over `target_bytes`
+    target_bytes: typing.Optional[int] = None
+    min_ssim: typing.Optional[float] = None
+    max_trials: int = 6
+    engine: Engine = Engine.PILLOW
+    # resized variants may be made from the thumbnail embedded in the EXIF
+    # data of JPEG originals, see ImageConvertProcessor.convert_thumbnail
+    exif_thumbnail: bool = False
+    # S3 records that fail to convert on the SNS path are sent here
+    failure_queue_url: typing.Optional[str] = None
+    # last S3 sequencer converted into each output key, see SequenceTable
+    sequence_table_name: typing.Optional[str] = None
+    # append the variants of a user into shared segments, see PackWriter
+    pack: bool = False
+    pack_segment_bytes: int = 4 * 1024 * 1024
+    key_layout: KeyLayout = KeyLayout.PLAIN
+    # animated sources stay animated in WebP, and in their own format for
+    # the original format variant, within these budgets of output frames
+    # and pixels over all frames; see load_animation
+    max_frames: int = DEFAULT_MAX_FRAMES
+    max_animation_pixels: int = DEFAULT_MAX_ANIMATION_PIXELS
+    max_source_frames: int = DEFAULT_MAX_SOURCE_FRAMES
+    animation_fallback: AnimationFallback = AnimationFallback.SUBSAMPLE
+    # what the variant keeps of the metadata of its source, the rest is
+    # dropped; see MetadataPolicy
+    auto_orient: bool = True
+    icc_policy: IccPolicy = IccPolicy.SRGB
+    exif_policy: ExifPolicy = ExifPolicy.DROP
 
 
-SENTRY_DSN = os.environ.get("SENTRY_DSN")
+def parse_format(value: typing.Optional[str]) -> typing.Optional[Format]:
+    try:
+        return Format(value)
+    except ValueError:
+        return None
 
 
-if SENTRY_DSN:
-    sentry_sdk.init(
-        dsn=SENTRY_DSN,
-        integrations=[AwsLambdaIntegration()],
-        traces_sample_rate=1.0,
+def parse_engine(value: typing.Optional[str]) -> Engine:
+    try:
+        return Engine(value)
+    except ValueError:
+        return Engine.PILLOW
+
+
+def parse_animation_fallback(value: typing.Optional[str]) -> AnimationFallback:
+    try:
+        return AnimationFallback(value)
+    except ValueError:
+        return AnimationFallback.SUBSAMPLE
+
+
+def parse_icc_policy(value: typing.Optional[str]) -> IccPolicy:
+    try:
+        return IccPolicy(value)
+    except ValueError:
+        return IccPolicy.SRGB
+
+
+def parse_exif_policy(value: typing.Optional[str]) -> ExifPolicy:
+    try:
+        return ExifPolicy(value)
+    except ValueError:
+        return ExifPolicy.DROP
+
+
+def parse_key_layout(value: typing.Optional[str]) -> KeyLayout:
+    try:
+        return KeyLayout(value)
+    except ValueError:
+        return KeyLayout.PLAIN
+
+
+def parse_resize(value: typing.Optional[str]) -> typing.Optional[int]:
+    try:
+        resize = int(value)  # type: ignore
+    except (ValueError, TypeError):
+        return None
+    return resize if resize > 0 else None
+
+
+def parse_target_bytes(value: typing.Optional[str]) -> typing.Optional[int]:
+    try:
+        target_bytes = int(value)  # type: ignore
+    except (ValueError, TypeError):
+        return None
+    return target_bytes if target_bytes > 0 else None
+
+
+def parse_ssim(value: typing.Optional[str]) -> typing.Optional[float]:
+    try:
+        min_ssim = float(value)  # type: ignore
+    except (ValueError, TypeError):
+        return None
+    return min_ssim if 0 < min_ssim <= 1 else None
+
+
+# the hash is split into this many bands for the similarity index; any two
+# hashes within PHASH_BANDS - 1 bits of each other share at least one band
+PHASH_BANDS = 4
+
+
+def dhash(image: Image.Image, size: int = 8) -> str:
+    """Difference hash of `image` as a hex string of `size * size` bits."""
+    gray = image.convert("L").resize(
+        (size + 1, size), Image.Resampling.BILINEAR
+    )
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return np.packbits(bits).tobytes().hex()
+
+
+def phash_bands(user_id: str, phash: str) -> typing.Dict[str, str]:
+    width = len(phash) // PHASH_BANDS
+    return {
+        f"PHashBand{i}": f"{user_id}:{phash[i * width:(i + 1) * width]}"
+        for i in range(PHASH_BANDS)
+    }
+
+
+BLURHASH_CHARACTERS = (
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    "abcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+)
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(
+        BLURHASH_CHARACTERS[value // 83 ** (length - i - 1) % 83]
+        for i in range(length)
+    )
+
+
+def _srgb_to_linear(value: np.ndarray) -> np.ndarray:
+    value = value / 255.0
+    return np.where(
+        value <= 0.04045, value / 12.92, ((value + 0.055) / 1.055) ** 2.4
+    )
+
+
+def _linear_to_srgb(value: float) -> int:
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(
+    image: Image.Image, x_components: int = 4, y_components: int = 3
+) -> str:
+    """BlurHash (https://blurha.sh) of `image`.
+
+    The components only carry low frequencies, so a 32px copy of the image
+    gives the same hash as the full bitmap at a fraction of the cost.
+    """
+    small = image.convert("RGB")
+    small.thumbnail((32, 32))
+    pixels = _srgb_to_linear(np.asarray(small, dtype=np.float64))
+    width, height = small.size
+
+    cos_x = np.cos(
+        np.pi * np.outer(np.arange(x_components), np.arange(width)) / width
+    )
+    cos_y = np.cos(
+        np.pi * np.outer(np.arange(y_components), np.arange(height)) / height
+    )
+    # factors[j, i] = mean of basis(i, j) * pixel, per channel
+    factors = np.einsum("jy,ix,yxc->jic", cos_y, cos_x, pixels)
+    factors /= width * height
+    factors[1:, :] *= 2
+    factors[0, 1:] *= 2
+
+    dc = factors[0, 0]
+    ac = factors.reshape(-1, 3)[1:]
+
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if len(ac):
+        quantised_max = int(
+            max(0, min(82, np.floor(np.abs(ac).max() * 166 - 0.5)))
+        )
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1.0
+        result += _base83(0, 1)
+
+    r, g, b = (_linear_to_srgb(v) for v in dc)
+    result += _base83((r << 16) + (g << 8) + b, 4)
+
+    scaled = np.sign(ac) * np.abs(ac / max_value) ** 0.5
+    quantised = np.clip(np.floor(scaled * 9 + 9.5), 0, 18).astype(int)
+    for qr, qg, qb in quantised:
+        result += _base83(int(qr * 19 * 19 + qg * 19 + qb), 2)
+    return result
+
+
+def dominant_color(image: Image.Image, colors: int = 5) -> str:
+    """Most common color of `image` after reducing it to `colors` colors."""
+    small = image.convert("RGB")
+    small.thumbnail((64, 64))
+    quantized = small.quantize(colors=colors)
+    palette = quantized.getpalette() or []
+    _, index = max(quantized.getcolors() or [(0, 0)])
+    offset = typing.cast(int, index) * 3
+    r, g, b = palette[offset : offset + 3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+# Pillow's own defaults, used when there is nothing to search for
+DEFAULT_QUALITY = {Format.JPEG: 75, Format.WEBP: 80}
+
+
+@dataclass
+class EncodeTrial:
+    format: Format
+    quality: int
+    body: bytes
+    ssim: typing.Optional[float] = None
+
+
+def ssim(a: Image.Image, b: Image.Image, window: int = 8) -> float:
+    """Mean SSIM of the luminance of two same-sized images.
+
+    Uses non-overlapping `window` sized blocks rather than a sliding
+    gaussian, which is plenty to rank encoder settings against each other.
+    """
+    x = np.asarray(a.convert("L"), dtype=np.float64)
+    y = np.asarray(b.convert("L"), dtype=np.float64)
+    window = max(1, min(window, a.width, a.height))
+    height = a.height // window * window
+    width = a.width // window * window
+    shape = (height // window, window, width // window, window)
+    x = x[:height, :width].reshape(shape)
+    y = y[:height, :width].reshape(shape)
+
+    mean_x = x.mean(axis=(1, 3), keepdims=True)
+    mean_y = y.mean(axis=(1, 3), keepdims=True)
+    var_x = ((x - mean_x) ** 2).mean(axis=(1, 3), keepdims=True)
+    var_y = ((y - mean_y) ** 2).mean(axis=(1, 3), keepdims=True)
+    cov = ((x - mean_x) * (y - mean_y)).mean(axis=(1, 3), keepdims=True)
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    scores = ((2 * mean_x * mean_y + c1) * (2 * cov + c2)) / (
+        (mean_x**2 + mean_y**2 + c1) * (var_x + var_y + c2)
+    )
+    return float(scores.mean())
+
+
+def encode_adaptive(
+    image: Image.Image,
+    format: Format,
+    target_bytes: typing.Optional[int] = None,
+    min_ssim: typing.Optional[float] = None,
+    max_trials: int = 6,
+    metadata: typing.Optional[typing.Dict[str, bytes]] = None,
+) -> EncodeTrial:
+    """Encode `image` at the lowest quality that keeps `min_ssim`.
+
+    `target_bytes` caps the quality first, so the byte budget wins when the
+    two disagree; without a floor the highest quality within the budget is
+    used. Each step of the binary searches is one trial encode of the same
+    decoded bitmap, at most `max_trials` in total. When nothing satisfies a
+    constraint the smallest (for a budget) or best (for a floor) trial is
+    returned. `metadata` are save params written with every trial, such as
+    an EXIF blob.
+    """
+    if format == Format.AUTO:
+        formats = [Format.WEBP]
+        if not _has_alpha(image):
+            formats.insert(0, Format.JPEG)
+        results = [
+            encode_adaptive(
+                image, f, target_bytes, min_ssim, max_trials, metadata
+            )
+            for f in formats
+        ]
+        return min(
+            results,
+            key=lambda t: (
+                not _acceptable(t, target_bytes, min_ssim),
+                len(t.body),
+            ),
+        )
+
+    source = image.convert("RGB") if format == Format.JPEG else image
+    reference = image.convert("L") if min_ssim is not None else None
+    trials: typing.Dict[int, EncodeTrial] = {}
+
+    def trial(quality: int) -> EncodeTrial:
+        if quality not in trials:
+            with BytesIO() as wbuf:
+                source.save(
+                    wbuf, format.value, quality=quality, **(metadata or {})
+                )
+                body = wbuf.getvalue()
+            score = None
+            if reference is not None:
+                with Image.open(BytesIO(body)) as decoded:
+                    score = ssim(reference, decoded)
+            trials[quality] = EncodeTrial(format, quality, body, score)
+        return trials[quality]
+
+    def search(
+        low: int,
+        high: int,
+        ok: typing.Callable[[EncodeTrial], bool],
+        lowest: bool,
+    ) -> typing.Optional[EncodeTrial]:
+        found = None
+        while low <= high and len(trials) < max_trials:
+            current = trial((low + high) // 2)
+            if ok(current):
+                found = current
+            if ok(current) == lowest:
+                high = current.quality - 1
+            else:
+                low = current.quality + 1
+        return found
+
+    if target_bytes is None and min_ssim is None:
+        return trial(DEFAULT_QUALITY[format])
+
+    best = None
+    high = MAX_QUALITY
+    if target_bytes is not None:
+        budget = target_bytes
+        best = search(
+            MIN_QUALITY,
+            MAX_QUALITY,
+            lambda t: len(t.body) <= budget,
+            lowest=False,
+        )
+        if best is None:
+            return min(trials.values(), key=lambda t: len(t.body))
+        high = best.quality
+    if min_ssim is not None:
+        floor = min_ssim
+        best = (
+            search(
+                MIN_QUALITY,
+                high,
+                lambda t: typing.cast(float, t.ssim) >= floor,
+                lowest=True,
+            )
+            or best
+        )
+    if best is None:
+        return max(trials.values(), key=lambda t: t.quality)
+    return best
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+
+
+def _acceptable(
+    trial: EncodeTrial,
+    target_bytes: typing.Optional[int],
+    min_ssim: typing.Optional[float],
+) -> bool:
+    if target_bytes is not None and len(trial.body) > target_bytes:
+        return False
+    if min_ssim is not None and (trial.ssim or 0.0) < min_ssim:
+        return False
+    return True
+
+
+# enough of a JPEG to hold the EXIF segment (at most 64KB) and the frame
+# header, which may follow other APPn segments such as an ICC profile
+JPEG_HEADER_BYTES = 128 * 1024
+# start of frame markers, all but DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+@dataclass
+class JpegHeader:
+    width: int
+    height: int
+    thumbnail: typing.Optional[bytes] = None
+    # of the image, its EXIF thumbnail has none of its own
+    orientation: int = 1
+
+
+def parse_jpeg_header(data: bytes) -> typing.Optional[JpegHeader]:
+    """Dimensions, orientation and EXIF thumbnail from the start of a JPEG.
+
+    None if `data` is not a JPEG or ends before the frame header.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    thumbnail = None
+    orientation = 1
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        (length,) = struct.unpack(">H", data[offset + 2 : offset + 4])
+        segment = data[offset + 4 : offset + 2 + length]
+        if marker == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            orientation, thumbnail = _parse_exif(segment[6:])
+        elif marker in JPEG_SOF_MARKERS:
+            if len(segment) < 5:
+                return None
+            height, width = struct.unpack(">HH", segment[1:5])
+            return JpegHeader(width, height, thumbnail, orientation)
+        elif marker == 0xDA:
+            # scan data without a frame header
+            return None
+        offset += 2 + length
+    return None
+
+
+def _parse_exif(
+    tiff: bytes,
+) -> typing.Tuple[int, typing.Optional[bytes]]:
+    """Orientation from IFD0 of EXIF (TIFF) data, and the JPEG thumbnail
+    referenced by IFD1."""
+    endian = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if endian is None:
+        return 1, None
+    try:
+        (ifd0,) = struct.unpack(endian + "I", tiff[4:8])
+        values, ifd1 = _ifd_values(tiff, endian, ifd0)
+        orientation = values.get(EXIF_ORIENTATION, 1)
+        if not ifd1:
+            return orientation, None
+        values, _ = _ifd_values(tiff, endian, ifd1)
+    except struct.error:
+        return 1, None
+    # JPEGInterchangeFormat and JPEGInterchangeFormatLength
+    start, length = values.get(0x0201), values.get(0x0202)
+    if not start or not length:
+        return orientation, None
+    thumbnail = tiff[start : start + length]
+    if len(thumbnail) != length or not thumbnail.startswith(b"\xff\xd8"):
+        return orientation, None
+    return orientation, thumbnail
+
+
+def _ifd_values(
+    tiff: bytes, endian: str, offset: int
+) -> typing.Tuple[typing.Dict[int, int], int]:
+    """Integer values of the IFD at `offset`, and the offset of the next."""
+    (count,) = struct.unpack(endian + "H", tiff[offset : offset + 2])
+    values = {}
+    for i in range(count):
+        entry = tiff[offset + 2 + 12 * i : offset + 14 + 12 * i]
+        tag, field_type, _ = struct.unpack(endian + "HHI", entry[:8])
+        # SHORT values are left aligned in the value field
+        fmt = "H" if field_type == 3 else "I"
+        (values[tag],) = struct.unpack_from(endian + fmt, entry, 8)
+    next_offset = offset + 2 + 12 * count
+    (next_ifd,) = struct.unpack(
+        endian + "I", tiff[next_offset : next_offset + 4]
     )
+    return values, next_ifd
+
+
+class DecodedImage:
+    """An image as decoded, and shrunk, by one of the engines."""
+
+    # source format, in the lower case of the output content type
+    format: str
+    width: int
+    height: int
+    source_width: int
+    source_height: int
+    # bytes of the EXIF, ICC and XMP blobs of the source
+    source_metadata_bytes: int = 0
+
+    def to_pillow(self) -> Image.Image:
+        raise NotImplementedError
+
+    def kept_metadata(self) -> typing.Dict[str, bytes]:
+        """EXIF and ICC blobs saved with the output, as Pillow save params."""
+        return {}
+
+    def save(
+        self,
+        format: typing.Optional[str] = None,
+        quality: typing.Optional[int] = None,
+    ) -> bytes:
+        """Encode as `format`, or as the source format and mode if None."""
+        raise NotImplementedError
+
+
+@dataclass
+class AnimationBudget:
+    max_frames: int
+    max_pixels: int
+    fallback: AnimationFallback = AnimationFallback.SUBSAMPLE
+    max_source_frames: int = DEFAULT_MAX_SOURCE_FRAMES
+
+
+@dataclass
+class MetadataPolicy:
+    auto_orient: bool = True
+    icc: IccPolicy = IccPolicy.SRGB
+    exif: ExifPolicy = ExifPolicy.DROP
+
+
+# the transpose that undoes each EXIF orientation
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+EXIF_ORIENTATION = 0x0112
+EXIF_GPS_IFD = 0x8825
+SRGB_PROFILE = ImageCms.createProfile("sRGB")
+
+
+def _oriented(
+    size: typing.Tuple[int, int], orientation: int
+) -> typing.Tuple[int, int]:
+    # orientations 5 to 8 turn the image a quarter
+    return (size[1], size[0]) if orientation in (5, 6, 7, 8) else size
+
+
+def metadata_bytes(info: typing.Mapping[typing.Any, typing.Any]) -> int:
+    """Bytes of the EXIF, ICC and XMP blobs in the info of a Pillow image."""
+    return sum(
+        len(info.get(key) or b"") for key in ("exif", "icc_profile", "xmp")
+    )
+
+
+def strip_exif(data: bytes, orientation: bool = False) -> bytes:
+    """EXIF without the GPS IFD and the thumbnail, and without the
+    orientation too with `orientation`, once it is applied to the pixels."""
+    exif = Image.Exif()
+    exif.load(data)
+    # the thumbnail of IFD1 is not written back
+    exif.pop(EXIF_GPS_IFD, None)
+    if orientation:
+        exif.pop(EXIF_ORIENTATION, None)
+    return exif.tobytes()
+
+
+def to_srgb(image: Image.Image, icc_profile: bytes) -> Image.Image:
+    """Convert the pixels of `image` from `icc_profile` to sRGB.
+
+    Palette and grayscale images are left as they are, their profile is
+    only dropped.
+    """
+    mode = {"RGB": "RGB", "RGBA": "RGBA", "CMYK": "RGB"}.get(image.mode)
+    if mode is None:
+        return image
+    try:
+        converted = ImageCms.profileToProfile(
+            image,
+            ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+            SRGB_PROFILE,
+            outputMode=mode,
+        )
+    except (ImageCms.PyCMSError, OSError):
+        logger.warning("unreadable ICC profile left unapplied")
+        return image
+    return typing.cast(Image.Image, converted)
+
+
+class ImageEngine:
+    def load(
+        self,
+        fileobj: typing.BinaryIO,
+        resize: typing.Optional[int],
+        animation: typing.Optional[AnimationBudget] = None,
+        metadata_policy: typing.Optional[MetadataPolicy] = None,
+        orientation: typing.Optional[int] = None,
+    ) -> DecodedImage:
+        """Decode and shrink to fit `resize`.
+
+        Animated sources are only decoded frame by frame with `animation`,
+        and flattened to their first frame otherwise. The metadata of the
+        source is applied or kept by `metadata_policy`, MetadataPolicy() if
+        None. `orientation` stands in for the EXIF orientation of a source
+        without any, such as an EXIF thumbnail.
+        """
+        raise NotImplementedError
+
+
+class PillowImage(DecodedImage):
+    def __init__(
+        self,
+        image: Image.Image,
+        source_size: typing.Tuple[int, int],
+        format: typing.Optional[str] = None,
+    ) -> None:
+        self.image = image
+        # transposed and converted images have no format of their own
+        self.format = format or typing.cast(str, image.format).lower()
+        self.width, self.height = image.size
+        self.source_width, self.source_height = source_size
+        self.metadata: typing.Dict[str, bytes] = {}
+
+    def to_pillow(self) -> Image.Image:
+        return self.image
+
+    def kept_metadata(self) -> typing.Dict[str, bytes]:
+        return self.metadata
+
+    def save(
+        self,
+        format: typing.Optional[str] = None,
+        quality: typing.Optional[int] = None,
+    ) -> bytes:
+        image = self.image
+        if format == Format.JPEG.value:
+            image = image.convert("RGB")
+        # PNG would keep the profile of the source otherwise
+        params: typing.Dict[str, typing.Any] = {"icc_profile": None}
+        params.update(self.metadata)
+        if quality is not None:
+            params["quality"] = quality
+        with BytesIO() as wbuf:
+            image.save(wbuf, format or self.format, **params)
+            return wbuf.getvalue()
+
+
+# formats whose animation is kept
+ANIMATED_FORMATS = {"gif", "webp"}
+
+
+class AnimatedImage(DecodedImage):
+    """The frames of an animation, composited and shrunk alike."""
+
+    def __init__(
+        self,
+        frames: typing.List[Image.Image],
+        durations: typing.List[int],
+        loop: int,
+        format: str,
+        source_size: typing.Tuple[int, int],
+    ) -> None:
+        self.frames = frames
+        self.durations = durations
+        self.loop = loop
+        self.format = format
+        self.width, self.height = frames[0].size
+        self.source_width, self.source_height = source_size
+
+    def to_pillow(self) -> Image.Image:
+        return self.frames[0]
+
+    def save(
+        self,
+        format: typing.Optional[str] = None,
+        quality: typing.Optional[int] = None,
+    ) -> bytes:
+        format = format or self.format
+        if format not in ANIMATED_FORMATS:
+            raise ValueError(f"{format} is not animated")
+        params: typing.Dict[str, typing.Any] = {}
+        if quality is not None:
+            params["quality"] = quality
+        if format == "gif":
+            # every frame is whole, none is drawn over the one before
+            params["disposal"] = 2
+        with BytesIO() as wbuf:
+            self.frames[0].save(
+                wbuf,
+                format,
+                save_all=True,
+                append_images=self.frames[1:],
+                duration=self.durations,
+                loop=self.loop,
+                **params,
+            )
+            return wbuf.getvalue()
+
+
+def _fit(
+    size: typing.Tuple[int, int], resize: typing.Optional[int]
+) -> typing.Tuple[int, int]:
+    width, height = size
+    if not resize or max(width, height) <= resize:
+        return size
+    scale = resize / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def load_animation(
+    image: Image.Image,
+    resize: typing.Optional[int],
+    budget: AnimationBudget,
+) -> typing.Optional[AnimatedImage]:
+    """Decode and shrink the frames of an animated image in one pass.
+
+    Pillow composites each frame onto the ones before it as it seeks,
+    applying their disposal and own palettes, so every frame comes out
+    whole and is converted to RGBA alike. Over `budget`, frames are dropped
+    evenly, or None is returned for the caller to make a still poster. Every
+    frame is still decoded, frames depend on the ones before, but only the
+    kept ones are resized and encoded; so sources of more than
+    `max_source_frames` frames are always posters.
+    """
+    count: int = getattr(image, "n_frames", 1)
+    size = _fit(image.size, resize)
+    keep = min(
+        count, budget.max_frames, budget.max_pixels // (size[0] * size[1])
+    )
+    if keep < count:
+        if (
+            budget.fallback == AnimationFallback.POSTER
+            or keep < 2
+            or count > budget.max_source_frames
+        ):
+            metrics.add_metric(
+                name="AnimationPosters", unit=MetricUnit.Count, value=1
+            )
+            return None
+        metrics.add_metric(
+            name="AnimationsSubsampled", unit=MetricUnit.Count, value=1
+        )
+    kept = {i * count // keep for i in range(keep)}
+
+    frames: typing.List[Image.Image] = []
+    durations: typing.List[int] = []
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = int(frame.info.get("duration") or 0)
+        if index not in kept:
+            durations[-1] += duration
+            continue
+        frame = frame.convert("RGBA")
+        if frame.size != size:
+            frame = frame.resize(size, Image.Resampling.BICUBIC)
+        frames.append(frame)
+        durations.append(duration)
+    return AnimatedImage(
+        frames,
+        durations,
+        image.info.get("loop", 0),
+        typing.cast(str, image.format).lower(),
+        image.size,
+    )
+
+
+class PillowEngine(ImageEngine):
+    def load(
+        self,
+        fileobj: typing.BinaryIO,
+        resize: typing.Optional[int],
+        animation: typing.Optional[AnimationBudget] = None,
+        metadata_policy: typing.Optional[MetadataPolicy] = None,
+        orientation: typing.Optional[int] = None,
+    ) -> DecodedImage:
+        policy = metadata_policy or MetadataPolicy()
+        image: Image.Image = Image.open(fileobj)
+        format = typing.cast(str, image.format).lower()
+        info = image.info
+        source_size = image.size
+        # MPO, APNG and multi-page TIFF are flattened like any other still
+        if (
+            animation
+            and format in ANIMATED_FORMATS
+            and getattr(image, "is_animated", False)
+        ):
+            animated = load_animation(image, resize, animation)
+            if animated:
+                # frames are taken as sRGB, with no metadata kept
+                animated.source_metadata_bytes = metadata_bytes(info)
+                return animated
+            image.seek(0)
+        # decoding is lazy, so it is part of the resize; JPEG sources are
+        # decoded at a reduced scale there
+        if resize:
+            image.thumbnail((resize, resize))
+        else:
+            image.load()
+
+        exif = info.get("exif")
+        if orientation is None:
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        # the bounds of the resize are square, so orienting after it is the
+        # same, on fewer pixels
+        if policy.auto_orient and orientation in EXIF_TRANSPOSE:
+            image = image.transpose(EXIF_TRANSPOSE[orientation])
+            source_size = _oriented(source_size, orientation)
+        icc_profile = info.get("icc_profile")
+        if icc_profile and policy.icc == IccPolicy.SRGB:
+            image = to_srgb(image, icc_profile)
+        decoded = PillowImage(image, source_size, format)
+        decoded.source_metadata_bytes = metadata_bytes(info)
+        if icc_profile and policy.icc == IccPolicy.KEEP:
+            decoded.metadata["icc_profile"] = icc_profile
+        if exif and policy.exif == ExifPolicy.NO_GPS:
+            decoded.metadata["exif"] = strip_exif(exif, policy.auto_orient)
+        return decoded
+
+
+# libvips picks the saver by suffix
+VIPS_SUFFIXES = {"jpeg": ".jpg", "webp": ".webp", "png": ".png", "gif": ".gif"}
+# libvips encodes both at 75 by default, match the Pillow output instead
+VIPS_DEFAULT_QUALITY = {f.value: q for f, q in DEFAULT_QUALITY.items()}
+# libvips leaves PNG rows unfiltered by default, Pillow picks one per row
+VIPS_SAVE_OPTIONS: typing.Dict[str, typing.Dict[str, typing.Any]] = {
+    "png": {"filter": "all"},
+}
+# the metadata blobs of libvips, and the Pillow save params of those kept
+VIPS_METADATA_FIELDS = ["exif-data", "icc-profile-data", "xmp-data"]
+VIPS_KEPT_METADATA = {"exif": "exif-data", "icc": "icc-profile-data"}
+PILLOW_METADATA_PARAMS = {"exif": "exif", "icc": "icc_profile"}
+
+
+class VipsImage(DecodedImage):
+    def __init__(
+        self,
+        image: typing.Any,
+        format: str,
+        source_size: typing.Tuple[int, int],
+        keep: typing.Sequence[str] = (),
+    ) -> None:
+        self.image = image
+        self.format = format
+        self.width, self.height = image.width, image.height
+        self.source_width, self.source_height = source_size
+        # what the savers keep of the metadata, "exif" and "icc"
+        self.keep = keep
+
+    def to_pillow(self) -> Image.Image:
+        # the pipeline reads the source sequentially and only once, keep the
+        # shrunk pixels for the encode that follows
+        self.image = self.image.copy_memory()
+        image = self.image
+        if image.format != "uchar":
+            image = image.cast("uchar")
+        return Image.fromarray(image.numpy())
+
+    def kept_metadata(self) -> typing.Dict[str, bytes]:
+        return {
+            PILLOW_METADATA_PARAMS[name]: self.image.get(
+                VIPS_KEPT_METADATA[name]
+            )
+            for name in self.keep
+        }
+
+    def save(
+        self,
+        format: typing.Optional[str] = None,
+        quality: typing.Optional[int] = None,
+    ) -> bytes:
+        image = self.image
+        if format == Format.JPEG.value:
+            # what Pillow's convert("RGB") does
+            if image.hasalpha():
+                image = image.extract_band(0, n=image.bands - 1)
+            if image.interpretation == "cmyk":
+                image = image.colourspace("srgb")
+        format = format or self.format
+        if quality is None and format in VIPS_DEFAULT_QUALITY:
+            quality = VIPS_DEFAULT_QUALITY[format]
+        options = dict(VIPS_SAVE_OPTIONS.get(format, {}))
+        options["keep"] = "|".join(self.keep) or "none"
+        if quality is not None:
+            options["Q"] = quality
+        return image.write_to_buffer(VIPS_SUFFIXES[format], **options)
+
+
+class VipsEngine(ImageEngine):
+    def __init__(self) -> None:
+        if pyvips is None:
+            raise RuntimeError("the vips engine requires pyvips and libvips")
+
+    def load(
+        self,
+        fileobj: typing.BinaryIO,
+        resize: typing.Optional[int],
+        animation: typing.Optional[AnimationBudget] = None,
+        metadata_policy: typing.Optional[MetadataPolicy] = None,
+        orientation: typing.Optional[int] = None,
+    ) -> DecodedImage:
+        policy = metadata_policy or MetadataPolicy()
+        data = fileobj.read()
+        # only the header is read here
+        source = pyvips.Image.new_from_buffer(data, "", access="sequential")
+        format = source.get("vips-loader").split("load")[0]
+        if (
+            animation
+            and format in ANIMATED_FORMATS
+            and source.get_n_pages() > 1
+        ):
+            # frames are composited by Pillow, as by the Pillow engine
+            return PillowEngine().load(
+                BytesIO(data), resize, animation, policy, orientation
+            )
+        source_size = (source.width, source.height)
+        own_orientation = _vips_int(source, "orientation", 1)
+        image = source
+        if resize:
+            # shrink-on-load, and orient the shrunk image
+            image = pyvips.Image.thumbnail_buffer(
+                data,
+                resize,
+                height=resize,
+                size="down",
+                no_rotate=not policy.auto_orient,
+            )
+        elif policy.auto_orient and own_orientation in EXIF_TRANSPOSE:
+            # turning reads the source out of order
+            image = pyvips.Image.new_from_buffer(data, "").autorot()
+        if policy.auto_orient:
+            if orientation in EXIF_TRANSPOSE:
+                image = image.copy_memory()
+                image.set_type(
+                    pyvips.GValue.gint_type, "orientation", orientation
+                )
+                image = image.autorot()
+            source_size = _oriented(source_size, orientation or own_orientation)
+
+        keep = []
+        if image.get_typeof("icc-profile-data"):
+            if policy.icc == IccPolicy.KEEP:
+                keep.append("icc")
+            else:
+                try:
+                    image = image.icc_transform("srgb", embedded=True)
+                except pyvips.Error:
+                    logger.warning("unreadable ICC profile left unapplied")
+        if image.get_typeof("exif-data") and policy.exif == ExifPolicy.NO_GPS:
+            image = _set_vips_exif(
+                image, strip_exif(image.get("exif-data"), policy.auto_orient)
+            )
+            keep.append("exif")
+        decoded = VipsImage(image, format, source_size, keep)
+        decoded.source_metadata_bytes = sum(
+            len(source.get(name))
+            for name in VIPS_METADATA_FIELDS
+            if source.get_typeof(name)
+        )
+        return decoded
+
+
+def _vips_int(image: typing.Any, name: str, default: int) -> int:
+    return image.get(name) if image.get_typeof(name) else default
+
+
+def _set_vips_exif(image: typing.Any, exif: bytes) -> typing.Any:
+    # libvips writes the exif-ifd fields back into the blob as it saves
+    image = image.copy()
+    for name in image.get_fields():
+        if name.startswith("exif-ifd"):
+            image.remove(name)
+    image.set_type(pyvips.GValue.blob_type, "exif-data", exif)
+    return image
+
+
+ENGINES: typing.Dict[Engine, typing.Type[ImageEngine]] = {
+    Engine.PILLOW: PillowEngine,
+    Engine.VIPS: VipsEngine,
+}
+
+
+SENTRY_DSN = os.environ.get("SENTRY_DSN")
+# invocations slower than this are reported even when not sampled
+TRACES_SLOW_MS = float(os.getenv("APP_TRACES_SLOW_MS") or 3000)
+if SENTRY_DSN:
+    telemetry.init_sentry(SENTRY_DSN)
 
 
 class SentryBatchProcessor(BatchProcessor):
     def failure_handler(self, record, exception) -> FailureResponse:
         if SENTRY_DSN:
-            capture_exception()
+            # a flush failure is handled outside of its except block
+            capture_exception(exception[1])
         return super().failure_handler(record, exception)
 
 
-processor = SentryBatchProcessor(event_type=EventType.SQS)
+def _add_latency(name: str, seconds: float) -> None:
+    # clocks of different hosts may disagree by a little
+    metrics.add_metric(
+        name=name,
+        unit=MetricUnit.Milliseconds,
+        value=max(seconds, 0.0) * 1000,
+    )
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class ImageIndex:
+    """Per-image catalog of converted variants, kept in DynamoDB.
+
+    Items are keyed by `UserId` and `ImageId` and hold one `Variants` map
+    entry per `{format}/{resize}`. Updates are buffered and coalesced per
+    image so a batch of records costs one conditional write per image.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        max_pending: int = 25,
+        dynamodb: typing.Optional[typing.Any] = None,
+    ) -> None:
+        self.table = (dynamodb or boto3.resource("dynamodb")).Table(table_name)
+        self.max_pending = max_pending
+        self._pending: typing.Dict[
+            typing.Tuple[str, str], typing.Dict[str, typing.Any]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def add_variant(
+        self,
+        user_id: str,
+        image_id: str,
+        variant: str,
+        attributes: typing.Dict[str, typing.Any],
+        source: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> None:
+        with self._lock:
+            pending = self._pending.setdefault(
+                (user_id, image_id), {"Variants": {}, "Source": {}}
+            )
+            pending["Variants"][variant] = attributes
+            pending["Source"].update(source or {})
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    @tracer.capture_method
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (user_id, image_id), update in pending.items():
+            self._update(user_id, image_id, update)
+
+    def _update(
+        self,
+        user_id: str,
+        image_id: str,
+        update: typing.Dict[str, typing.Any],
+    ) -> None:
+        names = {"#variants": "Variants", "#updated": "UpdatedAt"}
+        values: typing.Dict[str, typing.Any] = {":updated": _now_ms()}
+        expressions = ["#updated = :updated"]
+        for i, (name, value) in enumerate(update["Source"].items()):
+            names[f"#s{i}"] = name
+            values[f":s{i}"] = value
+            expressions.append(f"#s{i} = :s{i}")
+        for i, (variant, attributes) in enumerate(update["Variants"].items()):
+            names[f"#v{i}"] = variant
+            values[f":v{i}"] = attributes
+            expressions.append(f"#variants.#v{i} = :v{i}")
+
+        key = {"UserId": user_id, "ImageId": image_id}
+        for _ in range(2):
+            try:
+                self.table.update_item(
+                    Key=key,
+                    UpdateExpression="SET " + ", ".join(expressions),
+                    ConditionExpression="attribute_exists(#variants)",
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values,
+                )
+                return
+            except ClientError as e:
+                if not _is_conditional_check_failed(e):
+                    raise
+            # first variant of an image that was not indexed at ingestion,
+            # create the map and try again
+            try:
+                self.table.update_item(
+                    Key=key,
+                    UpdateExpression="SET #variants = :empty",
+                    ConditionExpression="attribute_not_exists(#variants)",
+                    ExpressionAttributeNames={"#variants": "Variants"},
+                    ExpressionAttributeValues={":empty": {}},
+                )
+            except ClientError as e:
+                if not _is_conditional_check_failed(e):
+                    raise
+        raise RuntimeError(f"failed to index {user_id}/{image_id}")
+
+
+# hex digits of the shard prefix, 256 prefixes
+KEY_SHARD_CHARS = 2
+
+
+def variant_key(
+    variant: str,
+    user_id: str,
+    image_id: str,
+    layout: KeyLayout = KeyLayout.PLAIN,
+) -> str:
+    """Key of a variant of an image in the output bucket.
+
+    Readers that do not go through the index resolve keys here too, with the
+    layout the variant is written with.
+    """
+    key = "/".join([variant, user_id, image_id])
+    if layout == KeyLayout.SHARDED:
+        digest = hashlib.md5(f"{user_id}/{image_id}".encode()).hexdigest()
+        return f"{digest[:KEY_SHARD_CHARS]}/{key}"
+    return key
+
+
+# adaptive mode slows the client down on 503 SlowDown, which S3 answers a
+# burst on a prefix with until it has partitioned it
+S3_CONFIG = Config(retries={"mode": "adaptive", "max_attempts": 10})
+
+
+def create_s3_client(**kwargs: typing.Any) -> typing.Any:
+    client = boto3.client("s3", config=S3_CONFIG, **kwargs)
+    client.meta.events.register("needs-retry.s3", _count_slow_down)
+    return client
+
+
+def _count_slow_down(response: typing.Any = None, **kwargs: typing.Any) -> None:
+    # called before every retry decision, whatever the outcome
+    if response is None:
+        return
+    error = response[1].get("Error", {})
+    if error.get("Code") == "SlowDown":
+        metrics.add_metric(name="S3SlowDown", unit=MetricUnit.Count, value=1)
+
+
+def _is_conditional_check_failed(e: ClientError) -> bool:
+    return e.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+
+def _is_precondition_failed(e: ClientError) -> bool:
+    return e.response["Error"]["Code"] in ("PreconditionFailed", "412")
+
+
+# segments of packed variants: the images back to back, then an index of
+# PACK_ENTRY records each followed by the image id, then PACK_TRAILER with
+# the index length. A reader gets the index with one suffix range GET.
+PACK_MAGIC = b"MLP1"
+PACK_ENTRY = struct.Struct(">QIH")
+PACK_TRAILER = struct.Struct(">I4s")
+# suffix read for the index, enough for about 2000 entries
+PACK_INDEX_READ_BYTES = 64 * 1024
+# tag of segments whose variants were moved by compaction, expired by a
+# lifecycle rule of the output bucket
+PACK_COMPACTED_TAG = "multilens:compacted"
+
+
+@dataclass
+class PackEntry:
+    image_id: str
+    offset: int
+    length: int
+
+
+def encode_pack_index(entries: typing.Sequence[PackEntry]) -> bytes:
+    index = b"".join(
+        PACK_ENTRY.pack(e.offset, e.length, len(image_id)) + image_id
+        for e, image_id in ((e, e.image_id.encode()) for e in entries)
+    )
+    return index + PACK_TRAILER.pack(len(index), PACK_MAGIC)
+
+
+def pack_index_length(tail: bytes) -> int:
+    """Bytes of index and trailer at the end of a segment."""
+    if len(tail) < PACK_TRAILER.size:
+        raise ValueError("not a packed segment")
+    length, magic = PACK_TRAILER.unpack_from(
+        tail, len(tail) - PACK_TRAILER.size
+    )
+    if magic != PACK_MAGIC:
+        raise ValueError("not a packed segment")
+    return length + PACK_TRAILER.size
+
+
+def decode_pack_index(tail: bytes) -> typing.List[PackEntry]:
+    """Entries of a segment, from a tail holding at least the whole index."""
+    length = pack_index_length(tail)
+    if length > len(tail):
+        raise ValueError("incomplete segment index")
+    index = memoryview(tail)[len(tail) - length : len(tail) - PACK_TRAILER.size]
+    entries = []
+    position = 0
+    while position < len(index):
+        offset, size, id_length = PACK_ENTRY.unpack_from(index, position)
+        position += PACK_ENTRY.size
+        image_id = bytes(index[position : position + id_length]).decode()
+        position += id_length
+        entries.append(PackEntry(image_id, offset, size))
+    return entries
+
+
+def read_pack_index(
+    s3: typing.Any, bucket_name: str, key: str
+) -> typing.List[PackEntry]:
+    tail = s3.get_object(
+        Bucket=bucket_name,
+        Key=key,
+        Range=f"bytes=-{PACK_INDEX_READ_BYTES}",
+    )["Body"].read()
+    length = pack_index_length(tail)
+    if length > len(tail):
+        tail = s3.get_object(
+            Bucket=bucket_name,
+            Key=key,
+            Range=f"bytes=-{length}",
+        )["Body"].read()
+    return decode_pack_index(tail)
+
+
+def pack_segment_key(variant: str, user_id: str) -> str:
+    # segments of a user sort by the time they were written
+    return "/".join(
+        ["packs", variant, user_id, f"{_now_ms():013d}-{uuid4().hex[:8]}"]
+    )
+
+
+def encode_pack_segment(
+    images: typing.Sequence[typing.Tuple[str, bytes]]
+) -> typing.Tuple[bytes, typing.List[PackEntry]]:
+    entries = []
+    offset = 0
+    for image_id, data in images:
+        entries.append(PackEntry(image_id, offset, len(data)))
+        offset += len(data)
+    body = b"".join(data for _, data in images) + encode_pack_index(entries)
+    return body, entries
+
+
+class PackWriter:
+    """Appends small variants of each user into shared segment objects.
+
+    A PUT per thumbnail, and a GET per thumbnail on a gallery page, become a
+    PUT per segment and a range GET per page. Variants are buffered per user
+    and written as one segment when the user's buffer reaches
+    `segment_bytes` or on `flush`; `on_written` is then called with the
+    segment key and the offset of each buffered item. Segments are never
+    modified, `multilens.tools.compact` merges the small ones.
+    """
+
+    def __init__(
+        self,
+        s3: typing.Any,
+        bucket_name: str,
+        variant: str,
+        on_written: typing.Callable[
+            [str, typing.List[typing.Tuple[PackEntry, typing.Any]]], None
+        ],
+        segment_bytes: int = 4 * 1024 * 1024,
+        cache_control: typing.Optional[str] = None,
+    ) -> None:
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.variant = variant
+        self.on_written = on_written
+        self.segment_bytes = segment_bytes
+        self.cache_control = cache_control
+        self._pending: typing.Dict[
+            str, typing.List[typing.Tuple[str, bytes, typing.Any]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self, user_id: str, image_id: str, body: bytes, item: typing.Any
+    ) -> None:
+        with self._lock:
+            pending = self._pending.setdefault(user_id, [])
+            pending.append((image_id, body, item))
+            full = sum(len(b) for _, b, _ in pending) >= self.segment_bytes
+            if full:
+                del self._pending[user_id]
+        if full:
+            self._write(user_id, pending)
+
+    @tracer.capture_method
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for user_id, items in pending.items():
+            self._write(user_id, items)
+
+    def _write(
+        self,
+        user_id: str,
+        items: typing.List[typing.Tuple[str, bytes, typing.Any]],
+    ) -> None:
+        key = pack_segment_key(self.variant, user_id)
+        body, entries = encode_pack_segment(
+            [(image_id, data) for image_id, data, _ in items]
+        )
+        extra_args: typing.Dict[str, typing.Any] = {
+            "ContentType": "application/octet-stream",
+            "Metadata": {"variant": self.variant, "userid": user_id},
+        }
+        if self.cache_control:
+            extra_args["CacheControl"] = self.cache_control
+        self.s3.put_object(
+            Bucket=self.bucket_name, Key=key, Body=body, **extra_args
+        )
+        metrics.add_metric(
+            name="PackedVariants", unit=MetricUnit.Count, value=len(items)
+        )
+        self.on_written(
+            key,
+            [(entry, item) for entry, (_, _, item) in zip(entries, items)],
+        )
+
+
+class SupersededError(Exception):
+    """The original was overwritten after the event being converted."""
+
+
+# S3 sequencers are hex strings of varying length, ordered once the shorter
+# one is right padded with zeros
+SEQUENCER_LENGTH = 64
+
+
+def pad_sequencer(sequencer: str) -> str:
+    return sequencer.upper().ljust(SEQUENCER_LENGTH, "0")
+
+
+class SequenceTable:
+    """Last S3 sequencer converted into each output key, in DynamoDB.
+
+    Notifications for an overwritten key may arrive late and out of order.
+    An event claims the output key before it is converted and checks the
+    claim again before uploading, so an older version never replaces the
+    variant of a newer one. Records expire after `ttl_seconds`, S3 does not
+    deliver events that late.
+    """
+
+    ttl_seconds = 7 * 24 * 60 * 60
+
+    def __init__(
+        self, table_name: str, dynamodb: typing.Optional[typing.Any] = None
+    ) -> None:
+        self.table = (dynamodb or boto3.resource("dynamodb")).Table(table_name)
+
+    def claim(self, key: str, sequencer: str) -> bool:
+        """Record `sequencer` for `key` unless a later one already is.
+
+        The same sequencer may claim again, a retried event is converted
+        again.
+        """
+        try:
+            self.table.put_item(
+                Item={
+                    "Key": key,
+                    "Sequencer": pad_sequencer(sequencer),
+                    "ExpiresAt": int(time.time()) + self.ttl_seconds,
+                },
+                ConditionExpression=(
+                    "attribute_not_exists(#key) OR #sequencer <= :sequencer"
+                ),
+                ExpressionAttributeNames={
+                    "#key": "Key",
+                    "#sequencer": "Sequencer",
+                },
+                ExpressionAttributeValues={
+                    ":sequencer": pad_sequencer(sequencer),
+                },
+            )
+        except ClientError as e:
+            if _is_conditional_check_failed(e):
+                return False
+            raise
+        return True
+
+    def is_latest(self, key: str, sequencer: str) -> bool:
+        item = self.table.get_item(
+            Key={"Key": key},
+            ConsistentRead=True,
+        ).get("Item")
+        return item is None or item["Sequencer"] <= pad_sequencer(sequencer)
 
 
 class ImageConvertProcessor:
-    def __init__(self, config: ConvertConfig) -> None:
+    def __init__(
+        self,
+        config: ConvertConfig,
+        s3_client: typing.Optional[typing.Any] = None,
+        dynamodb: typing.Optional[typing.Any] = None,
+    ) -> None:
         self.config = config
+        self.engine = ENGINES[config.engine]()
+        self._s3 = s3_client
+        self.index = (
+            ImageIndex(config.index_table_name, dynamodb=dynamodb)
+            if config.index_table_name
+            else None
+        )
+        self.sequences = (
+            SequenceTable(config.sequence_table_name, dynamodb=dynamodb)
+            if config.sequence_table_name
+            else None
+        )
+        self.packer: typing.Optional[PackWriter] = None
+        if config.pack:
+            if self.index is None:
+                raise ValueError("packed variants are only found by the index")
+            self.packer = PackWriter(
+                self.s3,
+                config.bucket_name,
+                self.variant_name(),
+                self._index_packed,
+                segment_bytes=config.pack_segment_bytes,
+                cache_control=config.cache_control,
+            )
+
+    @property
+    def s3(self) -> typing.Any:
+        if self._s3 is None:
+            self._s3 = create_s3_client()
+        return self._s3
 
     def process_records(
         self,
         records: typing.List[typing.Dict[str, typing.Any]],
-    ) -> None:
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
         raise NotImplementedError
 
+    def variant_name(self) -> str:
+        return "/".join(
+            [
+                self.config.format.value if self.config.format else "original",
+                str(self.config.resize) if self.config.resize else "original",
+            ]
+        )
+
+    def output_key(self, metadata: typing.Dict[str, str]) -> str:
+        return variant_key(
+            self.variant_name(),
+            metadata.get("userid", "anonymous"),
+            metadata.get("imageid", str(uuid4())),
+            self.config.key_layout,
+        )
+
+    def flush(self) -> None:
+        # segments first, their variants are indexed once written
+        if self.packer:
+            self.packer.flush()
+        if self.index:
+            self.index.flush()
+
+    def _flush_records(
+        self, records: typing.List[typing.Any]
+    ) -> typing.List[typing.Tuple[typing.Any, Exception]]:
+        """Flush the writes buffered for `records`, returning them as failed
+        if the flush fails.
+
+        Segments and index updates are buffered across the records of the
+        whole batch and written once here, so a record only succeeds once
+        its writes did.
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception("failed to flush %d records", len(records))
+            if records:
+                metrics.add_metric(
+                    name="FailedRecords",
+                    unit=MetricUnit.Count,
+                    value=len(records),
+                )
+            return [(record, e) for record in records]
+        return []
+
     @tracer.capture_method
     def _process_s3_records(
         self, records: typing.List[typing.Dict[str, typing.Any]]
-    ) -> None:
+    ) -> typing.List[typing.Tuple[typing.Dict[str, typing.Any], Exception]]:
+        """Convert every record, returning the ones that failed.
+
+        A failed record does not stop the others, so a retry of the failed
+        ones does not convert the rest again. Writes of the converted ones
+        stay buffered until `_flush_records`.
+        """
+        failures = []
         for record in records:
-            self._process_s3_record(record)
+            try:
+                self._process_s3_record(record)
+            except Exception as e:
+                logger.exception(
+                    "failed to convert %s",
+                    record.get("s3", {}).get("object", {}).get("key"),
+                )
+                failures.append((record, e))
+        if failures:
+            metrics.add_metric(
+                name="FailedRecords", unit=MetricUnit.Count, value=len(failures)
+            )
+        return failures
 
     @tracer.capture_method
     def _process_s3_record(self, record: typing.Dict[str, typing.Any]) -> None:
         logger.debug(record)
-        s3 = boto3.client("s3")
 
         bucket_name = record["s3"]["bucket"]["name"]
         object_key = record["s3"]["object"]["key"]
+        etag = record["s3"]["object"].get("eTag")
+        sequencer = record["s3"]["object"].get("sequencer")
 
-        head_response = s3.head_object(Bucket=bucket_name, Key=object_key)
+        started = time.time()
+        head_response = self.s3.head_object(Bucket=bucket_name, Key=object_key)
         logger.debug(head_response)
+
+        if etag and head_response["ETag"].strip('"') != etag:
+            # overwritten since, the event of the current version follows
+            self._add_superseded(object_key)
+            return
         metadata = head_response["Metadata"]
+        if self.variant_name() in metadata.get("previews", "").split(","):
+            # already rendered by the callback while ingesting the original
+            metrics.add_metric(
+                name="PreviewSkipped", unit=MetricUnit.Count, value=1
+            )
+            return
+        if not self._claim(metadata, sequencer):
+            self._add_superseded(object_key)
+            return
+        try:
+            self.convert_object(
+                bucket_name,
+                object_key,
+                metadata,
+                etag=head_response["ETag"],
+                sequencer=sequencer,
+            )
+        except SupersededError:
+            self._add_superseded(object_key)
+            return
+        self._add_latency_metrics(metadata, started, time.time())
 
-        with BytesIO() as rbuf:
-            s3.download_fileobj(
+    def _claim(
+        self, metadata: typing.Dict[str, str], sequencer: typing.Optional[str]
+    ) -> bool:
+        if self.sequences is None or not sequencer or "imageid" not in metadata:
+            # without an image id the output key is new every time
+            return True
+        return self.sequences.claim(self.output_key(metadata), sequencer)
+
+    def _add_superseded(self, object_key: str) -> None:
+        logger.info("dropped superseded event of %s", object_key)
+        metrics.add_metric(
+            name="SupersededEvents", unit=MetricUnit.Count, value=1
+        )
+
+    def _add_latency_metrics(
+        self,
+        metadata: typing.Dict[str, str],
+        started: float,
+        completed: float,
+    ) -> None:
+        """Per stage latency, timestamps from the callback's metadata.
+
+        Created is the LINE event time and Ingested the upload of the
+        original, so delivery covers the S3 notification, SNS and SQS.
+        """
+        _add_latency("ConversionDuration", completed - started)
+        if "ingested" in metadata:
+            _add_latency(
+                "DeliveryLatency", started - float(metadata["ingested"])
+            )
+        if "created" in metadata:
+            _add_latency(
+                "EndToEndLatency", completed - float(metadata["created"])
+            )
+
+    def convert_object(
+        self,
+        bucket_name: str,
+        object_key: str,
+        metadata: typing.Dict[str, str],
+        etag: typing.Optional[str] = None,
+        sequencer: typing.Optional[str] = None,
+    ) -> ConvertResult:
+        """Convert an original in S3 and upload it.
+
+        With `etag`, only that version of the original is converted. With
+        `sequencer`, the variant is only uploaded while no later event has
+        claimed it. SupersededError otherwise.
+        """
+        try:
+            result = None
+            if self.config.exif_thumbnail and self.config.resize:
+                result = self.convert_thumbnail(
+                    bucket_name, object_key, metadata, etag=etag
+                )
+            if result is None:
+                result = self._convert_original(
+                    bucket_name, object_key, metadata, etag=etag
+                )
+        except ClientError as e:
+            if _is_precondition_failed(e):
+                raise SupersededError(object_key) from e
+            raise
+        if (
+            self.sequences
+            and sequencer
+            and "imageid" in metadata
+            and not self.sequences.is_latest(result.key, sequencer)
+        ):
+            raise SupersededError(object_key)
+        with sentry_sdk.start_span(op="image.upload") as span:
+            span.set_data("bytes", len(result.body))
+            self._upload(result, metadata)
+        return result
+
+    def convert_content(
+        self, content: bytes, metadata: typing.Dict[str, str]
+    ) -> ConvertResult:
+        """Convert an original that is already in memory and upload it."""
+        result = self.convert_image(BytesIO(content), metadata)
+        with sentry_sdk.start_span(op="image.upload") as span:
+            span.set_data("bytes", len(result.body))
+            self._upload(result, metadata)
+        return result
+
+    def convert_thumbnail(
+        self,
+        bucket_name: str,
+        object_key: str,
+        metadata: typing.Dict[str, str],
+        etag: typing.Optional[str] = None,
+    ) -> typing.Optional[ConvertResult]:
+        """Convert the EXIF thumbnail of a JPEG if it covers the variant.
+
+        Only the start of the original is fetched. None if there is no
+        thumbnail, or it is smaller than the variant or cropped to another
+        aspect ratio, and the original has to be converted instead.
+        """
+        resize = typing.cast(int, self.config.resize)
+        with sentry_sdk.start_span(op="image.download_header") as span:
+            response = self.s3.get_object(
                 Bucket=bucket_name,
                 Key=object_key,
-                Fileobj=rbuf,
-            )
-            with Image.open(rbuf) as image, BytesIO() as wbuf:
-                if self.config.resize:
-                    image.thumbnail((self.config.resize, self.config.resize))
-                format = image.format
-                if self.config.format:
-                    format = self.config.format.value
-                if self.config.format == Format.JPEG:
-                    image = image.convert("RGB")
-                image.save(wbuf, format)
-                wbuf.seek(SEEK_SET)
-                s3.upload_fileobj(
-                    Bucket=self.config.bucket_name,
-                    Key="/".join(
-                        [
-                            (
-                                self.config.format.value
-                                if self.config.format
-                                else "original"
-                            ),
-                            (
-                                str(self.config.resize)
-                                if self.config.resize
-                                else "original"
-                            ),
-                            metadata.get("userid", "anonymous"),
-                            metadata.get("imageid", str(uuid4())),
-                        ]
-                    ),
-                    Fileobj=wbuf,
-                    ExtraArgs={
-                        "ContentType": f"image/{format.lower()}",
-                        "Metadata": metadata,
-                    },
+                Range=f"bytes=0-{JPEG_HEADER_BYTES - 1}",
+                **({"IfMatch": etag} if etag else {}),
+            )
+            data = response["Body"].read()
+            span.set_data("bytes", len(data))
+        header = parse_jpeg_header(data)
+        if header is None or header.thumbnail is None:
+            return None
+        try:
+            with Image.open(BytesIO(header.thumbnail)) as thumbnail:
+                width, height = thumbnail.size
+        except OSError:
+            return None
+        if max(width, height) < resize:
+            return None
+        # within a pixel of the thumbnail
+        if abs(width * header.height - height * header.width) > max(
+            header.width, header.height
+        ):
+            return None
+
+        result = self.convert_image(
+            BytesIO(header.thumbnail), metadata, header.orientation
+        )
+        result.source_width, result.source_height = (
+            _oriented((header.width, header.height), header.orientation)
+            if self.config.auto_orient
+            else (header.width, header.height)
+        )
+        metrics.add_metric(
+            name="ExifThumbnailConversions", unit=MetricUnit.Count, value=1
+        )
+        return result
+
+    def _convert_original(
+        self,
+        bucket_name: str,
+        object_key: str,
+        metadata: typing.Dict[str, str],
+        etag: typing.Optional[str] = None,
+    ) -> ConvertResult:
+        with BytesIO() as rbuf:
+            with sentry_sdk.start_span(op="image.download") as span:
+                if etag:
+                    # IfMatch is not among the extra args of download_fileobj
+                    response = self.s3.get_object(
+                        Bucket=bucket_name,
+                        Key=object_key,
+                        IfMatch=etag,
+                    )
+                    for chunk in response["Body"].iter_chunks():
+                        rbuf.write(chunk)
+                else:
+                    self.s3.download_fileobj(
+                        Bucket=bucket_name,
+                        Key=object_key,
+                        Fileobj=rbuf,
+                    )
+                span.set_data("bytes", rbuf.tell())
+            rbuf.seek(SEEK_SET)
+            return self.convert_image(rbuf, metadata)
+
+    def convert_image(
+        self,
+        fileobj: typing.BinaryIO,
+        metadata: typing.Dict[str, str],
+        orientation: typing.Optional[int] = None,
+    ) -> ConvertResult:
+        with sentry_sdk.start_span(op="image.resize") as span:
+            span.set_data("engine", self.config.engine.value)
+            image = self.engine.load(
+                fileobj,
+                self.config.resize,
+                self._animation_budget(),
+                MetadataPolicy(
+                    auto_orient=self.config.auto_orient,
+                    icc=self.config.icc_policy,
+                    exif=self.config.exif_policy,
+                ),
+                orientation,
+            )
+            span.set_data(
+                "source_size", (image.source_width, image.source_height)
+            )
+        if isinstance(image, AnimatedImage):
+            metrics.add_metric(
+                name="AnimatedFrames",
+                unit=MetricUnit.Count,
+                value=len(image.frames),
+            )
+        with sentry_sdk.start_span(op="image.features"):
+            features = self._image_features(image)
+        with sentry_sdk.start_span(op="image.encode") as span:
+            format, body, quality = self._encode(image)
+            span.set_data("format", format)
+            span.set_data("bytes", len(body))
+        if image.source_metadata_bytes:
+            # against carrying all of it over, as libvips does by default
+            kept = sum(len(blob) for blob in image.kept_metadata().values())
+            metrics.add_metric(
+                name="MetadataBytesSaved",
+                unit=MetricUnit.Bytes,
+                value=max(0, image.source_metadata_bytes - kept),
+            )
+        return ConvertResult(
+            key=self.output_key(metadata),
+            body=body,
+            content_type=f"image/{format}",
+            width=image.width,
+            height=image.height,
+            source_width=image.source_width,
+            source_height=image.source_height,
+            features=features,
+            quality=quality,
+        )
+
+    def _encode(
+        self, image: DecodedImage
+    ) -> typing.Tuple[str, bytes, typing.Optional[int]]:
+        if self._is_adaptive():
+            # the trial encodes and SSIM scoring work on a Pillow bitmap of
+            # the already shrunk image
+            result = encode_adaptive(
+                image.to_pillow(),
+                typing.cast(Format, self.config.format),
+                target_bytes=self.config.target_bytes,
+                min_ssim=self.config.min_ssim,
+                max_trials=self.config.max_trials,
+                metadata=image.kept_metadata(),
+            )
+            return result.format.value, result.body, result.quality
+
+        if self.config.format is None:
+            return image.format, image.save(), None
+        format = self.config.format.value
+        return format, image.save(format), None
+
+    def _animation_budget(self) -> typing.Optional[AnimationBudget]:
+        if self.config.format not in (None, Format.WEBP) or self._is_adaptive():
+            # JPEG, and the trial encodes of adaptive encoding, take a still
+            return None
+        return AnimationBudget(
+            max_frames=self.config.max_frames,
+            max_pixels=self.config.max_animation_pixels,
+            fallback=self.config.animation_fallback,
+            max_source_frames=self.config.max_source_frames,
+        )
+
+    def _is_adaptive(self) -> bool:
+        if self.config.format is None:
+            # the original format is kept as is
+            return False
+        return (
+            self.config.format == Format.AUTO
+            or self.config.target_bytes is not None
+            or self.config.min_ssim is not None
+        )
+
+    def _image_features(self, image: DecodedImage) -> typing.Dict[str, str]:
+        if not self.config.image_features:
+            return {}
+        pillow_image = image.to_pillow()
+        return {
+            "phash": dhash(pillow_image),
+            "blurhash": blurhash(pillow_image),
+            "dominantcolor": dominant_color(pillow_image),
+        }
+
+    def _upload(
+        self, result: ConvertResult, metadata: typing.Dict[str, str]
+    ) -> None:
+        if self.packer and "imageid" in metadata:
+            self.packer.add(
+                metadata.get("userid", "anonymous"),
+                metadata["imageid"],
+                result.body,
+                (result, metadata),
+            )
+            return
+        self.s3.upload_fileobj(
+            Bucket=self.config.bucket_name,
+            Key=result.key,
+            Fileobj=BytesIO(result.body),
+            ExtraArgs=self._extra_args(
+                result.content_type, {**metadata, **result.features}
+            ),
+        )
+        if self.index and "imageid" in metadata:
+            self._index_result(result, metadata, {"Key": result.key})
+
+    def _index_packed(
+        self,
+        segment_key: str,
+        written: typing.List[typing.Tuple[PackEntry, typing.Any]],
+    ) -> None:
+        for entry, (result, metadata) in written:
+            self._index_result(
+                result, metadata, {"Key": segment_key, "Offset": entry.offset}
+            )
+
+    def _index_result(
+        self,
+        result: ConvertResult,
+        metadata: typing.Dict[str, str],
+        location: typing.Dict[str, typing.Any],
+    ) -> None:
+        source: typing.Dict[str, typing.Any] = {
+            "Width": result.source_width,
+            "Height": result.source_height,
+        }
+        if "blurhash" in result.features:
+            source["BlurHash"] = result.features["blurhash"]
+            source["DominantColor"] = result.features["dominantcolor"]
+        if "phash" in result.features:
+            source["PHash"] = result.features["phash"]
+            source.update(
+                phash_bands(
+                    metadata.get("userid", "anonymous"),
+                    result.features["phash"],
                 )
+            )
+        self._index_variant(
+            metadata,
+            {
+                **location,
+                "ContentType": result.content_type,
+                "Bytes": len(result.body),
+                "Width": result.width,
+                "Height": result.height,
+                "UpdatedAt": _now_ms(),
+                **(
+                    {"Quality": result.quality}
+                    if result.quality is not None
+                    else {}
+                ),
+            },
+            source,
+        )
+
+    def _extra_args(
+        self, content_type: str, metadata: typing.Dict[str, str]
+    ) -> typing.Dict[str, typing.Any]:
+        extra_args: typing.Dict[str, typing.Any] = {
+            "ContentType": content_type,
+            "Metadata": metadata,
+        }
+        if self.config.cache_control:
+            extra_args["CacheControl"] = self.config.cache_control
+        return extra_args
+
+    def _index_variant(
+        self,
+        metadata: typing.Dict[str, str],
+        attributes: typing.Dict[str, typing.Any],
+        source: typing.Dict[str, typing.Any],
+    ) -> None:
+        assert self.index is not None
+        if "created" in metadata:
+            source["Created"] = int(float(metadata["created"]) * 1000)
+        self.index.add_variant(
+            user_id=metadata.get("userid", "anonymous"),
+            image_id=metadata["imageid"],
+            variant=self.variant_name(),
+            attributes=attributes,
+            source=source,
+        )
+
+
+def s3_records_of(
+    message: typing.Dict[str, typing.Any]
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """The S3 records of a message redriven into a variant's queue.
+
+    Besides S3 events, the invocation failure queue holds the records of
+    Lambda invocations failed as a whole, with the SNS event of the
+    invocation in `requestPayload`.
+    """
+    message = message.get("requestPayload", message)
+    records = []
+    for record in message.get("Records", []):
+        if "Sns" in record:
+            s3_event = json.loads(record["Sns"]["Message"])
+            records += s3_event.get("Records", [])
+        else:
+            records.append(record)
+    return records
 
 
 class SnsImageConvertProcessor(ImageConvertProcessor):
+    def __init__(
+        self,
+        config: ConvertConfig,
+        s3_client: typing.Optional[typing.Any] = None,
+        sqs_client: typing.Optional[typing.Any] = None,
+    ) -> None:
+        super().__init__(config, s3_client=s3_client)
+        self._sqs = sqs_client
+
+    @property
+    def sqs(self) -> typing.Any:
+        if self._sqs is None:
+            self._sqs = boto3.client("sqs")
+        return self._sqs
+
     @tracer.capture_method
     def process_records(
         self,
         records: typing.List[typing.Dict[str, typing.Any]],
     ) -> None:
+        failures = []
+        converted = []
         for record in records:
             s3_event = json.loads(record["Sns"]["Message"])
-            self._process_s3_records(s3_event["Records"])
+            s3_records = s3_event.get("Records", [])
+            record_failures = self._process_s3_records(s3_records)
+            failed = {id(s3_record) for s3_record, _ in record_failures}
+            converted += [r for r in s3_records if id(r) not in failed]
+            failures += record_failures
+        failures += self._flush_records(converted)
+        if not failures:
+            return
+        if not self.config.failure_queue_url:
+            # fail the invocation, leaving it to the retries of Lambda
+            raise failures[0][1]
+        for s3_record, e in failures:
+            if SENTRY_DSN:
+                capture_exception(e)
+            self._send_failure(s3_record, e)
+
+    def _send_failure(
+        self, s3_record: typing.Dict[str, typing.Any], error: Exception
+    ) -> None:
+        # the body is an S3 event like the ones the SQS path consumes, so
+        # the queue can be redriven into the queue of the Variant attribute
+        self.sqs.send_message(
+            QueueUrl=self.config.failure_queue_url,
+            MessageBody=json.dumps({"Records": [s3_record]}),
+            MessageAttributes={
+                "Variant": {
+                    "DataType": "String",
+                    "StringValue": self.variant_name(),
+                },
+                "ErrorType": {
+                    "DataType": "String",
+                    "StringValue": type(error).__name__,
+                },
+                "ErrorMessage": {
+                    "DataType": "String",
+                    "StringValue": str(error)[:1024] or "-",
+                },
+            },
+        )
 
 
 class SqsImageConvertProcessor(ImageConvertProcessor):
-    @tracer.capture_method
+    def __init__(
+        self,
+        config: ConvertConfig,
+        s3_client: typing.Optional[typing.Any] = None,
+    ) -> None:
+        super().__init__(config, s3_client=s3_client)
+        # batch state is per processor, so that several can run side by side
+        self.batch_processor = SentryBatchProcessor(event_type=EventType.SQS)
+
     def _record_handler(self, record: SQSRecord):
         logger.debug(record.body)
-        s3_event = json.loads(record.body)
-        self._process_s3_records(s3_event["Records"])
+        sent_timestamp = record.attributes.sent_timestamp
+        if sent_timestamp:
+            _add_latency("QueueAge", time.time() - int(sent_timestamp) / 1000)
+        failures = self._process_s3_records(
+            s3_records_of(json.loads(record.body))
+        )
+        if failures:
+            # the whole message is received again
+            raise failures[0][1]
 
     @tracer.capture_method
     def process_records(
         self,
         records: typing.List[typing.Dict[str, typing.Any]],
-    ) -> None:
-        with processor(records=records, handler=self._record_handler):
-            processed_messages = processor.process()
+    ) -> typing.Dict[str, typing.Any]:
+        """Process a batch, returning the partial batch response.
+
+        Only the failed messages are reported, for the event source to
+        receive them again (ReportBatchItemFailures).
+        """
+        with self.batch_processor(
+            records=records, handler=self._record_handler
+        ):
+            processed_messages = self.batch_processor.process()
             logger.debug(processed_messages)
+            converted = list(self.batch_processor.success_messages)
+            flush_failures = self._flush_records(converted)
+            if flush_failures:
+                # the messages are reported as failed on leaving the block
+                self.batch_processor.success_messages.clear()
+                for record, e in flush_failures:
+                    self.batch_processor.failure_handler(
+                        SQSRecord(record), (type(e), e, e.__traceback__)
+                    )
+        return self.batch_processor.response()
+
+
+class ImageNotFoundError(Exception):
+    pass
+
+
+class RenderTimeoutError(Exception):
+    pass
+
+
+class RenderLock:
+    """Short lease in DynamoDB so that concurrent misses render only once.
+
+    A crashed holder never blocks a key for longer than `lease_seconds`,
+    expired leases are simply taken over.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        lease_seconds: int = 30,
+        dynamodb: typing.Optional[typing.Any] = None,
+    ) -> None:
+        self.table = (dynamodb or boto3.resource("dynamodb")).Table(table_name)
+        self.lease_seconds = lease_seconds
+
+    def acquire(self, key: str, owner: str) -> bool:
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    "Key": key,
+                    "Owner": owner,
+                    "ExpiresAt": now + self.lease_seconds,
+                },
+                ConditionExpression=(
+                    "attribute_not_exists(#key) OR #expires < :now"
+                ),
+                ExpressionAttributeNames={
+                    "#key": "Key",
+                    "#expires": "ExpiresAt",
+                },
+                ExpressionAttributeValues={":now": now},
+            )
+        except ClientError as e:
+            if _is_conditional_check_failed(e):
+                return False
+            raise
+        return True
+
+    def release(self, key: str, owner: str) -> None:
+        try:
+            self.table.delete_item(
+                Key={"Key": key},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "Owner"},
+                ExpressionAttributeValues={":owner": owner},
+            )
+        except ClientError as e:
+            if not _is_conditional_check_failed(e):
+                raise
+
+
+class ImageRenderer:
+    """Renders a variant on its first request and writes it back to S3.
+
+    `variants` maps each variant rendered on demand to the variables of its
+    `ConvertProps`, parsed with `config_from_environ` like a converter's.
+    """
+
+    poll_interval = 0.2
+
+    def __init__(
+        self,
+        bucket_name: str,
+        input_bucket_name: str,
+        variants: typing.Mapping[str, typing.Mapping[str, str]],
+        index_table_name: typing.Optional[str] = None,
+        lock_table_name: typing.Optional[str] = None,
+        cache_control: typing.Optional[str] = None,
+        wait_timeout: float = 10.0,
+        s3_client: typing.Optional[typing.Any] = None,
+        dynamodb: typing.Optional[typing.Any] = None,
+    ) -> None:
+        self.bucket_name = bucket_name
+        self.input_bucket_name = input_bucket_name
+        self.variants = variants
+        self.index_table_name = index_table_name
+        self.cache_control = cache_control
+        self.wait_timeout = wait_timeout
+        self.s3 = s3_client or create_s3_client()
+        self.dynamodb = dynamodb or boto3.resource("dynamodb")
+        self.lock = (
+            RenderLock(lock_table_name, dynamodb=self.dynamodb)
+            if lock_table_name
+            else None
+        )
+        self._processors: typing.Dict[str, ImageConvertProcessor] = {}
+
+    @tracer.capture_method
+    def render(
+        self,
+        format: str,
+        resize: str,
+        user_id: str,
+        image_id: str,
+        owner: typing.Optional[str] = None,
+    ) -> typing.Tuple[bytes, str]:
+        processor = self._processor(format, resize)
+        metadata = {"userid": user_id, "imageid": image_id}
+        key = processor.output_key(metadata)
+
+        cached = self._get(key)
+        if cached:
+            return cached
+
+        owner = owner or str(uuid4())
+        if self.lock:
+            if not self.lock.acquire(key, owner):
+                return self._wait(key)
+            # rendered by the holder the lock was just taken over from
+            cached = self._get(key)
+            if cached:
+                self.lock.release(key, owner)
+                return cached
+        try:
+            result = self._convert(processor, metadata)
+        finally:
+            if self.lock:
+                self.lock.release(key, owner)
+        return result.body, result.content_type
+
+    def presigned_url(
+        self,
+        format: str,
+        resize: str,
+        user_id: str,
+        image_id: str,
+        expires_in: int = 300,
+    ) -> str:
+        """A presigned GET of the rendered variant in the output bucket."""
+        key = self._processor(format, resize).output_key(
+            {"userid": user_id, "imageid": image_id}
+        )
+        return self.s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket_name, "Key": key},
+            ExpiresIn=expires_in,
+        )
+
+    def _processor(self, format: str, resize: str) -> ImageConvertProcessor:
+        variant = f"{format}/{resize}"
+        if variant not in self.variants:
+            raise ImageNotFoundError(f"{variant} is not rendered")
+        if variant not in self._processors:
+            self._processors[variant] = ImageConvertProcessor(
+                config_from_environ(
+                    {
+                        **self.variants[variant],
+                        "BUCKET_NAME": self.bucket_name,
+                        "INDEX_TABLE_NAME": self.index_table_name or "",
+                        "APP_CACHE_CONTROL": self.cache_control or "",
+                    }
+                ),
+                s3_client=self.s3,
+                dynamodb=self.dynamodb,
+            )
+        return self._processors[variant]
+
+    def _convert(
+        self,
+        processor: ImageConvertProcessor,
+        metadata: typing.Dict[str, str],
+    ) -> ConvertResult:
+        source_key = self._source_key(metadata["userid"], metadata["imageid"])
+        try:
+            head_response = self.s3.head_object(
+                Bucket=self.input_bucket_name,
+                Key=source_key,
+            )
+        except ClientError as e:
+            if _is_not_found(e):
+                raise ImageNotFoundError(source_key)
+            raise
+        result = processor.convert_object(
+            self.input_bucket_name,
+            source_key,
+            {**head_response["Metadata"], **metadata},
+        )
+        processor.flush()
+        return result
+
+    def _source_key(self, user_id: str, image_id: str) -> str:
+        if self.index_table_name:
+            table = self.dynamodb.Table(self.index_table_name)
+            item = table.get_item(
+                Key={"UserId": user_id, "ImageId": image_id},
+                ProjectionExpression="OriginalKey",
+            ).get("Item")
+            if item and "OriginalKey" in item:
+                return item["OriginalKey"]
+        return f"original/{user_id}/{image_id}"
+
+    def _get(self, key: str) -> typing.Optional[typing.Tuple[bytes, str]]:
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+        return response["Body"].read(), response["ContentType"]
+
+    def _wait(self, key: str) -> typing.Tuple[bytes, str]:
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            cached = self._get(key)
+            if cached:
+                return cached
+        raise RenderTimeoutError(key)
+
+
+def _is_not_found(e: ClientError) -> bool:
+    return e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+
+# larger bodies do not fit in a Lambda proxy response once base64 encoded
+MAX_INLINE_BYTES = 4 * 1024 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def get_renderer() -> ImageRenderer:
+    """The renderer of the container, with its clients and processors."""
+    return ImageRenderer(
+        bucket_name=os.environ["BUCKET_NAME"],
+        input_bucket_name=os.environ["INPUT_BUCKET_NAME"],
+        # variant -> variables of its ConvertProps
+        variants=json.loads(os.getenv("APP_RENDER_VARIANTS") or "{}"),
+        index_table_name=os.getenv("INDEX_TABLE_NAME") or None,
+        lock_table_name=os.getenv("LOCK_TABLE_NAME") or None,
+        cache_control=os.getenv("APP_CACHE_CONTROL") or None,
+    )
+
+
+@app.get("/<format>/<resize>/<user_id>/<image_id>")
+@tracer.capture_method
+def render_route(format: str, resize: str, user_id: str, image_id: str):
+    cache_control = os.getenv("APP_CACHE_CONTROL") or None
+    renderer = get_renderer()
+    try:
+        body, content_type = renderer.render(
+            format=format,
+            resize=resize,
+            user_id=user_id,
+            image_id=image_id,
+            owner=app.lambda_context.aws_request_id,
+        )
+    except ImageNotFoundError:
+        return Response(
+            status_code=404,
+            content_type="application/json",
+            body=json.dumps({"message": "Not found"}),
+            headers={"Cache-Control": "no-store"},
+        )
+    except RenderTimeoutError:
+        return Response(
+            status_code=503,
+            content_type="application/json",
+            body=json.dumps({"message": "Rendering in progress"}),
+            headers={"Cache-Control": "no-store", "Retry-After": "1"},
+        )
+
+    if len(body) > MAX_INLINE_BYTES:
+        # too large for a Lambda response; the object is in the bucket now,
+        # send the client straight to it
+        return Response(
+            status_code=307,
+            content_type="text/plain",
+            body="",
+            headers={
+                "Cache-Control": "no-store",
+                "Location": renderer.presigned_url(
+                    format, resize, user_id, image_id
+                ),
+            },
+        )
+    return Response(
+        status_code=200,
+        content_type=content_type,
+        body=body,
+        headers={"Cache-Control": cache_control or "no-cache"},
+    )
+
+
+def config_from_environ(environ: typing.Mapping[str, str]) -> ConvertConfig:
+    """The config of a variant from the variables of `ConvertProps`.
+
+    The converters read their own environment, the LINE callback the
+    variables of each of its previews.
+    """
+    return ConvertConfig(
+        bucket_name=environ["BUCKET_NAME"],
+        format=parse_format(environ.get("APP_FORMAT")),
+        resize=parse_resize(environ.get("APP_RESIZE")),
+        index_table_name=environ.get("INDEX_TABLE_NAME") or None,
+        cache_control=environ.get("APP_CACHE_CONTROL") or None,
+        image_features=bool(
+            strtobool(environ.get("APP_IMAGE_FEATURES", "False"))
+        ),
+        target_bytes=parse_target_bytes(environ.get("APP_TARGET_BYTES")),
+        min_ssim=parse_ssim(environ.get("APP_MIN_SSIM")),
+        engine=parse_engine(environ.get("APP_ENGINE")),
+        exif_thumbnail=bool(
+            strtobool(environ.get("APP_EXIF_THUMBNAIL", "False"))
+        ),
+        failure_queue_url=environ.get("APP_FAILURE_QUEUE_URL") or None,
+        sequence_table_name=environ.get("SEQUENCE_TABLE_NAME") or None,
+        pack=bool(strtobool(environ.get("APP_PACK", "False"))),
+        key_layout=parse_key_layout(environ.get("APP_KEY_LAYOUT")),
+        max_frames=int(environ.get("APP_MAX_FRAMES") or DEFAULT_MAX_FRAMES),
+        max_animation_pixels=int(
+            environ.get("APP_MAX_ANIMATION_PIXELS")
+            or DEFAULT_MAX_ANIMATION_PIXELS
+        ),
+        max_source_frames=int(
+            environ.get("APP_MAX_SOURCE_FRAMES") or DEFAULT_MAX_SOURCE_FRAMES
+        ),
+        animation_fallback=parse_animation_fallback(
+            environ.get("APP_ANIMATION_FALLBACK")
+        ),
+        auto_orient=bool(strtobool(environ.get("APP_AUTO_ORIENT", "True"))),
+        icc_policy=parse_icc_policy(environ.get("APP_ICC_POLICY")),
+        exif_policy=parse_exif_policy(environ.get("APP_EXIF_POLICY")),
+    )
 
 
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
-def lambda_handler(event, context: LambdaContext) -> None:
+@metrics.log_metrics
+@telemetry.report_slow(TRACES_SLOW_MS)
+@telemetry.sampled_debug_logging
+@telemetry.sampled_profiling
+def lambda_handler(
+    event, context: LambdaContext
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
     logger.debug(event)
 
-    try:
-        format = Format(os.getenv("APP_FORMAT"))
-    except ValueError:
-        format = None
-    try:
-        resize = int(os.getenv("APP_RESIZE", 0))
-    except (ValueError, TypeError):
-        resize = None
-    else:
-        if resize is not None and resize <= 0:
-            resize = None
-    config = ConvertConfig(
-        bucket_name=os.environ["BUCKET_NAME"],
-        format=format,
-        resize=resize,
-    )
+    config = config_from_environ(os.environ)
 
     use_sqs = strtobool(os.getenv("APP_USE_SQS", "False"))
     processor = (
         SqsImageConvertProcessor if use_sqs else SnsImageConvertProcessor
     )(config)
-    processor.process_records(event["Records"])
+    metrics.add_dimension(name="Variant", value=processor.variant_name())
+    return processor.process_records(event["Records"])
+
+
+@logger.inject_lambda_context(
+    correlation_id_path=correlation_paths.API_GATEWAY_REST,
+)
+@tracer.capture_lambda_handler
+@metrics.log_metrics
+@telemetry.report_slow(TRACES_SLOW_MS)
+@telemetry.sampled_debug_logging
+@telemetry.sampled_profiling
+def render_handler(
+    event,
+    context: LambdaContext,
+) -> typing.Dict[str, typing.Any]:
+    logger.debug(event)
+    return app.resolve(event, context)
@@ -0,0 +1,59 @@
+import aws_cdk as cdk
+from aws_cdk import aws_dynamodb as dynamodb
+from constructs import Construct
+
+# must match PHASH_BANDS in the image convert function
+PHASH_BANDS = 4
+
+
+class ImageIndex(Construct):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        removal_policy: cdk.RemovalPolicy = cdk.RemovalPolicy.RETAIN,
+    ) -> None:
+        super().__init__(scope, id)
+
+        # one item per image, so a user's images are a single Query and an
+        # image is a single GetItem
+        self.table = dynamodb.Table(
+            self,
+            "Table",
+            partition_key=dynamodb.Attribute(
+                name="UserId",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            sort_key=dynamodb.Attribute(
+                name="ImageId",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=removal_policy,
+        )
+        # a user's images newest first; `Created` is the LINE event time in
+        # milliseconds, unlike the message ids of `ImageId` it sorts as a
+        # number
+        self.table.add_global_secondary_index(
+            index_name="Created",
+            partition_key=dynamodb.Attribute(
+                name="UserId",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            sort_key=dynamodb.Attribute(
+                name="Created",
+                type=dynamodb.AttributeType.NUMBER,
+            ),
+        )
+        # near-duplicate lookup, each band is "{UserId}:{hex}" so a query
+        # only ever touches one user's images
+        for i in range(PHASH_BANDS):
+            self.table.add_global_secondary_index(
+                index_name=f"PHashBand{i}",
+                partition_key=dynamodb.Attribute(
+                    name=f"PHashBand{i}",
+                    type=dynamodb.AttributeType.STRING,
+                ),
+                projection_type=dynamodb.ProjectionType.INCLUDE,
+                non_key_attributes=["PHash"],
+            )
@@ -1,10 +1,15 @@
+import json
 import typing
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
 
 import aws_cdk as cdk
 from aws_cdk import (
     aws_apigateway as apigateway,
+    aws_apigatewayv2 as apigatewayv2,
+    aws_dynamodb as dynamodb,
+    aws_iam as iam,
     aws_lambda as lambda_,
     aws_lambda_python_alpha as lambda_python,
     aws_logs as logs,
@@ -12,6 +17,9 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from multilens.constructs.image_convert import ConvertProps
+from multilens.constructs.pipeline_dashboard import METRICS_NAMESPACE
+
 here = Path(__file__).absolute().parent
 
 
@@ -19,6 +27,16 @@ here = Path(__file__).absolute().parent
 class LineApiCredential:
     access_token: str
     secret: str
+    # LINE Login channel whose ID tokens sign users in to their images; the
+    # routes of a user are left out without it
+    login_channel_id: typing.Optional[str] = None
+
+
+class FrontDoor(Enum):
+    # value is the event format the handler is configured for
+    REST_API = "APIGatewayProxyEvent"
+    HTTP_API = "APIGatewayProxyEventV2"
+    FUNCTION_URL = "LambdaFunctionUrlEvent"
 
 
 class LineApi(Construct):
@@ -29,9 +47,21 @@ class LineApi(Construct):
         line_credential: LineApiCredential,
         bucket: typing.Optional[s3.Bucket] = None,
         bucket_props: typing.Optional[s3.BucketProps] = None,
+        index_table: typing.Optional[dynamodb.ITable] = None,
+        image_bucket: typing.Optional[s3.IBucket] = None,
+        image_base_url: typing.Optional[str] = None,
+        deduplicate: bool = False,
+        front_door: FrontDoor = FrontDoor.REST_API,
+        preview_props: typing.Sequence[ConvertProps] = (),
+        preview_cache_control: typing.Optional[str] = None,
         lambda_tracing: bool = False,
         lambda_log_level: typing.Optional[str] = None,
+        lambda_log_sample_rate: typing.Optional[float] = None,
         lambda_sentry_dsn: typing.Optional[str] = None,
+        lambda_traces_sample_rate: typing.Optional[float] = None,
+        lambda_traces_slow_ms: typing.Optional[int] = None,
+        lambda_profile_sample_rate: typing.Optional[float] = None,
+        profile_bucket: typing.Optional[s3.IBucket] = None,
     ) -> None:
         super().__init__(scope, id)
         lambda_log_level = lambda_log_level or "INFO"
@@ -39,12 +69,55 @@ class LineApi(Construct):
 
         if bucket is None and bucket_props is None:
             raise ValueError("requires `bucket` or `bucket_props`")
+        if deduplicate and index_table is None:
+            raise ValueError("requires `index_table` to deduplicate")
+        if preview_props and image_bucket is None:
+            raise ValueError("requires `image_bucket` to render previews")
+        if lambda_profile_sample_rate and profile_bucket is None:
+            raise ValueError("requires `profile_bucket` to write profiles")
 
         self.bucket = bucket or s3.Bucket(
             self,
             "Bucket",
             **bucket_props._values,  # type: ignore
         )
+        self.index_table = index_table
+        self.image_bucket = image_bucket
+
+        self.content_hash_table: typing.Optional[dynamodb.Table] = None
+        if deduplicate:
+            self.content_hash_table = dynamodb.Table(
+                self,
+                "ContentHashTable",
+                partition_key=dynamodb.Attribute(
+                    name="ContentHash",
+                    type=dynamodb.AttributeType.STRING,
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                removal_policy=cdk.RemovalPolicy.RETAIN,
+            )
+
+        # previews are rendered with the image convert function's code,
+        # shipped to the callback as a layer
+        self.preview_layer: typing.Optional[
+            lambda_python.PythonLayerVersion
+        ] = None
+        if preview_props:
+            self.preview_layer = lambda_python.PythonLayerVersion(
+                self,
+                "PreviewLayer",
+                entry=str(here / "image_convert_function"),
+                compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+            )
+
+        # Sentry sampling and the like, shared with the image convert
+        # function the previews are rendered with
+        self.telemetry_layer = lambda_python.PythonLayerVersion(
+            self,
+            "TelemetryLayer",
+            entry=str(here / "telemetry_layer"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+        )
 
         self.callback_function = lambda_python.PythonFunction(
             self,
@@ -56,11 +129,48 @@ class LineApi(Construct):
             environment={
                 "CHANNEL_ACCESS_TOKEN": line_credential.access_token,
                 "CHANNEL_SECRET": line_credential.secret,
+                "APP_LOGIN_CHANNEL_ID": line_credential.login_channel_id or "",
                 "LOG_LEVEL": lambda_log_level,
+                "APP_PROXY_TYPE": front_door.value,
+                "APP_DEBUG_SAMPLE_RATE": str(lambda_log_sample_rate or ""),
                 "POWERTOOLS_SERVICE_NAME": "LineApi",
+                "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
                 "BUCKET_NAME": self.bucket.bucket_name,
                 "SENTRY_DSN": lambda_sentry_dsn,
+                "APP_TRACES_SAMPLE_RATE": (
+                    ""
+                    if lambda_traces_sample_rate is None
+                    else str(lambda_traces_sample_rate)
+                ),
+                "APP_TRACES_SLOW_MS": (
+                    ""
+                    if lambda_traces_slow_ms is None
+                    else str(lambda_traces_slow_ms)
+                ),
+                # listings and webhook results are no use as trace metadata
+                "POWERTOOLS_TRACER_CAPTURE_RESPONSE": "false",
+                "INDEX_TABLE_NAME": (
+                    self.index_table.table_name if self.index_table else ""
+                ),
+                "IMAGE_BUCKET_NAME": (
+                    self.image_bucket.bucket_name if self.image_bucket else ""
+                ),
+                "IMAGE_BASE_URL": image_base_url or "",
+                "CONTENT_HASH_TABLE_NAME": (
+                    self.content_hash_table.table_name
+                    if self.content_hash_table
+                    else ""
+                ),
+                "APP_PREVIEWS": json.dumps(
+                    [props.environment() for props in preview_props]
+                ),
+                "APP_PREVIEW_CACHE_CONTROL": preview_cache_control or "",
             },
+            layers=(
+                [self.telemetry_layer, self.preview_layer]
+                if self.preview_layer
+                else [self.telemetry_layer]
+            ),
             memory_size=512,
             timeout=cdk.Duration.seconds(15),
             log_retention=logs.RetentionDays.ONE_MONTH,
@@ -71,16 +181,67 @@ class LineApi(Construct):
             ),
         )
         self.bucket.grant_read_write(self.callback_function)
+        if self.index_table:
+            self.index_table.grant_read_write_data(self.callback_function)
+        if self.image_bucket and preview_props:
+            self.image_bucket.grant_read_write(self.callback_function)
+        elif self.image_bucket:
+            self.image_bucket.grant_read(self.callback_function)
+        if self.content_hash_table:
+            self.content_hash_table.grant_read_write_data(
+                self.callback_function
+            )
+        if lambda_profile_sample_rate and profile_bucket:
+            profile_prefix = "profiles/LineApi/"
+            self.callback_function.add_environment(
+                "APP_PROFILE_SAMPLE_RATE",
+                str(lambda_profile_sample_rate),
+            )
+            self.callback_function.add_environment(
+                "APP_PROFILE_BUCKET",
+                profile_bucket.bucket_name,
+            )
+            self.callback_function.add_environment(
+                "APP_PROFILE_PREFIX",
+                profile_prefix,
+            )
+            profile_bucket.grant_put(
+                self.callback_function,
+                profile_prefix + "*",
+            )
 
         self.access_log = logs.LogGroup(
             self,
             "AccessLog",
             retention=logs.RetentionDays.ONE_MONTH,
         )
-        self.api = apigateway.RestApi(
+
+        routes = [("POST", "/callback")]
+        if self.index_table and line_credential.login_channel_id:
+            routes += [
+                ("GET", "/users/{user_id}/images"),
+                ("GET", "/users/{user_id}/images/{image_id}/similar"),
+            ]
+
+        self.api: typing.Optional[apigateway.RestApi] = None
+        self.url: str
+        if front_door == FrontDoor.REST_API:
+            self.api = self._add_rest_api(routes)
+            self.url = self.api.url
+        elif front_door == FrontDoor.HTTP_API:
+            self.url = self._add_http_api(routes)
+        else:
+            self.url = self._add_function_url()
+
+    def _add_rest_api(
+        self, routes: typing.Sequence[typing.Tuple[str, str]]
+    ) -> apigateway.RestApi:
+        api = apigateway.RestApi(
             self,
             "Api",
             rest_api_name="LineApi",
+            # lets the handler return gzip compressed bodies
+            binary_media_types=["*/*"],
             deploy_options=apigateway.StageOptions(
                 access_log_destination=apigateway.LogGroupLogDestination(
                     self.access_log
@@ -98,9 +259,99 @@ class LineApi(Construct):
                 ),
             ),
         )
-        self.api.root.add_resource("callback").add_method(
-            http_method="POST",
-            integration=apigateway.LambdaIntegration(
-                handler=self.callback_function,
+        integration = apigateway.LambdaIntegration(
+            handler=self.callback_function,
+        )
+        for method, path in routes:
+            resource = api.root
+            for part in path.strip("/").split("/"):
+                resource = resource.get_resource(part) or resource.add_resource(
+                    part
+                )
+            resource.add_method(method, integration)
+        return api
+
+    def _add_http_api(
+        self, routes: typing.Sequence[typing.Tuple[str, str]]
+    ) -> str:
+        # only the L1 constructs of HTTP APIs are stable in this CDK version
+        api = apigatewayv2.CfnApi(
+            self,
+            "HttpApi",
+            name="LineApi",
+            protocol_type="HTTP",
+        )
+        integration = apigatewayv2.CfnIntegration(
+            self,
+            "HttpApiIntegration",
+            api_id=api.ref,
+            integration_type="AWS_PROXY",
+            integration_uri=self.callback_function.function_arn,
+            payload_format_version="2.0",
+        )
+        for method, path in routes:
+            apigatewayv2.CfnRoute(
+                self,
+                "HttpApiRoute"
+                + "".join(
+                    part.strip("{}").title().replace("_", "")
+                    for part in [method.lower(), *path.split("/")]
+                ),
+                api_id=api.ref,
+                route_key=f"{method} {path}",
+                target=f"integrations/{integration.ref}",
+            )
+        apigatewayv2.CfnStage(
+            self,
+            "HttpApiStage",
+            api_id=api.ref,
+            stage_name="$default",
+            auto_deploy=True,
+            access_log_settings=apigatewayv2.CfnStage.AccessLogSettingsProperty(
+                destination_arn=self.access_log.log_group_arn,
+                format=json.dumps(
+                    {
+                        "requestId": "$context.requestId",
+                        "ip": "$context.identity.sourceIp",
+                        "requestTime": "$context.requestTime",
+                        "httpMethod": "$context.httpMethod",
+                        "routeKey": "$context.routeKey",
+                        "status": "$context.status",
+                        "protocol": "$context.protocol",
+                        "responseLength": "$context.responseLength",
+                    }
+                ),
+            ),
+        )
+        self.callback_function.add_permission(
+            "HttpApiInvoke",
+            principal=iam.ServicePrincipal("apigateway.amazonaws.com"),
+            source_arn=cdk.Stack.of(self).format_arn(
+                service="execute-api",
+                resource=api.ref,
+                resource_name="*",
             ),
         )
+        return f"{api.attr_api_endpoint}/"
+
+    def _add_function_url(self) -> str:
+        # AWS::Lambda::Url is newer than this CDK version; the handler checks
+        # the LINE signature, so the URL itself is public
+        function_url = cdk.CfnResource(
+            self,
+            "FunctionUrl",
+            type="AWS::Lambda::Url",
+            properties={
+                "TargetFunctionArn": self.callback_function.function_arn,
+                "AuthType": "NONE",
+            },
+        )
+        permission = lambda_.CfnPermission(
+            self,
+            "FunctionUrlPermission",
+            action="lambda:InvokeFunctionUrl",
+            function_name=self.callback_function.function_name,
+            principal="*",
+        )
+        permission.add_property_override("FunctionUrlAuthType", "NONE")
+        return function_url.get_att("FunctionUrl").to_string()
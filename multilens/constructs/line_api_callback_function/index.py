@@ -1,17 +1,29 @@
+import base64
+import functools
+import hashlib
+import importlib.util
 import json
+import logging
 import os
+import time
 import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+from decimal import Decimal
 from io import BytesIO
 
 import boto3
-import sentry_sdk
-from aws_lambda_powertools import Logger, Tracer
+from aws_lambda_powertools import Logger, Metrics, Tracer
 from aws_lambda_powertools.event_handler.api_gateway import (
     ApiGatewayResolver,
+    ProxyEventType,
     Response,
 )
 from aws_lambda_powertools.logging import correlation_paths
+from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.exceptions import ClientError
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
@@ -20,28 +32,88 @@ from linebot.models import (
     TextMessage,
     TextSendMessage,
 )
-from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+try:
+    import telemetry  # the telemetry layer
+except ImportError:
+    from multilens.constructs.telemetry_layer import telemetry
 
 logger = Logger()
 tracer = Tracer()
-app = ApiGatewayResolver()
+metrics = Metrics(
+    namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "Multilens")
+)
+# the event format of the front door in use, see LineApi
+PROXY_TYPE = ProxyEventType(
+    os.getenv("APP_PROXY_TYPE") or ProxyEventType.APIGatewayProxyEvent.value
+)
+CORRELATION_PATHS = {
+    ProxyEventType.APIGatewayProxyEvent: correlation_paths.API_GATEWAY_REST,
+    ProxyEventType.APIGatewayProxyEventV2: correlation_paths.API_GATEWAY_HTTP,
+    ProxyEventType.LambdaFunctionUrlEvent: (
+        correlation_paths.LAMBDA_FUNCTION_URL
+    ),
+}
+app = ApiGatewayResolver(proxy_type=PROXY_TYPE)
 
 
 SENTRY_DSN = os.environ.get("SENTRY_DSN")
+# invocations slower than this are reported even when not sampled
+TRACES_SLOW_MS = float(os.getenv("APP_TRACES_SLOW_MS") or 1000)
+if SENTRY_DSN:
+    telemetry.init_sentry(SENTRY_DSN)
 
 
-if SENTRY_DSN:
-    sentry_sdk.init(
-        dsn=SENTRY_DSN,
-        integrations=[AwsLambdaIntegration()],
-        traces_sample_rate=1.0,
+# where the preview layer puts the image convert function
+IMAGE_CONVERT_MODULE = (
+    os.getenv("APP_IMAGE_CONVERT_MODULE") or "/opt/python/index.py"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_image_convert() -> typing.Any:
+    """The image convert function's module, to render previews with.
+
+    Loaded by path, as it is an `index` module like this one.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "image_convert", IMAGE_CONVERT_MODULE
     )
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 class LineApiHandler:
-    def __init__(self, access_token: str, secret: str) -> None:
+    def __init__(
+        self,
+        access_token: str,
+        secret: str,
+        index_table_name: typing.Optional[str] = None,
+        content_hash_table_name: typing.Optional[str] = None,
+        image_bucket_name: typing.Optional[str] = None,
+        previews: typing.Sequence[typing.Dict[str, str]] = (),
+        preview_cache_control: typing.Optional[str] = None,
+    ) -> None:
         self.line_bot_api = LineBotApi(access_token)
         self.handler = WebhookHandler(secret)
+        self.index_table = (
+            boto3.resource("dynamodb").Table(index_table_name)
+            if index_table_name
+            else None
+        )
+        # aliases are only visible through the index, so deduplication needs
+        # both tables
+        self.content_hash_table = (
+            boto3.resource("dynamodb").Table(content_hash_table_name)
+            if content_hash_table_name and index_table_name
+            else None
+        )
+        # variants rendered from the original in hand, see _render_previews
+        self.image_bucket_name = image_bucket_name
+        self.previews = previews if image_bucket_name else ()
+        self.preview_cache_control = preview_cache_control
 
         self._register_handlers()
 
@@ -77,7 +149,9 @@ class LineApiHandler:
         )
 
     def _handle_image_message(self, event: MessageEvent) -> None:
-        logger.debug(event.as_json_dict())
+        # as_json_dict() walks the whole event, skip it unless it is logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(event.as_json_dict())
         message_id = event.message.id
         image_id = f"L{message_id}"
         user_id = event.source.user_id
@@ -85,35 +159,474 @@ class LineApiHandler:
 
         object_key = f"original/{user_id}/{image_id}"
         message_content = self.line_bot_api.get_message_content(message_id)
+        content, content_hash = self._read_content(message_content)
+
+        if self.content_hash_table:
+            canonical = self._find_canonical(content_hash)
+            if canonical:
+                # already stored and converted for another message, point at
+                # it instead of fanning out another round of conversions
+                self._index_image(
+                    user_id=user_id,
+                    image_id=image_id,
+                    attributes={
+                        "OriginalKey": canonical["OriginalKey"],
+                        "ContentType": message_content.content_type,
+                        "Bytes": len(content),
+                        "Created": event.timestamp,
+                        "ContentHash": content_hash,
+                        "CanonicalUserId": canonical["UserId"],
+                        "CanonicalImageId": canonical["ImageId"],
+                    },
+                )
+                return
+
+        metadata = {
+            "UserId": user_id,
+            "ImageId": image_id,
+            "Created": str(unix_time),
+            "ContentHash": content_hash,
+        }
+        # before the original, whose notification the converters act on
+        previews = self._render_previews(content, metadata)
+        if previews:
+            metadata["Previews"] = ",".join(previews)
 
         s3 = boto3.client("s3")
+        # the object is not visible to the converters until the upload
+        # completes, so the start of the upload is a safe lower bound
+        metadata["Ingested"] = str(time.time())
         s3.upload_fileobj(
-            Fileobj=BytesIO(message_content.content),
+            Fileobj=BytesIO(content),
             Bucket=os.getenv("BUCKET_NAME"),
             Key=object_key,
             ExtraArgs={
                 "ContentType": message_content.content_type,
-                "Metadata": {
+                "Metadata": metadata,
+            },
+        )
+        metrics.add_metric(
+            name="IngestionLatency",
+            unit=MetricUnit.Milliseconds,
+            value=max(time.time() - unix_time, 0.0) * 1000,
+        )
+
+        if self.content_hash_table:
+            self._claim_content(content_hash, user_id, image_id, object_key)
+        if self.index_table:
+            self._index_image(
+                user_id=user_id,
+                image_id=image_id,
+                attributes={
+                    "OriginalKey": object_key,
+                    "ContentType": message_content.content_type,
+                    "Bytes": len(content),
+                    "Created": event.timestamp,
+                    "ContentHash": content_hash,
+                },
+            )
+
+    @tracer.capture_method
+    def _render_previews(
+        self, content: bytes, metadata: typing.Dict[str, str]
+    ) -> typing.List[str]:
+        """Render the preview variants, returning the ones written.
+
+        The converters skip the variants listed in the original's metadata;
+        a preview that fails is left to them.
+        """
+        if not self.previews:
+            return []
+        image_convert = load_image_convert()
+        # as S3 returns user metadata to the converters
+        convert_metadata = {k.lower(): v for k, v in metadata.items()}
+        rendered = []
+        for preview in self.previews:
+            # the variables of the variant's converter, parsed the same way
+            processor = image_convert.ImageConvertProcessor(
+                image_convert.config_from_environ(
+                    {
+                        **preview,
+                        "BUCKET_NAME": self.image_bucket_name,
+                        "INDEX_TABLE_NAME": (
+                            self.index_table.table_name
+                            if self.index_table
+                            else ""
+                        ),
+                        "APP_CACHE_CONTROL": self.preview_cache_control or "",
+                    }
+                )
+            )
+            variant = processor.variant_name()
+            try:
+                processor.convert_content(content, convert_metadata)
+                processor.flush()
+            except Exception:
+                logger.exception("failed to render preview %s", variant)
+                continue
+            rendered.append(variant)
+        metrics.add_metric(
+            name="PreviewsRendered", unit=MetricUnit.Count, value=len(rendered)
+        )
+        return rendered
+
+    def _read_content(self, message_content) -> typing.Tuple[bytes, str]:
+        digest = hashlib.sha256()
+        with BytesIO() as buf:
+            for chunk in message_content.iter_content(chunk_size=64 * 1024):
+                digest.update(chunk)
+                buf.write(chunk)
+            return buf.getvalue(), digest.hexdigest()
+
+    @tracer.capture_method
+    def _find_canonical(
+        self, content_hash: str
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        assert self.content_hash_table is not None
+        return self.content_hash_table.get_item(
+            Key={"ContentHash": content_hash},
+            ConsistentRead=True,
+        ).get("Item")
+
+    @tracer.capture_method
+    def _claim_content(
+        self,
+        content_hash: str,
+        user_id: str,
+        image_id: str,
+        object_key: str,
+    ) -> None:
+        assert self.content_hash_table is not None
+        # claimed only after the upload succeeded, so a canonical entry
+        # always points at an existing original; losing a race just means
+        # this copy is converted too
+        try:
+            self.content_hash_table.put_item(
+                Item={
+                    "ContentHash": content_hash,
                     "UserId": user_id,
                     "ImageId": image_id,
-                    "Created": str(unix_time),
+                    "OriginalKey": object_key,
                 },
-            },
+                ConditionExpression="attribute_not_exists(ContentHash)",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    @tracer.capture_method
+    def _index_image(
+        self,
+        user_id: str,
+        image_id: str,
+        attributes: typing.Dict[str, typing.Any],
+    ) -> None:
+        assert self.index_table is not None
+        names = {"#variants": "Variants", "#updated": "UpdatedAt"}
+        values: typing.Dict[str, typing.Any] = {
+            ":empty": {},
+            ":updated": int(time.time() * 1000),
+        }
+        expressions = [
+            "#variants = if_not_exists(#variants, :empty)",
+            "#updated = :updated",
+        ]
+        for i, (name, value) in enumerate(attributes.items()):
+            names[f"#a{i}"] = name
+            values[f":a{i}"] = value
+            expressions.append(f"#a{i} = :a{i}")
+        # converters add to `Variants` concurrently, so never overwrite it
+        self.index_table.update_item(
+            Key={"UserId": user_id, "ImageId": image_id},
+            UpdateExpression="SET " + ", ".join(expressions),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
         )
 
     def _handle_default(self, event) -> None:
-        logger.debug(event.as_json_dict())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(event.as_json_dict())
+
+
+# must match PHASH_BANDS in the image convert function
+PHASH_BANDS = 4
+
+
+class ImageCatalog:
+    default_variant = "jpeg/400"
+    default_limit = 30
+    max_limit = 100
+    url_expires_in = 3600
+    # with 4 bands, lookups are exact up to 3 bits and best effort above
+    max_similar_distance = 10
+
+    def __init__(
+        self,
+        index_table_name: str,
+        bucket_name: typing.Optional[str] = None,
+        base_url: typing.Optional[str] = None,
+    ) -> None:
+        self.table = boto3.resource("dynamodb").Table(index_table_name)
+        self.bucket_name = bucket_name
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.s3 = boto3.client("s3")
+
+    @tracer.capture_method
+    def list_images(
+        self,
+        user_id: str,
+        variant: typing.Optional[str] = None,
+        limit: typing.Optional[int] = None,
+        cursor: typing.Optional[str] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        variant = variant or self.default_variant
+        if limit is None:
+            limit = self.default_limit
+        limit = min(limit, self.max_limit)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+
+        params: typing.Dict[str, typing.Any] = {
+            "IndexName": "Created",
+            "KeyConditionExpression": "UserId = :user_id",
+            "ExpressionAttributeValues": {":user_id": user_id},
+            # newest first
+            "ScanIndexForward": False,
+            "Limit": limit,
+        }
+        if cursor:
+            params["ExclusiveStartKey"] = self._decode_cursor(cursor, user_id)
+        response = self.table.query(**params)
+        items = self._resolve_aliases(response["Items"], variant)
+
+        return {
+            "images": [self._to_image(item, variant) for item in items],
+            "next_cursor": (
+                self._encode_cursor(response["LastEvaluatedKey"])
+                if "LastEvaluatedKey" in response
+                else None
+            ),
+        }
+
+    @tracer.capture_method
+    def find_similar(
+        self,
+        user_id: str,
+        image_id: str,
+        max_distance: int = PHASH_BANDS - 1,
+        variant: typing.Optional[str] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        if not 0 <= max_distance <= self.max_similar_distance:
+            raise ValueError(
+                f"max_distance must be within 0-{self.max_similar_distance}"
+            )
+        variant = variant or self.default_variant
+
+        item = self.table.get_item(
+            Key={"UserId": user_id, "ImageId": image_id}
+        ).get("Item")
+        if not item or "PHash" not in item:
+            raise LookupError(f"{user_id}/{image_id} is not hashed")
+        phash = item["PHash"]
+
+        distances: typing.Dict[str, int] = {}
+        for i in range(PHASH_BANDS):
+            band = item.get(f"PHashBand{i}")
+            if not band:
+                continue
+            params: typing.Dict[str, typing.Any] = {
+                "IndexName": f"PHashBand{i}",
+                "KeyConditionExpression": "#band = :band",
+                "ExpressionAttributeNames": {"#band": f"PHashBand{i}"},
+                "ExpressionAttributeValues": {":band": band},
+            }
+            while True:
+                response = self.table.query(**params)
+                for candidate in response["Items"]:
+                    if candidate["ImageId"] == image_id:
+                        continue
+                    distance = _hamming(phash, candidate["PHash"])
+                    if distance <= max_distance:
+                        distances[candidate["ImageId"]] = distance
+                if "LastEvaluatedKey" not in response:
+                    break
+                params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        ordered = sorted(distances, key=lambda i: (distances[i], i))
+        items = self._get_items(user_id, ordered)
+        return {
+            "images": [
+                {**self._to_image(items[i], variant), "distance": distances[i]}
+                for i in ordered
+                if i in items
+            ]
+        }
+
+    def _get_items(
+        self, user_id: str, image_ids: typing.Sequence[str]
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        items: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        # BatchGetItem takes at most 100 keys
+        for start in range(0, len(image_ids), 100):
+            response = self.table.meta.client.batch_get_item(
+                RequestItems={
+                    self.table.name: {
+                        "Keys": [
+                            {"UserId": user_id, "ImageId": image_id}
+                            for image_id in image_ids[start : start + 100]
+                        ],
+                    }
+                }
+            )
+            for item in response["Responses"].get(self.table.name, []):
+                items[item["ImageId"]] = item
+        return items
+
+    def _resolve_aliases(
+        self,
+        items: typing.List[typing.Dict[str, typing.Any]],
+        variant: str,
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Fill variants of deduplicated images from their canonical image."""
+        keys = {
+            (item["CanonicalUserId"], item["CanonicalImageId"])
+            for item in items
+            if "CanonicalImageId" in item
+            and variant not in item.get("Variants", {})
+        }
+        if not keys:
+            return items
+
+        response = self.table.meta.client.batch_get_item(
+            RequestItems={
+                self.table.name: {
+                    "Keys": [
+                        {"UserId": user_id, "ImageId": image_id}
+                        for user_id, image_id in keys
+                    ],
+                    "ProjectionExpression": "UserId, ImageId, Variants",
+                }
+            }
+        )
+        canonicals = {
+            (item["UserId"], item["ImageId"]): item
+            for item in response["Responses"].get(self.table.name, [])
+        }
+
+        resolved = []
+        for item in items:
+            canonical = canonicals.get(
+                (item.get("CanonicalUserId"), item.get("CanonicalImageId"))
+            )
+            if canonical and variant in canonical.get("Variants", {}):
+                item = {
+                    **item,
+                    "Variants": {
+                        **item.get("Variants", {}),
+                        variant: canonical["Variants"][variant],
+                    },
+                }
+            resolved.append(item)
+        return resolved
+
+    def _to_image(
+        self, item: typing.Dict[str, typing.Any], variant: str
+    ) -> typing.Dict[str, typing.Any]:
+        found = item.get("Variants", {}).get(variant)
+        return _plain(
+            {
+                "image_id": item["ImageId"],
+                "created": item.get("Created"),
+                "width": item.get("Width"),
+                "height": item.get("Height"),
+                "blurhash": item.get("BlurHash"),
+                "dominant_color": item.get("DominantColor"),
+                "variant": variant,
+                "url": self._url(found["Key"]) if found else None,
+                "content_type": found.get("ContentType") if found else None,
+                "variant_width": found.get("Width") if found else None,
+                "variant_height": found.get("Height") if found else None,
+                "bytes": found.get("Bytes") if found else None,
+                # packed variants are a range of a shared segment at `url`
+                "byte_range": (
+                    f"bytes={found['Offset']}-"
+                    f"{found['Offset'] + found['Bytes'] - 1}"
+                    if found and "Offset" in found
+                    else None
+                ),
+            }
+        )
+
+    def _url(self, key: str) -> typing.Optional[str]:
+        if self.base_url:
+            return f"{self.base_url}/{key}"
+        if self.bucket_name:
+            return self.s3.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": self.bucket_name, "Key": key},
+                ExpiresIn=self.url_expires_in,
+            )
+        return None
+
+    def _encode_cursor(self, key: typing.Dict[str, typing.Any]) -> str:
+        return base64.urlsafe_b64encode(
+            json.dumps(_plain(key)).encode()
+        ).decode()
+
+    def _decode_cursor(
+        self, cursor: str, user_id: str
+    ) -> typing.Dict[str, typing.Any]:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            raise ValueError("invalid cursor")
+        if (
+            not isinstance(key, dict)
+            or key.get("UserId") != user_id
+            or not isinstance(key.get("ImageId"), str)
+            or not isinstance(key.get("Created"), int)
+        ):
+            raise ValueError("invalid cursor")
+        return {
+            "UserId": key["UserId"],
+            "ImageId": key["ImageId"],
+            "Created": key["Created"],
+        }
+
+
+def _hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def _plain(value: typing.Any) -> typing.Any:
+    """Convert DynamoDB `Decimal` values into JSON serializable numbers."""
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, Decimal):
+        return (
+            int(value) if value == value.to_integral_value() else float(value)
+        )
+    return value
 
 
 @app.post("/callback")
 @tracer.capture_method
 def post_handler():
     signature = app.current_event.get_header_value("X-Line-Signature")
-    body = app.current_event.body
+    # the API treats every media type as binary so listings can be gzipped,
+    # which means the webhook body may arrive base64 encoded
+    body = app.current_event.decoded_body
 
     line_api = LineApiHandler(
         access_token=os.getenv("CHANNEL_ACCESS_TOKEN"),
         secret=os.getenv("CHANNEL_SECRET"),
+        index_table_name=os.getenv("INDEX_TABLE_NAME") or None,
+        content_hash_table_name=os.getenv("CONTENT_HASH_TABLE_NAME") or None,
+        image_bucket_name=os.getenv("IMAGE_BUCKET_NAME") or None,
+        previews=json.loads(os.getenv("APP_PREVIEWS") or "[]"),
+        preview_cache_control=os.getenv("APP_PREVIEW_CACHE_CONTROL") or None,
     )
 
     try:
@@ -128,10 +641,168 @@ def post_handler():
     return {"message": "OK"}
 
 
+LINE_VERIFY_URL = "https://api.line.me/oauth2/v2.1/verify"
+# verified ID tokens of warm invocations: token -> (user id, expiry)
+_verified_tokens: typing.Dict[str, typing.Tuple[str, float]] = {}
+MAX_VERIFIED_TOKENS = 1000
+
+
+def verify_id_token(id_token: str, channel_id: str) -> typing.Optional[str]:
+    """User id of a LINE ID token issued to the LINE Login `channel_id`.
+
+    LINE checks the signature, audience and expiry. None if the token is
+    not valid.
+    """
+    cached = _verified_tokens.get(id_token)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    request = urllib.request.Request(
+        LINE_VERIFY_URL,
+        data=urllib.parse.urlencode(
+            {"id_token": id_token, "client_id": channel_id}
+        ).encode(),
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            claims = json.load(response)
+    except urllib.error.HTTPError as e:
+        if e.code == 400:
+            return None
+        raise
+    if len(_verified_tokens) >= MAX_VERIFIED_TOKENS:
+        _verified_tokens.clear()
+    _verified_tokens[id_token] = (claims["sub"], float(claims["exp"]))
+    return claims["sub"]
+
+
+def _authorize(user_id: str) -> typing.Optional[Response]:
+    """An error response unless the caller is signed in as `user_id`.
+
+    The routes of a user are off, 404, without a LINE Login channel to
+    verify ID tokens against.
+    """
+    channel_id = os.getenv("APP_LOGIN_CHANNEL_ID")
+    if not channel_id or not os.getenv("INDEX_TABLE_NAME"):
+        return Response(
+            status_code=404,
+            content_type="application/json",
+            body=json.dumps({"message": "Not found"}),
+        )
+    authorization = app.current_event.get_header_value("Authorization") or ""
+    scheme, _, id_token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not id_token:
+        return Response(
+            status_code=401,
+            content_type="application/json",
+            body=json.dumps({"message": "Unauthorized"}),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    signed_in = verify_id_token(id_token.strip(), channel_id)
+    if signed_in is None:
+        return Response(
+            status_code=401,
+            content_type="application/json",
+            body=json.dumps({"message": "Unauthorized"}),
+            headers={"WWW-Authenticate": 'Bearer error="invalid_token"'},
+        )
+    if signed_in != user_id:
+        return Response(
+            status_code=403,
+            content_type="application/json",
+            body=json.dumps({"message": "Forbidden"}),
+        )
+    return None
+
+
+@app.get(
+    "/users/<user_id>/images",
+    compress=True,
+    cache_control="private, max-age=60",
+)
+@tracer.capture_method
+def list_images_handler(user_id: str):
+    denied = _authorize(user_id)
+    if denied:
+        return denied
+    index_table_name = typing.cast(str, os.getenv("INDEX_TABLE_NAME"))
+
+    params = app.current_event.query_string_parameters or {}
+    catalog = ImageCatalog(
+        index_table_name=index_table_name,
+        bucket_name=os.getenv("IMAGE_BUCKET_NAME") or None,
+        base_url=os.getenv("IMAGE_BASE_URL") or None,
+    )
+    try:
+        limit = int(params["limit"]) if "limit" in params else None
+    except ValueError:
+        limit = 0
+    try:
+        return catalog.list_images(
+            user_id=user_id,
+            variant=params.get("variant"),
+            limit=limit,
+            cursor=params.get("cursor"),
+        )
+    except ValueError as e:
+        return Response(
+            status_code=400,
+            content_type="application/json",
+            body=json.dumps({"message": str(e)}),
+        )
+
+
+@app.get(
+    "/users/<user_id>/images/<image_id>/similar",
+    compress=True,
+    cache_control="private, max-age=60",
+)
+@tracer.capture_method
+def similar_images_handler(user_id: str, image_id: str):
+    denied = _authorize(user_id)
+    if denied:
+        return denied
+    index_table_name = typing.cast(str, os.getenv("INDEX_TABLE_NAME"))
+
+    params = app.current_event.query_string_parameters or {}
+    catalog = ImageCatalog(
+        index_table_name=index_table_name,
+        bucket_name=os.getenv("IMAGE_BUCKET_NAME") or None,
+        base_url=os.getenv("IMAGE_BASE_URL") or None,
+    )
+    try:
+        max_distance = int(params.get("max_distance", PHASH_BANDS - 1))
+    except ValueError:
+        max_distance = -1
+    try:
+        return catalog.find_similar(
+            user_id=user_id,
+            image_id=image_id,
+            max_distance=max_distance,
+            variant=params.get("variant"),
+        )
+    except LookupError:
+        return Response(
+            status_code=404,
+            content_type="application/json",
+            body=json.dumps({"message": "Not found"}),
+        )
+    except ValueError as e:
+        return Response(
+            status_code=400,
+            content_type="application/json",
+            body=json.dumps({"message": str(e)}),
+        )
+
+
 @logger.inject_lambda_context(
-    correlation_id_path=correlation_paths.API_GATEWAY_REST,
+    correlation_id_path=CORRELATION_PATHS[PROXY_TYPE],
 )
 @tracer.capture_lambda_handler
+@metrics.log_metrics
+@telemetry.report_slow(TRACES_SLOW_MS)
+@telemetry.sampled_debug_logging
+@telemetry.sampled_profiling
 def lambda_handler(
     event,
     context: LambdaContext,
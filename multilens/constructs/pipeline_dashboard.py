@@ -0,0 +1,79 @@
+import typing
+
+import aws_cdk as cdk
+from aws_cdk import aws_cloudwatch as cloudwatch
+from constructs import Construct
+
+# the functions publish metrics in embedded metric format under this
+# namespace, with the powertools "service" dimension
+METRICS_NAMESPACE = "Multilens"
+
+PERCENTILES = ["p50", "p95", "p99"]
+
+
+class PipelineDashboard(Construct):
+    """Latency percentiles of each pipeline stage, per variant.
+
+    LINE event -> ingestion (LineApi) -> delivery through SNS/SQS ->
+    conversion, plus the end to end time until a variant is uploaded.
+    """
+
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        variants: typing.Sequence[str],
+        namespace: str = METRICS_NAMESPACE,
+        ingestion_service: str = "LineApi",
+        convert_service: str = "ImageConvert",
+    ) -> None:
+        super().__init__(scope, id)
+
+        self.namespace = namespace
+        self.dashboard = cloudwatch.Dashboard(self, "Dashboard")
+
+        self.dashboard.add_widgets(
+            self._percentile_widget(
+                "IngestionLatency",
+                {"service": ingestion_service},
+            ),
+        )
+        for variant in variants:
+            dimensions = {"service": convert_service, "Variant": variant}
+            self.dashboard.add_widgets(
+                *(
+                    self._percentile_widget(
+                        metric_name,
+                        dimensions,
+                        title=f"{metric_name} {variant}",
+                    )
+                    for metric_name in (
+                        "EndToEndLatency",
+                        "DeliveryLatency",
+                        "QueueAge",
+                        "ConversionDuration",
+                    )
+                )
+            )
+
+    def _percentile_widget(
+        self,
+        metric_name: str,
+        dimensions: typing.Mapping[str, str],
+        title: typing.Optional[str] = None,
+    ) -> cloudwatch.GraphWidget:
+        return cloudwatch.GraphWidget(
+            title=title or metric_name,
+            left=[
+                cloudwatch.Metric(
+                    namespace=self.namespace,
+                    metric_name=metric_name,
+                    dimensions_map=dimensions,
+                    statistic=statistic,
+                    period=cdk.Duration.minutes(5),
+                    label=statistic,
+                )
+                for statistic in PERCENTILES
+            ],
+            width=6,
+        )
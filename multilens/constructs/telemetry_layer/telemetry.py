@@ -0,0 +1,217 @@
+"""Telemetry of the Lambda functions, shipped to each of them as a layer.
+
+Imported as `telemetry` from the layer in Lambda, and from this package
+elsewhere. The LINE callback loads the image convert function for previews,
+so both share the one module and whatever it registers.
+"""
+import cProfile
+import functools
+import logging
+import marshal
+import os
+import pickle
+import random
+import time
+import tracemalloc
+import typing
+
+import boto3
+import sentry_sdk
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+# the handler's own: Powertools shares a logger per service, and metrics
+# across instances
+logger = Logger()
+metrics = Metrics(
+    namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "Multilens")
+)
+
+
+class LogVolume(logging.Filter):
+    """Counts the records that pass the level check."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.records = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.records += 1
+        return True
+
+
+# once per process, however many functions load this module
+log_volume = LogVolume()
+logger.addFilter(log_volume)
+
+
+def sampled_debug_logging(handler: typing.Callable) -> typing.Callable:
+    """Log a sample of invocations at debug level and count log records.
+
+    Powertools only samples on cold start, here a fraction of every
+    invocation (APP_DEBUG_SAMPLE_RATE) logs at debug level and the rest
+    stays at LOG_LEVEL. Must be applied inside `metrics.log_metrics`.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        sample_rate = float(os.getenv("APP_DEBUG_SAMPLE_RATE") or 0)
+        sampled = random.random() < sample_rate
+        logger.setLevel(
+            logging.DEBUG if sampled else os.getenv("LOG_LEVEL", "INFO").upper()
+        )
+        log_volume.records = 0
+        try:
+            return handler(event, context)
+        finally:
+            metrics.add_metric(
+                name="LogRecords",
+                unit=MetricUnit.Count,
+                value=log_volume.records,
+            )
+            if sampled:
+                metrics.add_metric(
+                    name="DebugSampled", unit=MetricUnit.Count, value=1
+                )
+
+    return wrapper
+
+
+# share of transactions recorded for Sentry
+TRACES_SAMPLE_RATE = float(os.getenv("APP_TRACES_SAMPLE_RATE") or 0.01)
+
+
+def init_sentry(dsn: str) -> None:
+    """Sentry with head sampled transactions, once per process."""
+    if sentry_sdk.Hub.current.client is not None:
+        return
+    sentry_sdk.init(
+        dsn=dsn,
+        integrations=[AwsLambdaIntegration()],
+        traces_sampler=sample_transaction,
+    )
+
+
+def sample_transaction(sampling_context: typing.Dict[str, typing.Any]) -> float:
+    """Record TRACES_SAMPLE_RATE of the invocations, and every redelivery.
+
+    Unsampled transactions record no spans at all. A redelivered message
+    failed before, so its retry is recorded in full; errors themselves are
+    events of their own and are always sent.
+    """
+    event = sampling_context.get("aws_event")
+    records = event.get("Records") if isinstance(event, dict) else None
+    if any(_receive_count(record) > 1 for record in records or []):
+        return 1.0
+    return TRACES_SAMPLE_RATE
+
+
+def _receive_count(record: typing.Any) -> int:
+    attributes = record.get("attributes") if isinstance(record, dict) else None
+    return int((attributes or {}).get("ApproximateReceiveCount") or 0)
+
+
+def report_slow(slow_ms: float) -> typing.Callable:
+    """Report invocations slower than `slow_ms` left out by the sampling.
+
+    Slowness is only known at the end, too late to record the transaction,
+    so these are a warning event with the duration instead.
+    """
+
+    def decorator(handler: typing.Callable) -> typing.Callable:
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            start = time.monotonic()
+            try:
+                return handler(event, context)
+            finally:
+                elapsed_ms = (time.monotonic() - start) * 1000
+                if elapsed_ms >= slow_ms and not _sampled():
+                    sentry_sdk.capture_message(
+                        f"slow invocation: {elapsed_ms:.0f} ms",
+                        level="warning",
+                    )
+
+        return wrapper
+
+    return decorator
+
+
+def _sampled() -> bool:
+    span = sentry_sdk.Hub.current.scope.span
+    return bool(span and span.sampled)
+
+
+# frames kept per allocation in profiled invocations
+PROFILE_TRACEBACK_FRAMES = 25
+
+
+def sampled_profiling(handler: typing.Callable) -> typing.Callable:
+    """Profile a sample of invocations into S3.
+
+    For APP_PROFILE_SAMPLE_RATE of invocations, a cProfile profile (pstats)
+    and a tracemalloc snapshot are written under APP_PROFILE_PREFIX in
+    APP_PROFILE_BUCKET. The rest only pay for the coin toss. Must be applied
+    inside `metrics.log_metrics`.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        bucket_name = os.getenv("APP_PROFILE_BUCKET")
+        sample_rate = float(os.getenv("APP_PROFILE_SAMPLE_RATE") or 0)
+        if not bucket_name or random.random() >= sample_rate:
+            return handler(event, context)
+
+        # someone else's trace (a test, say) is left alone
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(PROFILE_TRACEBACK_FRAMES)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return handler(event, context)
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+            _put_profile(bucket_name, context, profiler, snapshot)
+
+    return wrapper
+
+
+def _put_profile(
+    bucket_name: str,
+    context: LambdaContext,
+    profiler: cProfile.Profile,
+    snapshot: tracemalloc.Snapshot,
+) -> None:
+    key = "/".join(
+        [
+            (os.getenv("APP_PROFILE_PREFIX") or "profiles").rstrip("/"),
+            time.strftime("%Y/%m/%d", time.gmtime()),
+            context.aws_request_id,
+        ]
+    )
+    # what Profile.dump_stats and Snapshot.dump write, for pstats.Stats
+    # and tracemalloc.Snapshot.load
+    profiler.create_stats()
+    try:
+        s3 = boto3.client("s3")
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=f"{key}.pstats",
+            Body=marshal.dumps(profiler.stats),  # type: ignore
+        )
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=f"{key}.tracemalloc",
+            Body=pickle.dumps(snapshot),
+        )
+    except Exception:
+        # a lost profile must not fail the invocation
+        logger.exception("failed to write profile %s", key)
+        return
+    metrics.add_metric(name="ProfileSampled", unit=MetricUnit.Count, value=1)
@@ -2,7 +2,9 @@ from aws_cdk import Stack, aws_s3 as s3
 from constructs import Construct
 
 from multilens.constructs.image_convert import ImageConvert
+from multilens.constructs.image_index import ImageIndex
 from multilens.constructs.line_api import LineApi, LineApiCredential
+from multilens.constructs.pipeline_dashboard import PipelineDashboard
 
 
 class MultilensStack(Stack):
@@ -15,19 +17,49 @@ class MultilensStack(Stack):
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        image_index = ImageIndex(self, "ImageIndex")
+
+        image_convert = ImageConvert(
+            self,
+            "ImageConvert",
+            use_sqs=False,
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            index_table=image_index.table,
+            use_cdn=True,
+            lambda_log_level="INFO",
+            lambda_log_sample_rate=0.01,
+        )
+        image_base_url = (
+            f"https://{image_convert.distribution.distribution_domain_name}"
+            if image_convert.distribution
+            else None
+        )
+
         LineApi(
             self,
             "LineApi",
             line_credential=line_credential,
             bucket_props=s3.BucketProps(),
-            lambda_log_level="DEBUG",
+            index_table=image_index.table,
+            image_bucket=image_convert.output_bucket,
+            image_base_url=image_base_url,
+            deduplicate=True,
+            # the list view thumbnail, ready as soon as the webhook returns
+            preview_props=[
+                props
+                for props in image_convert.convert_props
+                if props.variant_name() == "jpeg/400"
+            ],
+            preview_cache_control=image_convert.cache_control,
+            lambda_log_level="INFO",
+            lambda_log_sample_rate=0.01,
         )
 
-        ImageConvert(
+        PipelineDashboard(
             self,
-            "ImageConvert",
-            use_sqs=False,
-            input_bucket_props=s3.BucketProps(),
-            output_bucket_props=s3.BucketProps(),
-            lambda_log_level="DEBUG",
+            "PipelineDashboard",
+            variants=[
+                props.variant_name() for props in image_convert.convert_props
+            ],
         )
@@ -0,0 +1,307 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from botocore.exceptions import ClientError
+
+from multilens.constructs.image_convert_function.index import (
+    ConvertConfig,
+    Engine,
+    Format,
+    ImageConvertProcessor,
+    KeyLayout,
+    create_s3_client,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BackfillStats:
+    listed: int = 0
+    skipped: int = 0
+    converted: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        if self.elapsed <= 0:
+            return 0.0
+        return self.converted / self.elapsed
+
+
+class Checkpoint:
+    """Input keys that are already done, persisted as JSON lines.
+
+    Keys are appended as they complete, so an interrupted run loses at most
+    the conversions that were in flight.
+    """
+
+    def __init__(self, path: typing.Optional[str] = None) -> None:
+        self.path = path
+        self._done: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self._done.add(json.loads(line))
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._done
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            if key in self._done:
+                return
+            self._done.add(key)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(key) + "\n")
+
+
+class Backfill:
+    def __init__(
+        self,
+        input_bucket: str,
+        config: ConvertConfig,
+        workers: int = 8,
+        prefix: str = "",
+        checkpoint: typing.Optional[Checkpoint] = None,
+        overwrite: bool = False,
+        s3_client: typing.Optional[typing.Any] = None,
+        report_interval: float = 10.0,
+    ) -> None:
+        if workers < 1:
+            raise ValueError("requires `workers` >= 1")
+
+        self.input_bucket = input_bucket
+        self.config = config
+        self.workers = workers
+        self.prefix = prefix
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint()
+        self.overwrite = overwrite
+        self.s3 = s3_client or create_s3_client()
+        self.report_interval = report_interval
+        # boto3 clients are thread safe once created, so every worker shares
+        # the processor and its client.
+        self.processor = ImageConvertProcessor(config, s3_client=self.s3)
+
+        self.stats = BackfillStats()
+        self._stats_lock = threading.Lock()
+
+    def run(self) -> BackfillStats:
+        started = time.monotonic()
+        last_report = started
+        pending: typing.Set[Future] = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for key in self._iter_keys():
+                self.stats.listed += 1
+                if key in self.checkpoint:
+                    self._count("skipped")
+                    continue
+                # keep the listing only a little ahead of the workers
+                if len(pending) >= self.workers * 4:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(executor.submit(self._process, key))
+
+                now = time.monotonic()
+                if now - last_report >= self.report_interval:
+                    self._report(now - started)
+                    last_report = now
+            wait(pending)
+        self.processor.flush()
+
+        self.stats.elapsed = time.monotonic() - started
+        self._report(self.stats.elapsed)
+        return self.stats
+
+    def _iter_keys(self) -> typing.Iterator[str]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.input_bucket,
+            Prefix=self.prefix,
+        ):
+            for content in page.get("Contents", []):
+                yield content["Key"]
+
+    def _process(self, key: str) -> None:
+        try:
+            head_response = self.s3.head_object(
+                Bucket=self.input_bucket,
+                Key=key,
+            )
+            metadata = head_response["Metadata"]
+            if not self.overwrite and self._exists(metadata):
+                self._count("skipped")
+            else:
+                self.processor.convert_object(self.input_bucket, key, metadata)
+                self._count("converted")
+        except Exception:
+            logger.exception("failed to convert %s", key)
+            self._count("failed")
+            return
+        self.checkpoint.add(key)
+
+    def _exists(self, metadata: typing.Dict[str, str]) -> bool:
+        if "imageid" not in metadata:
+            # the output key would be random, nothing to compare against
+            return False
+        try:
+            self.s3.head_object(
+                Bucket=self.config.bucket_name,
+                Key=self.processor.output_key(metadata),
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _report(self, elapsed: float) -> None:
+        rate = self.stats.converted / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            "listed=%d converted=%d skipped=%d failed=%d (%.1f images/s)",
+            self.stats.listed,
+            self.stats.converted,
+            self.stats.skipped,
+            self.stats.failed,
+            rate,
+        )
+
+
+def parse_args(
+    argv: typing.Optional[typing.Sequence[str]] = None,
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert images already in the input bucket.",
+    )
+    parser.add_argument("--input-bucket", required=True)
+    parser.add_argument("--output-bucket", required=True)
+    parser.add_argument(
+        "--format",
+        choices=[f.value for f in Format],
+        default=None,
+        help="output format (default: keep the original format)",
+    )
+    parser.add_argument(
+        "--resize",
+        type=int,
+        default=None,
+        help="longest side in pixels (default: keep the original size)",
+    )
+    parser.add_argument(
+        "--target-bytes",
+        type=int,
+        default=None,
+        help="search the encoder quality to fit this many bytes",
+    )
+    parser.add_argument(
+        "--min-ssim",
+        type=float,
+        default=None,
+        help="search the lowest encoder quality keeping this SSIM",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=[e.value for e in Engine],
+        default=Engine.PILLOW.value,
+        help="imaging library to decode, resize and encode with",
+    )
+    parser.add_argument(
+        "--exif-thumbnail",
+        action="store_true",
+        help="make resized variants from EXIF thumbnails where they suffice",
+    )
+    parser.add_argument(
+        "--key-layout",
+        choices=[k.value for k in KeyLayout],
+        default=KeyLayout.PLAIN.value,
+        help="output key layout of the variant",
+    )
+    parser.add_argument(
+        "--cache-control",
+        default=None,
+        help="Cache-Control of the variants, as the stack's converters set",
+    )
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="file recording finished keys, used to resume a run",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="convert even if the output object already exists",
+    )
+    parser.add_argument(
+        "--index-table",
+        default=None,
+        help="image index table to record converted variants in",
+    )
+    parser.add_argument(
+        "--image-features",
+        action="store_true",
+        help="also compute perceptual hashes for the similarity index",
+    )
+    parser.add_argument(
+        "--endpoint-url",
+        default=None,
+        help="S3 endpoint, e.g. a local moto server or MinIO",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+    config = ConvertConfig(
+        bucket_name=args.output_bucket,
+        format=Format(args.format) if args.format else None,
+        resize=args.resize if args.resize and args.resize > 0 else None,
+        index_table_name=args.index_table,
+        cache_control=args.cache_control,
+        image_features=args.image_features,
+        target_bytes=args.target_bytes,
+        min_ssim=args.min_ssim,
+        engine=Engine(args.engine),
+        exif_thumbnail=args.exif_thumbnail,
+        key_layout=KeyLayout(args.key_layout),
+    )
+    backfill = Backfill(
+        input_bucket=args.input_bucket,
+        config=config,
+        workers=args.workers,
+        prefix=args.prefix,
+        checkpoint=Checkpoint(args.checkpoint),
+        overwrite=args.overwrite,
+        s3_client=create_s3_client(endpoint_url=args.endpoint_url),
+    )
+    stats = backfill.run()
+    return 1 if stats.failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
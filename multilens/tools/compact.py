@@ -0,0 +1,381 @@
+import argparse
+import logging
+import time
+import typing
+from dataclasses import dataclass
+
+import boto3
+from botocore.exceptions import ClientError
+
+from multilens.constructs.image_convert_function.index import (
+    PACK_COMPACTED_TAG,
+    PackEntry,
+    create_s3_client,
+    decode_pack_index,
+    encode_pack_segment,
+    pack_segment_key,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CompactionStats:
+    users: int = 0
+    # small segments replaced, and the segments written for them
+    compacted: int = 0
+    written: int = 0
+    # variants moved, and entries left behind because the index no longer
+    # points at them
+    moved: int = 0
+    dropped: int = 0
+    # segments left for a later run, with entries the index may not point at
+    # yet
+    pending: int = 0
+
+
+@dataclass
+class _LiveEntry:
+    segment_key: str
+    entry: PackEntry
+    body: bytes
+
+
+def _written_at(segment_key: str) -> float:
+    # see pack_segment_key
+    return int(segment_key.rsplit("/", 1)[-1].split("-", 1)[0]) / 1000
+
+
+class Compactor:
+    """Merges the small packed segments of each user into larger ones.
+
+    The converters write a segment per batch, so a user's thumbnails end up
+    spread over many small segments. Entries the index still points at are
+    copied into new segments and the index is moved over to them; entries of
+    re-converted images are dropped. The old segments are tagged with
+    PACK_COMPACTED_TAG for the lifecycle rule of the output bucket to expire
+    them, so pages listed before the compaction can still be read.
+
+    The index is updated after a segment is written, so segments younger than
+    `grace_seconds` are left alone, and a segment is only tagged once each of
+    its entries was copied or replaced by a later one in the index.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        index_table_name: str,
+        variant: str,
+        small_bytes: int = 1024 * 1024,
+        segment_bytes: int = 4 * 1024 * 1024,
+        grace_seconds: float = 15 * 60,
+        cache_control: typing.Optional[str] = None,
+        s3_client: typing.Optional[typing.Any] = None,
+        dynamodb: typing.Optional[typing.Any] = None,
+    ) -> None:
+        self.bucket_name = bucket_name
+        self.variant = variant
+        self.small_bytes = small_bytes
+        self.segment_bytes = segment_bytes
+        self.grace_seconds = grace_seconds
+        self.cache_control = cache_control
+        self.s3 = s3_client or create_s3_client()
+        self.table = (dynamodb or boto3.resource("dynamodb")).Table(
+            index_table_name
+        )
+        self.stats = CompactionStats()
+
+    @property
+    def prefix(self) -> str:
+        return f"packs/{self.variant}/"
+
+    def run(
+        self, user_ids: typing.Optional[typing.Iterable[str]] = None
+    ) -> CompactionStats:
+        for user_id in user_ids or self._iter_users():
+            self.compact_user(user_id)
+            self.stats.users += 1
+        logger.info(
+            "users=%d compacted=%d written=%d moved=%d dropped=%d pending=%d",
+            self.stats.users,
+            self.stats.compacted,
+            self.stats.written,
+            self.stats.moved,
+            self.stats.dropped,
+            self.stats.pending,
+        )
+        return self.stats
+
+    def compact_user(self, user_id: str) -> None:
+        segment_keys = self._small_segments(user_id)
+        if len(segment_keys) < 2:
+            return
+
+        bodies = {key: self._get(key) for key in segment_keys}
+        indexes = {key: decode_pack_index(body) for key, body in bodies.items()}
+        variants = self._indexed_variants(
+            user_id,
+            {e.image_id for entries in indexes.values() for e in entries},
+        )
+        live = []
+        pending = set()
+        for key in segment_keys:
+            for entry in indexes[key]:
+                found = variants.get(entry.image_id, {})
+                if (
+                    found.get("Key") == key
+                    and found.get("Offset") == entry.offset
+                ):
+                    live.append(
+                        _LiveEntry(
+                            key,
+                            entry,
+                            bodies[key][
+                                entry.offset : entry.offset + entry.length
+                            ],
+                        )
+                    )
+                elif self._superseded(key, found):
+                    self.stats.dropped += 1
+                else:
+                    # its index update may not have landed yet
+                    pending.add(key)
+
+        live_keys = {item.segment_key for item in live}
+        if len(live_keys) < 2:
+            # a single segment left, nothing to merge it with
+            segment_keys = [key for key in segment_keys if key not in live_keys]
+            live = []
+        for chunk in self._chunks(live):
+            self._write(user_id, chunk)
+        self.stats.pending += len(pending)
+        segment_keys = [key for key in segment_keys if key not in pending]
+        for key in segment_keys:
+            self.s3.put_object_tagging(
+                Bucket=self.bucket_name,
+                Key=key,
+                Tagging={
+                    "TagSet": [{"Key": PACK_COMPACTED_TAG, "Value": "true"}]
+                },
+            )
+        self.stats.compacted += len(segment_keys)
+
+    def _iter_users(self) -> typing.Iterator[str]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket_name,
+            Prefix=self.prefix,
+            Delimiter="/",
+        ):
+            for common_prefix in page.get("CommonPrefixes", []):
+                yield common_prefix["Prefix"][len(self.prefix) :].rstrip("/")
+
+    def _small_segments(self, user_id: str) -> typing.List[str]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        written_before = time.time() - self.grace_seconds
+        keys = []
+        for page in paginator.paginate(
+            Bucket=self.bucket_name,
+            Prefix=f"{self.prefix}{user_id}/",
+        ):
+            for content in page.get("Contents", []):
+                key = content["Key"]
+                if (
+                    content["Size"] < self.small_bytes
+                    and _written_at(key) < written_before
+                    and not self._is_compacted(key)
+                ):
+                    keys.append(key)
+        # oldest first, segment keys start with the time they were written
+        return sorted(keys)
+
+    def _is_compacted(self, key: str) -> bool:
+        tags = self.s3.get_object_tagging(Bucket=self.bucket_name, Key=key)
+        return any(tag["Key"] == PACK_COMPACTED_TAG for tag in tags["TagSet"])
+
+    def _superseded(
+        self, segment_key: str, found: typing.Dict[str, typing.Any]
+    ) -> bool:
+        """Whether the index points at a later conversion than the segment's.
+
+        Another offset in the same segment, or a later segment of the user,
+        was written after it; a variant written unpacked since packing was
+        turned off is later too. An entry that is not indexed at all, or
+        indexed in an earlier segment, may still be waiting for its update.
+        """
+        key = found.get("Key")
+        if not key:
+            return False
+        if key.startswith(self.prefix):
+            return key >= segment_key
+        return True
+
+    def _get(self, key: str) -> bytes:
+        return self.s3.get_object(Bucket=self.bucket_name, Key=key)[
+            "Body"
+        ].read()
+
+    def _indexed_variants(
+        self, user_id: str, image_ids: typing.Collection[str]
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        ordered = sorted(image_ids)
+        variants = {}
+        # BatchGetItem takes at most 100 keys
+        for start in range(0, len(ordered), 100):
+            response = self.table.meta.client.batch_get_item(
+                RequestItems={
+                    self.table.name: {
+                        "Keys": [
+                            {"UserId": user_id, "ImageId": image_id}
+                            for image_id in ordered[start : start + 100]
+                        ],
+                    }
+                }
+            )
+            for item in response["Responses"].get(self.table.name, []):
+                found = item.get("Variants", {}).get(self.variant)
+                if found:
+                    variants[item["ImageId"]] = found
+        return variants
+
+    def _chunks(
+        self, live: typing.List[_LiveEntry]
+    ) -> typing.Iterator[typing.List[_LiveEntry]]:
+        chunk: typing.List[_LiveEntry] = []
+        size = 0
+        for item in live:
+            if chunk and size + len(item.body) > self.segment_bytes:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(item)
+            size += len(item.body)
+        if chunk:
+            yield chunk
+
+    def _write(self, user_id: str, chunk: typing.List[_LiveEntry]) -> None:
+        key = pack_segment_key(self.variant, user_id)
+        body, entries = encode_pack_segment(
+            [(item.entry.image_id, item.body) for item in chunk]
+        )
+        extra_args: typing.Dict[str, typing.Any] = {
+            "ContentType": "application/octet-stream",
+            "Metadata": {"variant": self.variant, "userid": user_id},
+        }
+        if self.cache_control:
+            extra_args["CacheControl"] = self.cache_control
+        self.s3.put_object(
+            Bucket=self.bucket_name, Key=key, Body=body, **extra_args
+        )
+        self.stats.written += 1
+        for item, entry in zip(chunk, entries):
+            if self._move(user_id, item, key, entry.offset):
+                self.stats.moved += 1
+            else:
+                # re-converted into a later segment since it was read
+                self.stats.dropped += 1
+
+    def _move(
+        self, user_id: str, item: _LiveEntry, key: str, offset: int
+    ) -> bool:
+        try:
+            self.table.update_item(
+                Key={"UserId": user_id, "ImageId": item.entry.image_id},
+                UpdateExpression=(
+                    "SET #variants.#variant.#key = :key, "
+                    "#variants.#variant.#offset = :offset"
+                ),
+                # re-converted while compacting, the new entry stays
+                ConditionExpression=(
+                    "#variants.#variant.#key = :old_key AND "
+                    "#variants.#variant.#offset = :old_offset"
+                ),
+                ExpressionAttributeNames={
+                    "#variants": "Variants",
+                    "#variant": self.variant,
+                    "#key": "Key",
+                    "#offset": "Offset",
+                },
+                ExpressionAttributeValues={
+                    ":key": key,
+                    ":offset": offset,
+                    ":old_key": item.segment_key,
+                    ":old_offset": item.entry.offset,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+
+def parse_args(
+    argv: typing.Optional[typing.Sequence[str]] = None,
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Merge small packed segments of a variant.",
+    )
+    parser.add_argument("--bucket", required=True, help="output bucket")
+    parser.add_argument("--index-table", required=True)
+    parser.add_argument(
+        "--variant",
+        required=True,
+        help="packed variant, e.g. jpeg/400",
+    )
+    parser.add_argument(
+        "--user",
+        action="append",
+        default=None,
+        help="user to compact, may be repeated (default: every user)",
+    )
+    parser.add_argument(
+        "--small-bytes",
+        type=int,
+        default=1024 * 1024,
+        help="segments below this size are merged",
+    )
+    parser.add_argument(
+        "--segment-bytes",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="size of the merged segments",
+    )
+    parser.add_argument(
+        "--grace-seconds",
+        type=float,
+        default=15 * 60,
+        help="segments written more recently are left alone, their index "
+        "updates may not have landed yet",
+    )
+    parser.add_argument("--cache-control", default=None)
+    parser.add_argument(
+        "--endpoint-url",
+        default=None,
+        help="S3 endpoint, e.g. a local moto server or MinIO",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+    compactor = Compactor(
+        bucket_name=args.bucket,
+        index_table_name=args.index_table,
+        variant=args.variant,
+        small_bytes=args.small_bytes,
+        segment_bytes=args.segment_bytes,
+        grace_seconds=args.grace_seconds,
+        cache_control=args.cache_control,
+        s3_client=create_s3_client(endpoint_url=args.endpoint_url),
+    )
+    compactor.run(args.user)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,622 @@
+"""Drive the whole pipeline in process, against moto.
+
+Synthetic LINE webhook deliveries are signed with the channel secret and
+resolved by the callback function, which stores originals in S3. Each
+upload is then announced on SNS like the bucket notification would, fanned
+out to one SQS queue per variant, and consumed by a converter per variant
+running concurrently, as separate Lambda functions would.
+
+Only the LINE platform itself is faked: message content is served from
+images generated up front.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from io import BytesIO
+from unittest import mock
+
+import boto3
+from linebot import LineBotApi
+from moto import mock_dynamodb, mock_s3, mock_sns, mock_sqs
+from PIL import Image
+
+from multilens.constructs.image_convert_function import (
+    index as image_convert_function,
+)
+from multilens.constructs.line_api_callback_function import (
+    index as line_api_callback_function,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANTS = [
+    "original/original",
+    "jpeg/400",
+    "webp/original",
+    "webp/400",
+]
+DEFAULT_IMAGE_SIZES = {(640, 480): 3.0, (1280, 960): 2.0, (4032, 3024): 1.0}
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class HarnessConfig:
+    events: int = 50
+    # webhook deliveries per second, 0 delivers them back to back
+    rate: float = 0.0
+    image_ratio: float = 0.8
+    # (width, height) -> relative weight
+    image_sizes: typing.Mapping[typing.Tuple[int, int], float] = field(
+        default_factory=lambda: dict(DEFAULT_IMAGE_SIZES)
+    )
+    variants: typing.Sequence[str] = field(
+        default_factory=lambda: list(DEFAULT_VARIANTS)
+    )
+    use_index: bool = True
+    batch_size: int = 10
+    timeout: float = 300.0
+    seed: int = 0
+
+
+@dataclass
+class StageStats:
+    count: int
+    percentiles: typing.Dict[int, float]
+    max: float
+
+    @classmethod
+    def from_samples(cls, samples: typing.Sequence[float]) -> "StageStats":
+        ordered = sorted(samples)
+        return cls(
+            count=len(ordered),
+            percentiles={p: _percentile(ordered, p) for p in PERCENTILES},
+            max=ordered[-1] if ordered else 0.0,
+        )
+
+
+@dataclass
+class HarnessReport:
+    elapsed: float
+    webhooks: int
+    images: int
+    variants: int
+    failed: int
+    # stage name -> seconds
+    stages: typing.Dict[str, StageStats]
+
+    @property
+    def throughput(self) -> float:
+        """Images with every variant converted, per second."""
+        return self.images / self.elapsed if self.elapsed > 0 else 0.0
+
+    def format(self) -> str:
+        lines = [
+            f"{self.webhooks} webhooks, {self.images} images, "
+            f"{self.variants} variants, {self.failed} failed "
+            f"in {self.elapsed:.1f}s ({self.throughput:.2f} images/s)",
+            f"{'stage':<24}{'count':>7}"
+            + "".join(f"{f'p{p}':>10}" for p in PERCENTILES)
+            + f"{'max':>10}",
+        ]
+        for name, stats in self.stages.items():
+            lines.append(
+                f"{name:<24}{stats.count:>7}"
+                + "".join(
+                    f"{stats.percentiles[p] * 1000:>8.1f}ms"
+                    for p in PERCENTILES
+                )
+                + f"{stats.max * 1000:>8.1f}ms"
+            )
+        return "\n".join(lines)
+
+
+def sign(channel_secret: str, body: str) -> str:
+    """X-Line-Signature of a webhook body."""
+    digest = hmac.new(
+        channel_secret.encode(), body.encode(), hashlib.sha256
+    ).digest()
+    return base64.b64encode(digest).decode()
+
+
+class _MessageContent:
+    def __init__(self, content: bytes, content_type: str) -> None:
+        self.content = content
+        self.content_type = content_type
+
+    def iter_content(self, chunk_size: int = 1024) -> typing.Iterator[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class _TimedConvertProcessor(image_convert_function.SqsImageConvertProcessor):
+    """Samples the conversion of each image, and each flush of a batch."""
+
+    def __init__(
+        self,
+        config: image_convert_function.ConvertConfig,
+        s3_client: typing.Any,
+        sample: typing.Callable[[str, float], None],
+    ) -> None:
+        super().__init__(config, s3_client=s3_client)
+        self.sample = sample
+
+    def _process_s3_record(self, record: typing.Dict[str, typing.Any]) -> None:
+        started = time.monotonic()
+        super()._process_s3_record(record)
+        self.sample(
+            f"convert.{self.variant_name()}", time.monotonic() - started
+        )
+
+    def flush(self) -> None:
+        started = time.monotonic()
+        super().flush()
+        self.sample(f"flush.{self.variant_name()}", time.monotonic() - started)
+
+
+class PipelineHarness:
+    channel_secret = "harness-channel-secret"
+    input_bucket_name = "harness-input"
+    output_bucket_name = "harness-output"
+    index_table_name = "harness-index"
+
+    def __init__(self, config: typing.Optional[HarnessConfig] = None) -> None:
+        self.config = config or HarnessConfig()
+        self.random = random.Random(self.config.seed)
+        self._images: typing.Dict[typing.Tuple[int, int], bytes] = {}
+        self._contents: typing.Dict[str, bytes] = {}
+        self._samples: typing.Dict[str, typing.List[float]] = {}
+        self._delivered: typing.Dict[str, float] = {}
+        self._remaining: typing.Dict[str, int] = {}
+        self._failed_keys: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self._converted = threading.Condition(self._lock)
+        self._done = threading.Event()
+        self._images_done = 0
+        self._variants_done = 0
+        self._failed = 0
+
+    def run(self) -> HarnessReport:
+        environ = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_SECURITY_TOKEN": "testing",
+            "AWS_SESSION_TOKEN": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "CHANNEL_ACCESS_TOKEN": "harness",
+            "CHANNEL_SECRET": self.channel_secret,
+            "BUCKET_NAME": self.input_bucket_name,
+            "INDEX_TABLE_NAME": (
+                self.index_table_name if self.config.use_index else ""
+            ),
+            "CONTENT_HASH_TABLE_NAME": "",
+        }
+        with mock.patch.dict(os.environ, environ), mock_s3(), mock_sns(), (
+            mock_sqs()
+        ), mock_dynamodb(), mock.patch.object(
+            LineBotApi, "get_message_content", self._get_message_content
+        ), mock.patch.object(
+            LineBotApi, "reply_message"
+        ):
+            try:
+                return self._run()
+            finally:
+                image_convert_function.metrics.clear_metrics()
+                line_api_callback_function.metrics.clear_metrics()
+
+    def _run(self) -> HarnessReport:
+        self.s3 = boto3.client("s3")
+        self.sns = boto3.client("sns")
+        self.sqs = boto3.client("sqs")
+        self.s3.create_bucket(Bucket=self.input_bucket_name)
+        self.s3.create_bucket(Bucket=self.output_bucket_name)
+        if self.config.use_index:
+            self._create_index_table()
+        self.topic_arn = self.sns.create_topic(Name="harness")["TopicArn"]
+        queue_urls = {
+            variant: self._subscribe_queue(variant)
+            for variant in self.config.variants
+        }
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(queue_urls)) as executor:
+            consumers = [
+                executor.submit(self._consume, variant, queue_url)
+                for variant, queue_url in queue_urls.items()
+            ]
+            try:
+                self._deliver_webhooks()
+                with self._converted:
+                    if not self._converted.wait_for(
+                        lambda: not any(self._remaining.values()),
+                        timeout=self.config.timeout,
+                    ):
+                        logger.warning("timed out waiting for conversions")
+            finally:
+                self._done.set()
+                for consumer in consumers:
+                    consumer.result()
+        elapsed = time.monotonic() - started
+
+        return HarnessReport(
+            elapsed=elapsed,
+            webhooks=self.config.events,
+            images=self._images_done,
+            variants=self._variants_done,
+            failed=self._failed,
+            stages={
+                name: StageStats.from_samples(samples)
+                for name, samples in self._samples.items()
+            },
+        )
+
+    def _create_index_table(self) -> None:
+        bands = range(image_convert_function.PHASH_BANDS)
+        boto3.client("dynamodb").create_table(
+            TableName=self.index_table_name,
+            KeySchema=[
+                {"AttributeName": "UserId", "KeyType": "HASH"},
+                {"AttributeName": "ImageId", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "UserId", "AttributeType": "S"},
+                {"AttributeName": "ImageId", "AttributeType": "S"},
+                {"AttributeName": "Created", "AttributeType": "N"},
+            ]
+            + [
+                {"AttributeName": f"PHashBand{i}", "AttributeType": "S"}
+                for i in bands
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": "Created",
+                    "KeySchema": [
+                        {"AttributeName": "UserId", "KeyType": "HASH"},
+                        {"AttributeName": "Created", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+            ]
+            + [
+                {
+                    "IndexName": f"PHashBand{i}",
+                    "KeySchema": [
+                        {"AttributeName": f"PHashBand{i}", "KeyType": "HASH"}
+                    ],
+                    "Projection": {"ProjectionType": "KEYS_ONLY"},
+                }
+                for i in bands
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+    def _subscribe_queue(self, variant: str) -> str:
+        queue_url = self.sqs.create_queue(
+            QueueName=f"harness-{variant.replace('/', '-')}"
+        )["QueueUrl"]
+        queue_arn = self.sqs.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["QueueArn"]
+        )["Attributes"]["QueueArn"]
+        self.sns.subscribe(
+            TopicArn=self.topic_arn,
+            Protocol="sqs",
+            Endpoint=queue_arn,
+            Attributes={"RawMessageDelivery": "true"},
+        )
+        return queue_url
+
+    def _deliver_webhooks(self) -> None:
+        interval = 1.0 / self.config.rate if self.config.rate > 0 else 0.0
+        next_at = time.monotonic()
+        for i in range(self.config.events):
+            if interval:
+                time.sleep(max(next_at - time.monotonic(), 0.0))
+                next_at += interval
+            if self.random.random() < self.config.image_ratio:
+                self._deliver_image(str(1000000 + i))
+            else:
+                self._deliver(
+                    {
+                        "type": "text",
+                        "id": str(1000000 + i),
+                        "text": "harness",
+                    }
+                )
+
+    def _deliver_image(self, message_id: str) -> None:
+        self._contents[message_id] = self._image(self._pick_size())
+        user_id = self._deliver(
+            {
+                "type": "image",
+                "id": message_id,
+                "contentProvider": {"type": "line"},
+            }
+        )
+        key = f"original/{user_id}/L{message_id}"
+        with self._lock:
+            self._delivered[key] = time.monotonic()
+            self._remaining[key] = len(self.config.variants)
+
+        # stands in for the bucket notification
+        started = time.monotonic()
+        self.sns.publish(
+            TopicArn=self.topic_arn,
+            Message=json.dumps({"Records": [self._s3_record(key)]}),
+        )
+        self._sample("notification", time.monotonic() - started)
+
+    def _deliver(self, message: typing.Dict[str, typing.Any]) -> str:
+        user_id = f"U{self.random.randrange(16):032x}"
+        body = json.dumps(
+            {
+                "destination": "Uharness",
+                "events": [
+                    {
+                        "type": "message",
+                        "mode": "active",
+                        "timestamp": int(time.time() * 1000),
+                        "source": {"type": "user", "userId": user_id},
+                        "replyToken": "harness",
+                        "message": message,
+                    }
+                ],
+            }
+        )
+        event = {
+            "resource": "/callback",
+            "path": "/callback",
+            "httpMethod": "POST",
+            "headers": {
+                "Content-Type": "application/json",
+                "X-Line-Signature": sign(self.channel_secret, body),
+            },
+            "multiValueHeaders": {},
+            "queryStringParameters": None,
+            "multiValueQueryStringParameters": None,
+            "pathParameters": None,
+            "stageVariables": None,
+            "requestContext": {"httpMethod": "POST", "path": "/callback"},
+            "body": body,
+            "isBase64Encoded": False,
+        }
+
+        started = time.monotonic()
+        # the resolver rather than the handler, which would print the
+        # metrics of every delivery
+        response = line_api_callback_function.app.resolve(event, None)
+        self._sample(f"webhook.{message['type']}", time.monotonic() - started)
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"webhook rejected: {response}")
+        return user_id
+
+    def _consume(self, variant: str, queue_url: str) -> None:
+        format, resize = variant.split("/")
+        convert_processor = _TimedConvertProcessor(
+            image_convert_function.ConvertConfig(
+                bucket_name=self.output_bucket_name,
+                format=image_convert_function.parse_format(format),
+                resize=image_convert_function.parse_resize(resize),
+                index_table_name=(
+                    self.index_table_name if self.config.use_index else None
+                ),
+            ),
+            s3_client=self.s3,
+            sample=self._sample,
+        )
+        while True:
+            messages = self.sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=self.config.batch_size,
+                AttributeNames=["All"],
+            ).get("Messages", [])
+            if not messages:
+                if self._done.is_set():
+                    return
+                time.sleep(0.01)
+                continue
+
+            received = time.time()
+            for message in messages:
+                sent = int(message["Attributes"]["SentTimestamp"]) / 1000
+                self._sample("queue_age", max(received - sent, 0.0))
+
+            try:
+                response = convert_processor.process_records(
+                    [self._sqs_record(queue_url, m) for m in messages]
+                )
+                failed_ids = {
+                    failure["itemIdentifier"]
+                    for failure in response["batchItemFailures"]
+                }
+            except Exception:
+                # the batch processor raises only when every record failed
+                logger.exception("conversion failed for %s", variant)
+                failed_ids = {m["MessageId"] for m in messages}
+            completed = time.monotonic()
+
+            self.sqs.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]}
+                    for i, m in enumerate(messages)
+                ],
+            )
+            for message in messages:
+                key = json.loads(message["Body"])["Records"][0]["s3"]["object"][
+                    "key"
+                ]
+                self._complete(
+                    key, completed, message["MessageId"] in failed_ids
+                )
+
+    def _complete(self, key: str, completed: float, failed: bool) -> None:
+        with self._converted:
+            if failed:
+                self._failed += 1
+                self._failed_keys.add(key)
+            else:
+                self._variants_done += 1
+            self._remaining[key] -= 1
+            if self._remaining[key] == 0 and key not in self._failed_keys:
+                self._images_done += 1
+                self._samples.setdefault("end_to_end", []).append(
+                    completed - self._delivered[key]
+                )
+            self._converted.notify_all()
+
+    def _sample(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def _get_message_content(
+        self, message_id: str, timeout: typing.Any = None
+    ) -> _MessageContent:
+        return _MessageContent(self._contents.pop(message_id), "image/jpeg")
+
+    def _pick_size(self) -> typing.Tuple[int, int]:
+        sizes = list(self.config.image_sizes)
+        weights = [self.config.image_sizes[s] for s in sizes]
+        return self.random.choices(sizes, weights=weights)[0]
+
+    def _image(self, size: typing.Tuple[int, int]) -> bytes:
+        if size not in self._images:
+            with Image.effect_mandelbrot(
+                size, (-2.0, -1.2, 1.0, 1.2), 64
+            ) as image, BytesIO() as buf:
+                image.convert("RGB").save(buf, "JPEG", quality=90)
+                self._images[size] = buf.getvalue()
+        return self._images[size]
+
+    def _s3_record(self, key: str) -> typing.Dict[str, typing.Any]:
+        head_response = self.s3.head_object(
+            Bucket=self.input_bucket_name, Key=key
+        )
+        return {
+            "eventVersion": "2.1",
+            "eventSource": "aws:s3",
+            "awsRegion": "us-east-1",
+            "eventTime": datetime.now(timezone.utc).isoformat(),
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "s3SchemaVersion": "1.0",
+                "bucket": {
+                    "name": self.input_bucket_name,
+                    "arn": f"arn:aws:s3:::{self.input_bucket_name}",
+                },
+                "object": {
+                    "key": key,
+                    "size": head_response["ContentLength"],
+                    "eTag": head_response["ETag"].strip('"'),
+                },
+            },
+        }
+
+    def _sqs_record(
+        self, queue_url: str, message: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "messageId": message["MessageId"],
+            "receiptHandle": message["ReceiptHandle"],
+            "body": message["Body"],
+            "attributes": message["Attributes"],
+            "messageAttributes": {},
+            "md5OfBody": message["MD5OfBody"],
+            "eventSource": "aws:sqs",
+            "eventSourceARN": f"arn:aws:sqs:us-east-1:123456789012:"
+            f"{queue_url.rsplit('/', 1)[-1]}",
+            "awsRegion": "us-east-1",
+        }
+
+
+def _percentile(ordered: typing.Sequence[float], percent: int) -> float:
+    """Nearest-rank percentile of already sorted samples."""
+    if not ordered:
+        return 0.0
+    rank = max(0, -(-percent * len(ordered) // 100) - 1)
+    return ordered[rank]
+
+
+def _parse_image_size(
+    value: str,
+) -> typing.Tuple[typing.Tuple[int, int], float]:
+    size, _, weight = value.partition(":")
+    width, height = size.lower().split("x")
+    return (int(width), int(height)), float(weight or 1)
+
+
+def parse_args(
+    argv: typing.Optional[typing.Sequence[str]] = None,
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline locally against moto and report "
+        "latency per stage.",
+    )
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="webhook deliveries per second (default: back to back)",
+    )
+    parser.add_argument(
+        "--image-ratio",
+        type=float,
+        default=0.8,
+        help="share of image messages, the rest are text",
+    )
+    parser.add_argument(
+        "--image-size",
+        action="append",
+        type=_parse_image_size,
+        default=None,
+        metavar="WxH[:WEIGHT]",
+        help="image size to generate, repeat for a mix",
+    )
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=None,
+        metavar="FORMAT/RESIZE",
+        help=f"variant to convert, repeat for more "
+        f"(default: {' '.join(DEFAULT_VARIANTS)})",
+    )
+    parser.add_argument("--no-index", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+    config = HarnessConfig(
+        events=args.events,
+        rate=args.rate,
+        image_ratio=args.image_ratio,
+        use_index=not args.no_index,
+        seed=args.seed,
+    )
+    if args.image_size:
+        config.image_sizes = dict(args.image_size)
+    if args.variant:
+        config.variants = args.variant
+    report = PipelineHarness(config).run()
+    print(report.format())
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
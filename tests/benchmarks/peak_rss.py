@@ -0,0 +1,42 @@
+"""Peak RSS of one conversion, in a process of its own.
+
+Run as `python -m tests.benchmarks.peak_rss VARIABLES < image`, with the
+variables of a `ConvertProps` as JSON. Prints how far the conversion raised
+the peak resident set size over the loaded function, in bytes. Only the
+function is imported, as in its Lambda runtime; the CDK would dwarf it.
+"""
+import json
+import sys
+from io import BytesIO
+
+from multilens.constructs.image_convert_function.index import (
+    ImageConvertProcessor,
+    config_from_environ,
+)
+
+
+def max_rss() -> int:
+    # the high water mark of this process alone: Linux carries ru_maxrss of
+    # the forking parent, pytest with the CDK, over to the executed program
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("requires Linux")
+
+
+def main() -> None:
+    environ = json.loads(sys.argv[1])
+    data = sys.stdin.buffer.read()
+    processor = ImageConvertProcessor(
+        config_from_environ({**environ, "BUCKET_NAME": "benchmark"})
+    )
+    before = max_rss()
+    processor.convert_image(
+        BytesIO(data), {"userid": "user", "imageid": "image"}
+    )
+    print(max_rss() - before)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""Conversion time and output size of every default variant over a corpus.
+
+Not collected by default, run with `make benchmark` or
+`pytest tests/benchmarks`. The vips engine is held to the output of the
+Pillow one rather than to baselines of its own. Timings are collected by
+pytest-benchmark, with the time of each stage of the conversion in
+extra_info; compare them between runs with `--benchmark-autosave` and
+`--benchmark-compare-fail=mean:25%`. Output bytes and peak RSS are
+deterministic enough to be checked against baselines.json here. After an
+intended change, regenerate it with MULTILENS_UPDATE_BASELINES=1.
+"""
+import dataclasses
+import functools
+import json
+import os
+import subprocess
+import sys
+import time
+import typing
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from multilens.constructs.image_convert import (
+    DEFAULT_CONVERT_PROPS,
+    ConvertProps,
+)
+from multilens.constructs.image_convert_function.index import (
+    ConvertConfig,
+    Engine,
+    ImageConvertProcessor,
+    config_from_environ,
+    pyvips,
+    ssim,
+)
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+UPDATE_BASELINES = bool(os.getenv("MULTILENS_UPDATE_BASELINES"))
+# output bytes may move either way, both can be a regression
+BYTES_TOLERANCE = 0.1
+PEAK_RSS_TOLERANCE = 0.25
+# allocator noise, against the variants that barely raise the peak
+PEAK_RSS_SLACK = 1024 * 1024
+# the engines resample and encode a little differently
+PARITY_BYTES_TOLERANCE = 0.35
+PARITY_MIN_SSIM = 0.9
+
+# name -> (mode, source format, size)
+CORPUS = {
+    "rgb_jpeg_1600": ("RGB", "JPEG", (1600, 1200)),
+    "rgb_webp_800": ("RGB", "WEBP", (800, 600)),
+    "rgba_png_800": ("RGBA", "PNG", (800, 600)),
+    "p_gif_640": ("P", "GIF", (640, 480)),
+    "l_png_640": ("L", "PNG", (640, 480)),
+    "cmyk_jpeg_800": ("CMYK", "JPEG", (800, 600)),
+}
+
+
+def generate_image(
+    mode: str, format: str, size: typing.Tuple[int, int]
+) -> bytes:
+    """Deterministic photo-like test image, with detail and smooth areas."""
+    fractal = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 64)
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge(
+        "RGB",
+        (fractal, gradient, gradient.transpose(Image.Transpose.ROTATE_180)),
+    )
+    if mode == "RGBA":
+        image.putalpha(
+            gradient.transpose(Image.Transpose.ROTATE_90).resize(size)
+        )
+    elif mode == "P":
+        image = image.quantize(colors=64)
+    else:
+        image = image.convert(mode)
+    with BytesIO() as buf:
+        image.save(buf, format)
+        return buf.getvalue()
+
+
+@pytest.fixture(scope="module")
+def corpus() -> typing.Dict[str, bytes]:
+    return {name: generate_image(*params) for name, params in CORPUS.items()}
+
+
+@pytest.fixture(scope="module")
+def baselines() -> typing.Iterator[typing.Dict[str, typing.Dict[str, int]]]:
+    baselines = (
+        json.loads(BASELINES_PATH.read_text())
+        if BASELINES_PATH.exists()
+        else {}
+    )
+    yield baselines
+    if UPDATE_BASELINES:
+        BASELINES_PATH.write_text(
+            json.dumps(baselines, indent=2, sort_keys=True) + "\n"
+        )
+
+
+def convert_config(props: ConvertProps, **kwargs) -> ConvertConfig:
+    # as the variant's function configures itself
+    config = config_from_environ(
+        {**props.environment(), "BUCKET_NAME": "benchmark"}
+    )
+    return dataclasses.replace(config, **kwargs)
+
+
+def stage_timings(
+    processor: ImageConvertProcessor,
+    data: bytes,
+    metadata: typing.Dict[str, str],
+) -> typing.Dict[str, float]:
+    """Time of each stage of one convert_image of `processor`.
+
+    Decoding and shrinking are one stage, the engines shrink while they
+    decode.
+    """
+    timings: typing.Dict[str, float] = {}
+
+    def timed(name: str, func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[name] = time.perf_counter() - started
+
+        return wrapper
+
+    with mock.patch.object(
+        processor.engine, "load", timed("load", processor.engine.load)
+    ), mock.patch.object(
+        processor,
+        "_image_features",
+        timed("features", processor._image_features),
+    ), mock.patch.object(
+        processor, "_encode", timed("encode", processor._encode)
+    ):
+        processor.convert_image(BytesIO(data), metadata)
+    return timings
+
+
+def peak_rss(props: ConvertProps, data: bytes) -> int:
+    """How far one conversion raises the peak RSS of a fresh process."""
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "tests.benchmarks.peak_rss",
+            json.dumps(props.environment()),
+        ],
+        input=data,
+        capture_output=True,
+        check=True,
+        cwd=Path(__file__).parents[2],
+    )
+    return int(completed.stdout)
+
+
+@pytest.mark.parametrize("name", list(CORPUS))
+@pytest.mark.parametrize(
+    "props", DEFAULT_CONVERT_PROPS, ids=lambda p: p.variant_name()
+)
+def test_convert(
+    benchmark,
+    corpus: typing.Dict[str, bytes],
+    baselines: typing.Dict[str, typing.Dict[str, int]],
+    props: ConvertProps,
+    name: str,
+) -> None:
+    processor = ImageConvertProcessor(convert_config(props))
+    data = corpus[name]
+    metadata = {"userid": "user", "imageid": name}
+
+    def convert() -> int:
+        return len(processor.convert_image(BytesIO(data), metadata).body)
+
+    output_bytes = benchmark.pedantic(convert, rounds=3, warmup_rounds=1)
+    rss = peak_rss(props, data)
+
+    benchmark.extra_info.update(stage_timings(processor, data, metadata))
+    benchmark.extra_info["output_bytes"] = output_bytes
+    benchmark.extra_info["peak_rss"] = rss
+
+    key = f"{props.variant_name()} {name}"
+    if UPDATE_BASELINES:
+        baselines[key] = {"bytes": output_bytes, "peak_rss": rss}
+        return
+    assert key in baselines, f"no baseline for {key}"
+    baseline = baselines[key]
+    assert output_bytes == pytest.approx(
+        baseline["bytes"], rel=BYTES_TOLERANCE
+    ), f"{key}: output bytes drifted from {baseline['bytes']}"
+    assert (
+        rss <= baseline["peak_rss"] * (1 + PEAK_RSS_TOLERANCE) + PEAK_RSS_SLACK
+    ), f"{key}: peak RSS grew from {baseline['peak_rss']}"
+
+
+@pytest.mark.skipif(pyvips is None, reason="requires pyvips and libvips")
+@pytest.mark.parametrize("name", list(CORPUS))
+@pytest.mark.parametrize(
+    "props", DEFAULT_CONVERT_PROPS, ids=lambda p: p.variant_name()
+)
+def test_engine_parity(
+    benchmark,
+    corpus: typing.Dict[str, bytes],
+    props: ConvertProps,
+    name: str,
+) -> None:
+    data = corpus[name]
+    metadata = {"userid": "user", "imageid": name}
+    processors = {
+        engine: ImageConvertProcessor(convert_config(props, engine=engine))
+        for engine in Engine
+    }
+    results = {
+        engine: processor.convert_image(BytesIO(data), metadata)
+        for engine, processor in processors.items()
+    }
+    benchmark.pedantic(
+        lambda: processors[Engine.VIPS].convert_image(BytesIO(data), metadata),
+        rounds=3,
+        warmup_rounds=1,
+    )
+
+    expected, actual = results[Engine.PILLOW], results[Engine.VIPS]
+    assert actual.content_type == expected.content_type
+    assert (actual.source_width, actual.source_height) == (
+        expected.source_width,
+        expected.source_height,
+    )
+    assert abs(actual.width - expected.width) <= 1
+    assert abs(actual.height - expected.height) <= 1
+    assert len(actual.body) == pytest.approx(
+        len(expected.body), rel=PARITY_BYTES_TOLERANCE
+    )
+    with Image.open(BytesIO(expected.body)) as a, Image.open(
+        BytesIO(actual.body)
+    ) as b:
+        assert ssim(a, b.resize(a.size)) >= PARITY_MIN_SSIM
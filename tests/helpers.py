@@ -6,7 +6,7 @@ import typing
 import boto3
 import pytest
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from moto import mock_s3
+from moto import mock_dynamodb, mock_s3
 
 
 def ignore_template_assets(
@@ -14,6 +14,9 @@ def ignore_template_assets(
 ) -> typing.Mapping[str, typing.Any]:
     template = copy.deepcopy(template_json)
     for resource in template["Resources"].values():
+        if resource["Type"] == "AWS::Lambda::LayerVersion":
+            resource["Properties"]["Content"] = {}
+            continue
         if "Code" not in resource.get("Properties", {}):
             # not target
             continue
@@ -49,6 +52,57 @@ class AwsTestClass:
             s3 = boto3.client("s3")
             yield s3
 
+    @pytest.fixture
+    def dynamodb(self, aws_credentials) -> typing.Any:
+        with mock_dynamodb():
+            dynamodb = boto3.resource("dynamodb")
+            yield dynamodb
+
+    @pytest.fixture
+    def index_table_name(self, dynamodb) -> str:
+        table_name = "test-index-table"
+        dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": "UserId", "KeyType": "HASH"},
+                {"AttributeName": "ImageId", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "UserId", "AttributeType": "S"},
+                {"AttributeName": "ImageId", "AttributeType": "S"},
+                {"AttributeName": "Created", "AttributeType": "N"},
+            ]
+            + [
+                {"AttributeName": f"PHashBand{i}", "AttributeType": "S"}
+                for i in range(4)
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": "Created",
+                    "KeySchema": [
+                        {"AttributeName": "UserId", "KeyType": "HASH"},
+                        {"AttributeName": "Created", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+            ]
+            + [
+                {
+                    "IndexName": f"PHashBand{i}",
+                    "KeySchema": [
+                        {"AttributeName": f"PHashBand{i}", "KeyType": "HASH"}
+                    ],
+                    "Projection": {
+                        "ProjectionType": "INCLUDE",
+                        "NonKeyAttributes": ["PHash"],
+                    },
+                }
+                for i in range(4)
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        return table_name
+
     @pytest.fixture
     def lambda_context(self) -> LambdaContext:
         return MockLambdaContext()
@@ -7,7 +7,8 @@ import pytest
 from aws_cdk import aws_s3 as s3
 from pytest_snapshot.plugin import Snapshot
 
-from multilens.constructs.image_convert import ImageConvert
+from multilens.constructs.image_convert import ConvertProps, ImageConvert
+from multilens.constructs.image_index import ImageIndex
 from tests.helpers import ignore_template_assets
 
 
@@ -31,14 +32,20 @@ class TestImageConvert:
         self, snapshot: Snapshot, app: cdk.App, env: cdk.Environment
     ) -> None:
         stack = cdk.Stack(app, "Test", env=env)
+        image_index = ImageIndex(stack, "ImageIndex")
         ImageConvert(
             stack,
             "ImageConvert",
             use_sqs=True,
+            index_table=image_index.table,
+            use_cdn=True,
             input_bucket_props=s3.BucketProps(),
             output_bucket_props=s3.BucketProps(),
-            lambda_log_level="DEBUG",
+            lambda_log_level="INFO",
+            lambda_log_sample_rate=0.01,
             lambda_sentry_dsn="https://sentry.example.com",
+            lambda_traces_sample_rate=0.05,
+            lambda_traces_slow_ms=2000,
         )
         template_json = ignore_template_assets(
             assertions.Template.from_stack(stack).to_json()
@@ -70,3 +77,312 @@ class TestImageConvert:
             json.dumps(template_json, indent=2),
             "convert_image_minimal_resource.json",
         )
+
+    def test_cdn(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_convert = ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            use_cdn=True,
+        )
+        template = assertions.Template.from_stack(stack)
+
+        assert image_convert.distribution is not None
+        template.resource_count_is("AWS::CloudFront::Distribution", 1)
+        template.resource_count_is(
+            "AWS::CloudFront::CloudFrontOriginAccessIdentity", 1
+        )
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "APP_CACHE_CONTROL": "public, max-age=86400",
+                        }
+                    )
+                }
+            },
+        )
+
+    def test_no_cdn(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_convert = ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+        )
+        template = assertions.Template.from_stack(stack)
+
+        assert image_convert.distribution is None
+        template.resource_count_is("AWS::CloudFront::Distribution", 0)
+
+    def test_failure_queue_sqs(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_convert = ImageConvert(
+            stack,
+            "ImageConvert",
+            use_sqs=True,
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            convert_props=[ConvertProps(format="jpeg", resize="400")],
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::Lambda::EventSourceMapping",
+            {"FunctionResponseTypes": ["ReportBatchItemFailures"]},
+        )
+        assert list(image_convert.dead_letter_queues) == ["jpeg/400"]
+        template.has_resource_properties(
+            "AWS::SQS::Queue",
+            {
+                "RedrivePolicy": {
+                    "deadLetterTargetArn": stack.resolve(
+                        image_convert.dead_letter_queues["jpeg/400"].queue_arn
+                    ),
+                    "maxReceiveCount": 3,
+                }
+            },
+        )
+        assert image_convert.failure_queue is None
+        assert image_convert.invocation_failure_queue is None
+
+    def test_failure_queue_direct(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_convert = ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            convert_props=[ConvertProps(format="jpeg", resize="400")],
+        )
+        template = assertions.Template.from_stack(stack)
+
+        assert image_convert.failure_queue is not None
+        assert image_convert.invocation_failure_queue is not None
+        assert image_convert.dead_letter_queues == {}
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "APP_FAILURE_QUEUE_URL": stack.resolve(
+                                image_convert.failure_queue.queue_url
+                            ),
+                        }
+                    )
+                }
+            },
+        )
+        template.has_resource_properties(
+            "AWS::Lambda::EventInvokeConfig",
+            {
+                "DestinationConfig": {
+                    "OnFailure": {
+                        "Destination": stack.resolve(
+                            image_convert.invocation_failure_queue.queue_arn
+                        )
+                    }
+                }
+            },
+        )
+
+    def test_pack(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_index = ImageIndex(stack, "ImageIndex")
+        ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            index_table=image_index.table,
+            convert_props=[
+                ConvertProps(format="jpeg", resize="400", pack=True)
+            ],
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {"APP_PACK": "True"}
+                    )
+                }
+            },
+        )
+        template.has_resource_properties(
+            "AWS::S3::Bucket",
+            {
+                "LifecycleConfiguration": {
+                    "Rules": [
+                        assertions.Match.object_like(
+                            {
+                                "Prefix": "packs/",
+                                "TagFilters": [
+                                    {
+                                        "Key": "multilens:compacted",
+                                        "Value": "true",
+                                    }
+                                ],
+                                "ExpirationInDays": 1,
+                            }
+                        )
+                    ]
+                }
+            },
+        )
+
+    def test_pack_requires_index(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        with pytest.raises(ValueError):
+            ImageConvert(
+                stack,
+                "ImageConvert",
+                input_bucket_props=s3.BucketProps(),
+                output_bucket_props=s3.BucketProps(),
+                convert_props=[
+                    ConvertProps(format="jpeg", resize="400", pack=True)
+                ],
+            )
+
+    def test_profiling(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        profile_bucket = s3.Bucket(stack, "ProfileBucket")
+        ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            convert_props=[ConvertProps(format="jpeg", resize="400")],
+            lambda_profile_sample_rate=0.01,
+            profile_bucket=profile_bucket,
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "APP_PROFILE_SAMPLE_RATE": "0.01",
+                            "APP_PROFILE_BUCKET": stack.resolve(
+                                profile_bucket.bucket_name
+                            ),
+                            "APP_PROFILE_PREFIX": (
+                                "profiles/ImageConvert/jpeg_400/"
+                            ),
+                        }
+                    )
+                }
+            },
+        )
+
+    def test_profiling_requires_bucket(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        with pytest.raises(ValueError):
+            ImageConvert(
+                stack,
+                "ImageConvert",
+                input_bucket_props=s3.BucketProps(),
+                output_bucket_props=s3.BucketProps(),
+                lambda_profile_sample_rate=0.01,
+            )
+
+    def test_on_demand(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_convert = ImageConvert(
+            stack,
+            "ImageConvert",
+            input_bucket_props=s3.BucketProps(),
+            output_bucket_props=s3.BucketProps(),
+            use_cdn=True,
+            convert_props=[ConvertProps(format="jpeg", resize="400")],
+            on_demand_props=[
+                ConvertProps(format="webp", resize="original"),
+                ConvertProps(format="webp", resize="400", engine="vips"),
+            ],
+        )
+        template = assertions.Template.from_stack(stack)
+
+        assert image_convert.render_api is not None
+        assert image_convert.render_function is not None
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Handler": "index.render_handler",
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "APP_RENDER_VARIANTS": json.dumps(
+                                {
+                                    "webp/original": ConvertProps(
+                                        format="webp", resize="original"
+                                    ).environment(),
+                                    "webp/400": ConvertProps(
+                                        format="webp",
+                                        resize="400",
+                                        engine="vips",
+                                    ).environment(),
+                                }
+                            )
+                        }
+                    )
+                },
+            },
+        )
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Handler": "index.lambda_handler",
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {"APP_FORMAT": "jpeg", "APP_RESIZE": "400"}
+                    )
+                },
+            },
+        )
+        template.has_resource_properties(
+            "AWS::DynamoDB::Table",
+            {"TimeToLiveSpecification": {"AttributeName": "ExpiresAt"}},
+        )
+        template.has_resource_properties(
+            "AWS::CloudFront::Distribution",
+            {
+                "DistributionConfig": assertions.Match.object_like(
+                    {
+                        "OriginGroups": assertions.Match.object_like(
+                            {"Quantity": 1}
+                        )
+                    }
+                )
+            },
+        )
+
+    def test_on_demand_pack(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        with pytest.raises(ValueError):
+            ImageConvert(
+                stack,
+                "ImageConvert",
+                input_bucket_props=s3.BucketProps(),
+                output_bucket_props=s3.BucketProps(),
+                on_demand_props=[
+                    ConvertProps(format="webp", resize="400", pack=True)
+                ],
+            )
@@ -1,114 +1,1523 @@
 import json
 import os
+import struct
 import typing
+import urllib.parse
 from hashlib import md5
 from io import SEEK_SET, BytesIO
+from types import SimpleNamespace
 
 import pytest
+from aws_lambda_powertools.utilities.batch.exceptions import (
+    BatchProcessingError,
+)
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from PIL import Image
+from PIL import Image, ImageCms, ImageOps, ImageSequence
 from pytest_mock import MockerFixture
 
-from multilens.constructs.image_convert_function.index import (
-    ConvertConfig,
-    Format,
-    ImageConvertProcessor,
-    SnsImageConvertProcessor,
-    SqsImageConvertProcessor,
-    lambda_handler,
-)
-from tests.helpers import AwsTestClass
+from multilens.constructs.image_convert import ConvertProps
+from multilens.constructs.image_convert_function.index import (
+    AnimationFallback,
+    ConvertConfig,
+    ConvertResult,
+    Engine,
+    ExifPolicy,
+    Format,
+    IccPolicy,
+    ImageConvertProcessor,
+    ImageIndex,
+    ImageNotFoundError,
+    ImageRenderer,
+    KeyLayout,
+    PackEntry,
+    RenderLock,
+    RenderTimeoutError,
+    SequenceTable,
+    SnsImageConvertProcessor,
+    SqsImageConvertProcessor,
+    SupersededError,
+    blurhash,
+    create_s3_client,
+    decode_pack_index,
+    dhash,
+    dominant_color,
+    encode_adaptive,
+    encode_pack_segment,
+    get_renderer,
+    lambda_handler,
+    metrics,
+    parse_jpeg_header,
+    phash_bands,
+    pyvips,
+    read_pack_index,
+    render_handler,
+    ssim,
+    variant_key,
+)
+from tests.helpers import AwsTestClass
+
+
+def animated_gif(frames: int = 10, duration: int = 40) -> bytes:
+    images = []
+    for i in range(frames):
+        image = Image.new("RGB", (200, 100), (0, 0, 0))
+        # a moving square, drawn onto the frames before
+        image.paste((255, 255 - i * 20, 0), (i * 15, 20, i * 15 + 30, 50))
+        images.append(image)
+    with BytesIO() as buf:
+        images[0].save(
+            buf,
+            "GIF",
+            save_all=True,
+            append_images=images[1:],
+            duration=duration,
+            loop=0,
+        )
+        return buf.getvalue()
+
+
+def frame_durations(data: bytes) -> typing.List[int]:
+    durations = []
+    with Image.open(BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            # WebP sets the duration of a frame once it is decoded
+            frame.load()
+            durations.append(frame.info["duration"])
+    return durations
+
+
+def jpeg_with_thumbnail(
+    size: typing.Tuple[int, int],
+    thumbnail_size: typing.Tuple[int, int],
+    orientation: int = 1,
+) -> bytes:
+    """A JPEG with an EXIF thumbnail (IFD1) of a different color."""
+    with Image.new(
+        "RGB", thumbnail_size, (255, 0, 0)
+    ) as thumbnail, BytesIO() as buf:
+        thumbnail.save(buf, "JPEG")
+        thumbnail_data = buf.getvalue()
+    # little endian TIFF: IFD0 with the orientation, if any, followed by
+    # IFD1 holding the offset and length of the thumbnail
+    ifd0 = [struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0)]
+    if orientation == 1:
+        ifd0 = []
+    ifd1_offset = 8 + 2 + 12 * len(ifd0) + 4
+    tiff = (
+        b"II*\x00"
+        + struct.pack("<IH", 8, len(ifd0))
+        + b"".join(ifd0)
+        + struct.pack("<I", ifd1_offset)
+        + struct.pack("<H", 2)
+        + struct.pack("<HHII", 0x0201, 4, 1, ifd1_offset + 30)
+        + struct.pack("<HHII", 0x0202, 4, 1, len(thumbnail_data))
+        + struct.pack("<I", 0)
+        + thumbnail_data
+    )
+    app1 = b"Exif\x00\x00" + tiff
+    with Image.new("RGB", size, (0, 0, 255)) as image, BytesIO() as buf:
+        image.save(buf, "JPEG")
+        data = buf.getvalue()
+    return (
+        data[:2]
+        + b"\xff\xe1"
+        + struct.pack(">H", len(app1) + 2)
+        + app1
+        + data[2:]
+    )
+
+
+SRGB_PROFILE = ImageCms.ImageCmsProfile(
+    ImageCms.createProfile("sRGB")
+).tobytes()
+
+
+def swapped_profile() -> bytes:
+    """The sRGB profile with the red and blue primaries swapped."""
+    profile = bytearray(SRGB_PROFILE)
+    (count,) = struct.unpack(">I", profile[128:132])
+    tags = {
+        bytes(profile[132 + 12 * i : 136 + 12 * i]): 132 + 12 * i
+        for i in range(count)
+    }
+    r, b = tags[b"rXYZ"], tags[b"bXYZ"]
+    profile[r + 4 : r + 12], profile[b + 4 : b + 12] = (
+        profile[b + 4 : b + 12],
+        profile[r + 4 : r + 12],
+    )
+    return bytes(profile)
+
+
+def jpeg_with_metadata(
+    icc_profile: bytes = SRGB_PROFILE, orientation: int = 6
+) -> bytes:
+    """A 200x100 JPEG, red on the left and blue on the right, with EXIF
+    (orientation and GPS), an ICC profile and XMP."""
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x010F] = "Camera"
+    gps = exif.get_ifd(0x8825)
+    gps[1] = "N"
+    gps[2] = (35.0, 40.0, 0.0)
+    with Image.new("RGB", (200, 100), (0, 0, 255)) as image, BytesIO() as buf:
+        image.paste((255, 0, 0), (0, 0, 100, 100))
+        image.save(
+            buf,
+            "JPEG",
+            exif=exif.tobytes(),
+            icc_profile=icc_profile,
+            xmp=b"<x:xmpmeta/>" * 100,
+        )
+        return buf.getvalue()
+
+
+class TestImageConvertProcessor(AwsTestClass):
+    @pytest.fixture
+    def s3_record(self, s3_client) -> typing.Dict[str, typing.Any]:
+        bucket_name = "test-input-bucket"
+        object_key = "test/image.jpeg"
+        s3_client.create_bucket(Bucket=bucket_name)
+        with Image.new(
+            mode="RGB", size=(200, 200), color=(0, 0, 0)
+        ) as image, BytesIO() as buf:
+            image.save(buf, "JPEG")
+            buf.seek(SEEK_SET)
+            s3_client.upload_fileobj(
+                Bucket=bucket_name,
+                Key=object_key,
+                Fileobj=buf,
+                ExtraArgs={
+                    "ContentType": "image/jpeg",
+                },
+            )
+        s3_record = {
+            "eventVersion": "2.1",
+            "eventSource": "aws:s3",
+            "awsRegion": "us-east-1",
+            "eventTime": "2022-01-01T00:00:00.000Z",
+            "eventName": "ObjectCreated:Put",
+            "userIdentity": {"principalId": "AWS:XXXXXXXXXXXXXXXXXXXXX"},
+            "requestParameters": {"sourceIPAddress": "192.168.1.1"},
+            "responseElements": {
+                "x-amz-request-id": "XXXXXXXXXXXXXXXX",
+                "x-amz-id-2": "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx/xxxxxxxxxxxxxxxxxxxxxxxx/xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx/",
+            },
+            "s3": {
+                "s3SchemaVersion": "1.0",
+                "configurationId": "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+                "bucket": {
+                    "name": bucket_name,
+                    "ownerIdentity": {"principalId": "XXXXXXXXXXXXXX"},
+                    "arn": f"arn:aws:s3:::{bucket_name}",
+                },
+                "object": {
+                    "key": object_key,
+                    "size": 200000,
+                    "eTag": s3_client.head_object(
+                        Bucket=bucket_name, Key=object_key
+                    )["ETag"].strip('"'),
+                    "sequencer": "0061CA8F155D6048ED",
+                },
+            },
+        }
+        return s3_record
+
+    @pytest.fixture
+    def output_bucket_name(self, s3_client) -> str:
+        bucket_name = "test-output-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        return bucket_name
+
+    @pytest.fixture
+    def target(self) -> typing.Type[ImageConvertProcessor]:
+        return ImageConvertProcessor
+
+    def test_process_records(
+        self, target: typing.Type[ImageConvertProcessor]
+    ) -> None:
+        processor = target(ConvertConfig(bucket_name="test"))
+        with pytest.raises(NotImplementedError):
+            processor.process_records([])
+
+    @pytest.mark.parametrize(
+        ("format", "resize"),
+        [
+            (None, None),
+            (Format.WEBP, 400),
+        ],
+    )
+    def test_process_s3_records(
+        self,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+        format: typing.Optional[Format],
+        resize: typing.Optional[int],
+    ) -> None:
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=format,
+                resize=resize,
+            )
+        )
+        processor._process_s3_records([s3_record])
+
+    @pytest.mark.parametrize(
+        ("previews", "converted"),
+        [("jpeg/400", False), ("webp/400", True)],
+    )
+    def test_process_s3_records_previews(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+        previews: str,
+        converted: bool,
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={"ImageId": "L1", "Previews": previews},
+            MetadataDirective="REPLACE",
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.JPEG,
+                resize=400,
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+
+        objects = s3_client.list_objects_v2(Bucket=output_bucket_name)
+        assert ("Contents" in objects) == converted
+
+    def test_process_s3_records_overwritten(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=b"new")
+        processor = target(ConvertConfig(bucket_name=output_bucket_name))
+        metrics.clear_metrics()
+
+        assert processor._process_s3_records([s3_record]) == []
+
+        assert "Contents" not in s3_client.list_objects_v2(
+            Bucket=output_bucket_name
+        )
+        assert metrics.metric_set["SupersededEvents"]["Value"] == [1]
+        metrics.clear_metrics()
+
+    def test_process_s3_records_sequence(
+        self,
+        s3_client: typing.Any,
+        dynamodb: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={"UserId": "user", "ImageId": "L1"},
+            MetadataDirective="REPLACE",
+        )
+        dynamodb.create_table(
+            TableName="test-sequence-table",
+            KeySchema=[{"AttributeName": "Key", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "Key", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                sequence_table_name="test-sequence-table",
+            )
+        )
+        # a later event of the same key was converted first
+        processor.sequences.claim(  # type: ignore
+            "original/original/user/L1", "0061CA8F155D6049"
+        )
+
+        assert processor._process_s3_records([s3_record]) == []
+        assert "Contents" not in s3_client.list_objects_v2(
+            Bucket=output_bucket_name
+        )
+
+        s3_record["s3"]["object"]["sequencer"] = "0061CA8F155D604A00"
+        assert processor._process_s3_records([s3_record]) == []
+        assert "Contents" in s3_client.list_objects_v2(
+            Bucket=output_bucket_name
+        )
+
+    def test_convert_object_if_match(
+        self,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        processor = target(ConvertConfig(bucket_name=output_bucket_name))
+
+        with pytest.raises(SupersededError):
+            processor.convert_object(
+                s3_record["s3"]["bucket"]["name"],
+                s3_record["s3"]["object"]["key"],
+                {},
+                etag='"0123456789abcdef0123456789abcdef"',
+            )
+
+    def test_process_s3_records_latency_metrics(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={
+                "Created": "1640962800.0",
+                "Ingested": "1640962801.0",
+            },
+            MetadataDirective="REPLACE",
+        )
+        processor = target(ConvertConfig(bucket_name=output_bucket_name))
+        metrics.clear_metrics()
+
+        processor._process_s3_records([s3_record])
+
+        assert sorted(metrics.metric_set) == [
+            "ConversionDuration",
+            "DeliveryLatency",
+            "EndToEndLatency",
+        ]
+        end_to_end = metrics.metric_set["EndToEndLatency"]
+        assert end_to_end["Unit"] == "Milliseconds"
+        delivery = metrics.metric_set["DeliveryLatency"]
+        assert end_to_end["Value"][0] > delivery["Value"][0]
+        metrics.clear_metrics()
+
+    def test_process_s3_records_cache_control(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.JPEG,
+                cache_control="public, max-age=86400",
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+
+        response = s3_client.list_objects_v2(Bucket=output_bucket_name)
+        head_response = s3_client.head_object(
+            Bucket=output_bucket_name,
+            Key=response["Contents"][0]["Key"],
+        )
+        assert head_response["CacheControl"] == "public, max-age=86400"
+
+    def test_process_s3_records_with_index(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={
+                "UserId": "user",
+                "ImageId": "L1",
+                "Created": "1640962800.0",
+            },
+            MetadataDirective="REPLACE",
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.WEBP,
+                resize=100,
+                index_table_name=index_table_name,
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+        processor.flush()
+
+        item = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L1"}
+        )["Item"]
+        assert item["Width"] == 200
+        assert item["Created"] == 1640962800000
+        variant = item["Variants"]["webp/100"]
+        assert variant["Key"] == "webp/100/user/L1"
+        assert variant["ContentType"] == "image/webp"
+        assert (variant["Width"], variant["Height"]) == (100, 100)
+        assert variant["Bytes"] > 0
+        assert "Quality" not in variant
+        assert "PHash" not in item
+
+    def test_process_s3_records_adaptive(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={"UserId": "user", "ImageId": "L1"},
+            MetadataDirective="REPLACE",
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.AUTO,
+                resize=100,
+                index_table_name=index_table_name,
+                min_ssim=0.9,
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+        processor.flush()
+
+        variant = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L1"}
+        )["Item"]["Variants"]["auto/100"]
+        assert variant["Key"] == "auto/100/user/L1"
+        assert variant["ContentType"] in ("image/jpeg", "image/webp")
+        assert 30 <= variant["Quality"] <= 95
+        head_response = s3_client.head_object(
+            Bucket=output_bucket_name,
+            Key="auto/100/user/L1",
+        )
+        assert head_response["ContentType"] == variant["ContentType"]
+
+    def test_process_s3_records_image_features(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        target: typing.Type[ImageConvertProcessor],
+    ) -> None:
+        bucket_name = s3_record["s3"]["bucket"]["name"]
+        object_key = s3_record["s3"]["object"]["key"]
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            Metadata={"UserId": "user", "ImageId": "L1"},
+            MetadataDirective="REPLACE",
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.JPEG,
+                resize=100,
+                index_table_name=index_table_name,
+                image_features=True,
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+        processor.flush()
+
+        item = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L1"}
+        )["Item"]
+        assert len(item["PHash"]) == 16
+        assert item["PHashBand0"] == f"user:{item['PHash'][:4]}"
+        assert item["PHashBand3"] == f"user:{item['PHash'][12:]}"
+        head_response = s3_client.head_object(
+            Bucket=output_bucket_name,
+            Key="jpeg/100/user/L1",
+        )
+        assert head_response["Metadata"]["phash"] == item["PHash"]
+        assert len(item["BlurHash"]) == 28
+        assert head_response["Metadata"]["blurhash"] == item["BlurHash"]
+        assert item["DominantColor"].startswith("#")
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    def test_process_s3_records_engine(
+        self,
+        s3_client: typing.Any,
+        s3_record: typing.Dict[str, typing.Any],
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+        engine: Engine,
+    ) -> None:
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.WEBP,
+                resize=100,
+                image_features=True,
+                engine=engine,
+            )
+        )
+
+        processor._process_s3_records([s3_record])
+
+        objects = s3_client.list_objects_v2(Bucket=output_bucket_name)
+        key = objects["Contents"][0]["Key"]
+        assert key.startswith("webp/100/")
+        response = s3_client.get_object(Bucket=output_bucket_name, Key=key)
+        assert response["ContentType"] == "image/webp"
+        assert "phash" in response["Metadata"]
+        with Image.open(response["Body"]) as image:
+            assert image.format == "WEBP"
+            assert image.size == (100, 100)
+
+    @pytest.mark.parametrize(
+        ("thumbnail_size", "expected_color"),
+        [
+            # the thumbnail covers the variant
+            ((160, 120), (255, 0, 0)),
+            # too small
+            ((80, 60), (0, 0, 255)),
+            # letterboxed to another aspect ratio
+            ((160, 160), (0, 0, 255)),
+        ],
+    )
+    def test_convert_object_exif_thumbnail(
+        self,
+        s3_client: typing.Any,
+        output_bucket_name: str,
+        target: typing.Type[ImageConvertProcessor],
+        thumbnail_size: typing.Tuple[int, int],
+        expected_color: typing.Tuple[int, int, int],
+    ) -> None:
+        s3_client.create_bucket(Bucket="test-input-bucket")
+        s3_client.put_object(
+            Bucket="test-input-bucket",
+            Key="original/user/L1",
+            Body=jpeg_with_thumbnail((1600, 1200), thumbnail_size),
+        )
+        processor = target(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.JPEG,
+                resize=100,
+                exif_thumbnail=True,
+            )
+        )
+
+        result = processor.convert_object(
+            "test-input-bucket",
+            "original/user/L1",
+            {"userid": "user", "imageid": "L1"},
+        )
+
+        assert (result.width, result.height) == (100, 75)
+        assert (result.source_width, result.source_height) == (1600, 1200)
+        with Image.open(BytesIO(result.body)) as image:
+            color = typing.cast(
+                typing.Tuple[int, int, int], image.getpixel((50, 37))
+            )
+        assert all(abs(a - b) < 8 for a, b in zip(color, expected_color))
+
+    def test_convert_object_exif_thumbnail_orientation(
+        self,
+        s3_client: typing.Any,
+        output_bucket_name: str,
+    ) -> None:
+        s3_client.create_bucket(Bucket="test-input-bucket")
+        s3_client.put_object(
+            Bucket="test-input-bucket",
+            Key="original/user/L1",
+            Body=jpeg_with_thumbnail((1600, 1200), (160, 120), orientation=6),
+        )
+        processor = ImageConvertProcessor(
+            ConvertConfig(
+                bucket_name=output_bucket_name,
+                format=Format.JPEG,
+                resize=100,
+                exif_thumbnail=True,
+            )
+        )
+
+        result = processor.convert_object(
+            "test-input-bucket",
+            "original/user/L1",
+            {"userid": "user", "imageid": "L1"},
+        )
+
+        # the thumbnail is turned as the original would be
+        assert (result.width, result.height) == (75, 100)
+        assert (result.source_width, result.source_height) == (1200, 1600)
+        with Image.open(BytesIO(result.body)) as image:
+            red, _, _ = typing.cast(
+                typing.Tuple[int, int, int], image.getpixel((37, 50))
+            )
+        assert red > 200
+
+    def test_vips_engine_unavailable(self, mocker: MockerFixture) -> None:
+        mocker.patch(
+            "multilens.constructs.image_convert_function.index.pyvips", None
+        )
+        with pytest.raises(RuntimeError):
+            ImageConvertProcessor(
+                ConvertConfig(bucket_name="test", engine=Engine.VIPS)
+            )
+
+
+class TestAnimation:
+    def convert(self, data: bytes, **kwargs: typing.Any) -> ConvertResult:
+        processor = ImageConvertProcessor(
+            ConvertConfig(bucket_name="test", **kwargs)
+        )
+        return processor.convert_image(BytesIO(data), {})
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    def test_webp(self, engine: Engine) -> None:
+        metrics.clear_metrics()
+
+        result = self.convert(
+            animated_gif(), format=Format.WEBP, resize=50, engine=engine
+        )
+
+        assert result.content_type == "image/webp"
+        assert (result.width, result.height) == (50, 25)
+        assert frame_durations(result.body) == [40] * 10
+        with Image.open(BytesIO(result.body)) as image:
+            image.seek(9)
+            # the square has moved to the right in the last frame
+            red, _, _ = typing.cast(
+                typing.Tuple[int, int, int],
+                image.convert("RGB").getpixel((40, 8)),
+            )
+            assert red > 200
+        assert metrics.metric_set["AnimatedFrames"]["Value"] == [10]
+        metrics.clear_metrics()
+
+    def test_original_format(self) -> None:
+        result = self.convert(animated_gif())
+
+        assert result.content_type == "image/gif"
+        assert frame_durations(result.body) == [40] * 10
+
+    def test_jpeg(self) -> None:
+        result = self.convert(animated_gif(), format=Format.JPEG, resize=50)
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert image.format == "JPEG"
+            assert image.size == (50, 25)
+
+    @pytest.mark.parametrize(
+        ("budget", "durations"),
+        [
+            ({"max_frames": 4}, [80, 120, 80, 120]),
+            ({"max_animation_pixels": 50 * 25 * 3}, [120, 120, 160]),
+        ],
+    )
+    def test_subsample(
+        self, budget: typing.Dict[str, int], durations: typing.List[int]
+    ) -> None:
+        metrics.clear_metrics()
+
+        result = self.convert(
+            animated_gif(), format=Format.WEBP, resize=50, **budget
+        )
+
+        # the animation lasts as long
+        assert frame_durations(result.body) == durations
+        assert "AnimationsSubsampled" in metrics.metric_set
+        metrics.clear_metrics()
+
+    def test_poster(self) -> None:
+        metrics.clear_metrics()
+
+        result = self.convert(
+            animated_gif(),
+            format=Format.WEBP,
+            resize=50,
+            max_frames=4,
+            animation_fallback=AnimationFallback.POSTER,
+        )
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert not getattr(image, "is_animated", False)
+            assert image.size == (50, 25)
+        assert "AnimationPosters" in metrics.metric_set
+        metrics.clear_metrics()
+
+    def test_poster_over_source_frames(self) -> None:
+        metrics.clear_metrics()
+
+        result = self.convert(
+            animated_gif(),
+            format=Format.WEBP,
+            resize=50,
+            max_frames=4,
+            max_source_frames=8,
+        )
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert not getattr(image, "is_animated", False)
+        assert "AnimationPosters" in metrics.metric_set
+        metrics.clear_metrics()
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    @pytest.mark.parametrize(
+        ("source_format", "output_format"),
+        [
+            ("MPO", None),
+            ("MPO", Format.WEBP),
+            ("PNG", None),
+            ("PNG", Format.WEBP),
+        ],
+    )
+    def test_multi_frame_still(
+        self,
+        engine: Engine,
+        source_format: str,
+        output_format: typing.Optional[Format],
+    ) -> None:
+        # MPO, as from phone cameras, and APNG are stills to the converter
+        images = [
+            Image.new("RGB", (200, 100), color)
+            for color in [(255, 0, 0), (0, 0, 255)]
+        ]
+        with BytesIO() as buf:
+            images[0].save(
+                buf, source_format, save_all=True, append_images=images[1:]
+            )
+            data = buf.getvalue()
+
+        result = self.convert(
+            data, format=output_format, resize=50, engine=engine
+        )
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert getattr(image, "n_frames", 1) == 1
+            assert image.size == (50, 25)
+            red, _, blue = typing.cast(
+                typing.Tuple[int, int, int],
+                image.convert("RGB").getpixel((25, 12)),
+            )
+        assert red > 200 and blue < 50
+
+
+class TestMetadataPolicy:
+    def convert(self, data: bytes, **kwargs: typing.Any) -> ConvertResult:
+        processor = ImageConvertProcessor(
+            ConvertConfig(bucket_name="test", **kwargs)
+        )
+        return processor.convert_image(BytesIO(data), {})
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    def test_default(self, engine: Engine) -> None:
+        metrics.clear_metrics()
+
+        result = self.convert(
+            jpeg_with_metadata(), format=Format.JPEG, resize=50, engine=engine
+        )
+
+        assert (result.width, result.height) == (25, 50)
+        assert (result.source_width, result.source_height) == (100, 200)
+        with Image.open(BytesIO(result.body)) as image:
+            assert image.size == (25, 50)
+            # turned a quarter clockwise, the left of the source on top
+            red, _, blue = typing.cast(
+                typing.Tuple[int, int, int], image.getpixel((12, 10))
+            )
+            assert red > 200 and blue < 50
+            assert not {"exif", "icc_profile", "xmp"} & image.info.keys()
+        (saved,) = metrics.metric_set["MetadataBytesSaved"]["Value"]
+        assert saved > len(SRGB_PROFILE) + len(b"<x:xmpmeta/>") * 100
+        metrics.clear_metrics()
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    @pytest.mark.parametrize(
+        ("auto_orient", "size", "orientation"),
+        [(True, (25, 50), 1), (False, (50, 25), 6)],
+    )
+    def test_keep(
+        self,
+        engine: Engine,
+        auto_orient: bool,
+        size: typing.Tuple[int, int],
+        orientation: int,
+    ) -> None:
+        result = self.convert(
+            jpeg_with_metadata(),
+            format=Format.WEBP,
+            resize=50,
+            engine=engine,
+            auto_orient=auto_orient,
+            icc_policy=IccPolicy.KEEP,
+            exif_policy=ExifPolicy.NO_GPS,
+        )
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert image.size == size
+            assert image.info["icc_profile"] == SRGB_PROFILE
+            assert "xmp" not in image.info
+            exif = image.getexif()
+        assert exif[0x010F] == "Camera"
+        # 1 is the default, libvips writes it where Pillow leaves it out
+        assert exif.get(0x0112, 1) == orientation
+        assert not exif.get_ifd(0x8825)
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            Engine.PILLOW,
+            pytest.param(
+                Engine.VIPS,
+                marks=pytest.mark.skipif(
+                    pyvips is None, reason="requires pyvips and libvips"
+                ),
+            ),
+        ],
+    )
+    def test_srgb(self, engine: Engine) -> None:
+        data = jpeg_with_metadata(swapped_profile(), orientation=1)
+
+        result = self.convert(data, format=Format.JPEG, engine=engine)
+
+        with Image.open(BytesIO(result.body)) as image:
+            red, _, blue = typing.cast(
+                typing.Tuple[int, int, int], image.getpixel((10, 10))
+            )
+        # red in the swapped profile is blue in sRGB
+        assert red < 50 and blue > 200
+
+    def test_original_format(self) -> None:
+        with Image.new("RGB", (64, 48)) as image, BytesIO() as buf:
+            image.save(buf, "PNG", icc_profile=SRGB_PROFILE)
+            data = buf.getvalue()
+
+        result = self.convert(data)
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert image.format == "PNG"
+            assert "icc_profile" not in image.info
+
+    def test_adaptive(self) -> None:
+        result = self.convert(
+            jpeg_with_metadata(),
+            format=Format.JPEG,
+            resize=50,
+            target_bytes=10_000,
+            exif_policy=ExifPolicy.NO_GPS,
+        )
+
+        with Image.open(BytesIO(result.body)) as image:
+            assert image.getexif()[0x010F] == "Camera"
+
+
+class TestJpegHeader:
+    def test_parse(self) -> None:
+        data = jpeg_with_thumbnail((1600, 1200), (160, 120))
+
+        header = parse_jpeg_header(data[:4096])
+
+        assert header is not None
+        assert (header.width, header.height) == (1600, 1200)
+        assert header.thumbnail is not None
+        with Image.open(BytesIO(header.thumbnail)) as thumbnail:
+            assert thumbnail.size == (160, 120)
+
+    def test_parse_orientation(self) -> None:
+        data = jpeg_with_thumbnail((1600, 1200), (160, 120), orientation=6)
+
+        header = parse_jpeg_header(data)
+
+        assert header is not None
+        assert header.orientation == 6
+        assert header.thumbnail is not None
+
+    def test_parse_without_thumbnail(self) -> None:
+        with Image.new("RGB", (64, 48)) as image, BytesIO() as buf:
+            image.save(buf, "JPEG")
+            data = buf.getvalue()
+
+        header = parse_jpeg_header(data)
+
+        assert header is not None
+        assert (header.width, header.height) == (64, 48)
+        assert header.thumbnail is None
+
+    def test_parse_truncated(self) -> None:
+        data = jpeg_with_thumbnail((1600, 1200), (160, 120))
+
+        assert parse_jpeg_header(data[:100]) is None
+
+    def test_parse_not_jpeg(self) -> None:
+        with Image.new("RGB", (64, 48)) as image, BytesIO() as buf:
+            image.save(buf, "PNG")
+            data = buf.getvalue()
+
+        assert parse_jpeg_header(data) is None
+
+
+class TestPack(AwsTestClass):
+    def test_index(self) -> None:
+        body, entries = encode_pack_segment(
+            [("L1", b"first"), ("L\u00e9", b""), ("L3", b"third")]
+        )
+
+        assert entries == [
+            PackEntry("L1", 0, 5),
+            PackEntry("L\u00e9", 5, 0),
+            PackEntry("L3", 5, 5),
+        ]
+        assert body.startswith(b"firstthird")
+        assert decode_pack_index(body) == entries
+        assert decode_pack_index(body[10:]) == entries
+        with pytest.raises(ValueError):
+            decode_pack_index(body[12:])
+        with pytest.raises(ValueError):
+            decode_pack_index(b"firstthird")
+
+    def test_processor(
+        self, s3_client: typing.Any, index_table_name: str, dynamodb
+    ) -> None:
+        s3_client.create_bucket(Bucket="test-input-bucket")
+        s3_client.create_bucket(Bucket="test-output-bucket")
+        for i in range(3):
+            with Image.new(
+                mode="RGB", size=(200, 100), color=(i, i, i)
+            ) as image, BytesIO() as buf:
+                image.save(buf, "JPEG")
+                s3_client.put_object(
+                    Bucket="test-input-bucket",
+                    Key=f"original/user/L{i}",
+                    Body=buf.getvalue(),
+                )
+        processor = ImageConvertProcessor(
+            ConvertConfig(
+                bucket_name="test-output-bucket",
+                format=Format.JPEG,
+                resize=50,
+                index_table_name=index_table_name,
+                pack=True,
+            )
+        )
+
+        for i in range(3):
+            processor.convert_object(
+                "test-input-bucket",
+                f"original/user/L{i}",
+                {"userid": "user", "imageid": f"L{i}"},
+            )
+        processor.flush()
+
+        keys = [
+            content["Key"]
+            for content in s3_client.list_objects_v2(
+                Bucket="test-output-bucket"
+            )["Contents"]
+        ]
+        assert len(keys) == 1
+        assert keys[0].startswith("packs/jpeg/50/user/")
+        entries = read_pack_index(s3_client, "test-output-bucket", keys[0])
+        assert [e.image_id for e in entries] == ["L0", "L1", "L2"]
+        variant = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L1"}
+        )["Item"]["Variants"]["jpeg/50"]
+        assert variant["Key"] == keys[0]
+        assert variant["Offset"] == entries[1].offset
+        assert variant["Bytes"] == entries[1].length
+        data = s3_client.get_object(
+            Bucket="test-output-bucket",
+            Key=keys[0],
+            Range=(
+                f"bytes={variant['Offset']}-"
+                f"{variant['Offset'] + variant['Bytes'] - 1}"
+            ),
+        )["Body"].read()
+        with Image.open(BytesIO(data)) as image:
+            assert image.size == (50, 25)
+
+    def test_requires_index(self) -> None:
+        with pytest.raises(ValueError):
+            ImageConvertProcessor(
+                ConvertConfig(bucket_name="test", pack=True),
+                s3_client=object(),
+            )
+
+
+class TestKeyLayout:
+    def test_variant_key(self) -> None:
+        assert variant_key("jpeg/400", "user", "L1") == "jpeg/400/user/L1"
+        sharded = variant_key("jpeg/400", "user", "L1", KeyLayout.SHARDED)
+        assert sharded == f"{md5(b'user/L1').hexdigest()[:2]}/jpeg/400/user/L1"
+        # the images of one user spread over the prefixes too
+        prefixes = {
+            variant_key("jpeg/400", "user", f"L{i}", KeyLayout.SHARDED)[:2]
+            for i in range(4000)
+        }
+        assert len(prefixes) == 256
+
+    def test_output_key(self) -> None:
+        processor = ImageConvertProcessor(
+            ConvertConfig(
+                bucket_name="test",
+                format=Format.WEBP,
+                resize=400,
+                key_layout=KeyLayout.SHARDED,
+            )
+        )
+
+        assert processor.output_key(
+            {"userid": "user", "imageid": "L1"}
+        ) == variant_key("webp/400", "user", "L1", KeyLayout.SHARDED)
+
+
+class TestS3Client(AwsTestClass):
+    def test_slow_down(self, aws_credentials) -> None:
+        client = create_s3_client()
+        metrics.clear_metrics()
+
+        for status, code in [(503, "SlowDown"), (404, "NoSuchKey")]:
+            client.meta.events.emit(
+                "needs-retry.s3.PutObject",
+                response=(
+                    SimpleNamespace(status_code=status, headers={}),
+                    {"Error": {"Code": code}},
+                ),
+                endpoint=client._endpoint,
+                operation=client.meta.service_model.operation_model(
+                    "PutObject"
+                ),
+                attempts=1,
+                caught_exception=None,
+                request_dict={"context": {}},
+            )
+
+        assert client.meta.config.retries["mode"] == "adaptive"
+        assert metrics.metric_set["S3SlowDown"]["Value"] == [1]
+        metrics.clear_metrics()
+
+
+class TestPerceptualHash:
+    def test_dhash(self) -> None:
+        gradient = Image.linear_gradient("L").resize((256, 128))
+
+        assert dhash(gradient) == dhash(gradient.resize((64, 32)))
+        assert dhash(gradient.convert("RGB")) == dhash(gradient)
+        assert dhash(gradient) != dhash(gradient.rotate(90))
+
+    def test_phash_bands(self) -> None:
+        assert phash_bands("user", "0123456789abcdef") == {
+            "PHashBand0": "user:0123",
+            "PHashBand1": "user:4567",
+            "PHashBand2": "user:89ab",
+            "PHashBand3": "user:cdef",
+        }
+
+
+class TestPlaceholder:
+    def test_blurhash(self) -> None:
+        image = Image.new("RGB", (64, 48), (255, 0, 0))
+        image.paste((0, 0, 255), (32, 0, 64, 48))
+
+        assert blurhash(image) == "L~LZ}s|TsRJrsXn~jsa}fQfQfQfQ"
+        assert blurhash(image, x_components=1, y_components=1) == "00LZ}s"
+
+    def test_dominant_color(self) -> None:
+        image = Image.new("RGB", (64, 48), (255, 0, 0))
+        image.paste((0, 0, 255), (48, 0, 64, 48))
+
+        assert dominant_color(image) == "#ff0000"
+        assert dominant_color(image.convert("RGBA")) == "#ff0000"
+
+
+class TestAdaptiveEncoding:
+    @pytest.fixture
+    def image(self) -> Image.Image:
+        return Image.effect_mandelbrot((200, 150), (-2, -1.2, 1, 1.2), 80)
+
+    def test_ssim(self, image: Image.Image) -> None:
+        assert ssim(image, image) == pytest.approx(1.0)
+        assert ssim(image, ImageOps.invert(image)) < 0.1
+
+    def test_target_bytes(self, image: Image.Image) -> None:
+        largest = encode_adaptive(image, Format.JPEG, target_bytes=10**6)
+        smallest = encode_adaptive(image, Format.JPEG, target_bytes=1)
+        budget = (len(largest.body) + len(smallest.body)) // 2
+
+        result = encode_adaptive(image, Format.JPEG, target_bytes=budget)
+
+        assert result.format == Format.JPEG
+        assert len(result.body) <= budget
+        assert smallest.quality < result.quality < largest.quality
+
+    def test_min_ssim(self, image: Image.Image) -> None:
+        result = encode_adaptive(image, Format.WEBP, min_ssim=0.98)
+
+        assert result.ssim is not None and result.ssim >= 0.98
+        lower = encode_adaptive(image, Format.WEBP, min_ssim=0.9)
+        assert lower.quality <= result.quality
+
+    def test_max_trials(
+        self, image: Image.Image, mocker: MockerFixture
+    ) -> None:
+        save = mocker.spy(Image.Image, "save")
+
+        encode_adaptive(
+            image, Format.JPEG, target_bytes=2000, min_ssim=0.99, max_trials=3
+        )
+
+        assert save.call_count == 3
+
+    def test_auto(self, image: Image.Image) -> None:
+        result = encode_adaptive(image, Format.AUTO)
+        jpeg = encode_adaptive(image, Format.JPEG)
+        webp = encode_adaptive(image, Format.WEBP)
 
+        assert len(result.body) == min(len(jpeg.body), len(webp.body))
+        result = encode_adaptive(image.convert("RGBA"), Format.AUTO)
+        assert result.format == Format.WEBP
 
-class TestImageConvertProcessor(AwsTestClass):
+
+class TestImageIndex(AwsTestClass):
     @pytest.fixture
-    def s3_record(self, s3_client) -> typing.Dict[str, typing.Any]:
-        bucket_name = "test-input-bucket"
-        object_key = "test/image.jpeg"
-        s3_client.create_bucket(Bucket=bucket_name)
+    def target(self, index_table_name: str) -> ImageIndex:
+        return ImageIndex(index_table_name)
+
+    def test_flush(
+        self,
+        target: ImageIndex,
+        index_table_name: str,
+        dynamodb: typing.Any,
+    ) -> None:
+        table = dynamodb.Table(index_table_name)
+        table.put_item(
+            Item={
+                "UserId": "user",
+                "ImageId": "L1",
+                "OriginalKey": "original/user/L1",
+                "Variants": {"jpeg/400": {"Key": "jpeg/400/user/L1"}},
+            }
+        )
+
+        target.add_variant("user", "L1", "webp/400", {"Key": "webp/400/a"})
+        target.add_variant("user", "L1", "webp/100", {"Key": "webp/100/a"})
+        target.add_variant("user", "L2", "webp/400", {"Key": "webp/400/b"})
+        target.flush()
+
+        item = table.get_item(Key={"UserId": "user", "ImageId": "L1"})["Item"]
+        assert item["OriginalKey"] == "original/user/L1"
+        assert sorted(item["Variants"]) == ["jpeg/400", "webp/100", "webp/400"]
+        item = table.get_item(Key={"UserId": "user", "ImageId": "L2"})["Item"]
+        assert item["Variants"] == {"webp/400": {"Key": "webp/400/b"}}
+
+    def test_add_variant_flushes_when_full(
+        self,
+        index_table_name: str,
+        dynamodb: typing.Any,
+    ) -> None:
+        target = ImageIndex(index_table_name, max_pending=1)
+
+        target.add_variant("user", "L1", "webp/400", {"Key": "webp/400/a"})
+
+        item = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L1"}
+        )
+        assert "Item" in item
+
+
+class TestSequenceTable(AwsTestClass):
+    def test_claim(self, dynamodb: typing.Any) -> None:
+        dynamodb.create_table(
+            TableName="test-sequence-table",
+            KeySchema=[{"AttributeName": "Key", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "Key", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        target = SequenceTable("test-sequence-table")
+
+        assert target.is_latest("key", "0061CA8F155D6048ED")
+        assert target.claim("key", "0061CA8F155D6048ED")
+        assert target.claim("key", "0061CA8F155D6048ED")
+        # shorter sequencers are right padded before comparing
+        assert target.claim("key", "0061CA8F155D6049")
+        assert not target.is_latest("key", "0061CA8F155D6048ED")
+        assert not target.claim("key", "0061CA8F155D6048ED")
+        assert target.is_latest("key", "0061CA8F155D6049")
+        assert target.claim("other", "0061CA8F155D6048ED")
+
+
+class TestImageRenderer(AwsTestClass):
+    @pytest.fixture
+    def lock_table_name(self, dynamodb: typing.Any) -> str:
+        table_name = "test-lock-table"
+        dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[{"AttributeName": "Key", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "Key", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        return table_name
+
+    @pytest.fixture
+    def buckets(self, s3_client: typing.Any) -> typing.Tuple[str, str]:
+        s3_client.create_bucket(Bucket="test-input-bucket")
+        s3_client.create_bucket(Bucket="test-output-bucket")
         with Image.new(
-            mode="RGB", size=(200, 200), color=(0, 0, 0)
+            mode="RGB", size=(800, 600), color=(0, 0, 0)
         ) as image, BytesIO() as buf:
             image.save(buf, "JPEG")
-            buf.seek(SEEK_SET)
-            s3_client.upload_fileobj(
-                Bucket=bucket_name,
-                Key=object_key,
-                Fileobj=buf,
-                ExtraArgs={
-                    "ContentType": "image/jpeg",
-                },
+            s3_client.put_object(
+                Bucket="test-input-bucket",
+                Key="original/user/L1",
+                Body=buf.getvalue(),
+                ContentType="image/jpeg",
+                Metadata={"UserId": "user", "ImageId": "L1"},
             )
-        s3_record = {
-            "eventVersion": "2.1",
-            "eventSource": "aws:s3",
-            "awsRegion": "us-east-1",
-            "eventTime": "2022-01-01T00:00:00.000Z",
-            "eventName": "ObjectCreated:Put",
-            "userIdentity": {"principalId": "AWS:XXXXXXXXXXXXXXXXXXXXX"},
-            "requestParameters": {"sourceIPAddress": "192.168.1.1"},
-            "responseElements": {
-                "x-amz-request-id": "XXXXXXXXXXXXXXXX",
-                "x-amz-id-2": "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx/xxxxxxxxxxxxxxxxxxxxxxxx/xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx/",
-            },
-            "s3": {
-                "s3SchemaVersion": "1.0",
-                "configurationId": "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
-                "bucket": {
-                    "name": bucket_name,
-                    "ownerIdentity": {"principalId": "XXXXXXXXXXXXXX"},
-                    "arn": f"arn:aws:s3:::{bucket_name}",
-                },
-                "object": {
-                    "key": object_key,
-                    "size": 200000,
-                    "eTag": "54ac6050d0ff433a637073253a71fc11",
-                    "sequencer": "0061CA8F155D6048ED",
-                },
-            },
-        }
-        return s3_record
+        return "test-input-bucket", "test-output-bucket"
 
     @pytest.fixture
-    def output_bucket_name(self, s3_client) -> str:
-        bucket_name = "test-output-bucket"
-        s3_client.create_bucket(Bucket=bucket_name)
-        return bucket_name
+    def target(
+        self, buckets: typing.Tuple[str, str], lock_table_name: str
+    ) -> ImageRenderer:
+        input_bucket_name, output_bucket_name = buckets
+        renderer = ImageRenderer(
+            bucket_name=output_bucket_name,
+            input_bucket_name=input_bucket_name,
+            variants={
+                "webp/400": ConvertProps(
+                    format="webp", resize="400", icc_policy="keep"
+                ).environment()
+            },
+            lock_table_name=lock_table_name,
+            cache_control="public, max-age=86400",
+            wait_timeout=0.5,
+        )
+        renderer.poll_interval = 0.05
+        return renderer
 
-    @pytest.fixture
-    def target(self) -> typing.Type[ImageConvertProcessor]:
-        return ImageConvertProcessor
+    def test_presigned_url(
+        self, target: ImageRenderer, s3_client: typing.Any
+    ) -> None:
+        target.render("webp", "400", "user", "L1")
 
-    def test_process_records(
-        self, target: typing.Type[ImageConvertProcessor]
+        url = target.presigned_url("webp", "400", "user", "L1")
+
+        parsed = urllib.parse.urlparse(url)
+        assert parsed.path.endswith("/webp/400/user/L1")
+        # signed by SigV2 or SigV4, depending on the region
+        query = urllib.parse.parse_qs(parsed.query)
+        assert {"Signature", "X-Amz-Signature"} & query.keys()
+        with pytest.raises(ImageNotFoundError):
+            target.presigned_url("jpeg", "100", "user", "L1")
+
+    def test_render(
+        self,
+        target: ImageRenderer,
+        s3_client: typing.Any,
+        mocker: MockerFixture,
     ) -> None:
-        processor = target(ConvertConfig(bucket_name="test"))
-        with pytest.raises(NotImplementedError):
-            processor.process_records([])
+        body, content_type = target.render("webp", "400", "user", "L1")
+
+        assert content_type == "image/webp"
+        with Image.open(BytesIO(body)) as image:
+            assert image.size == (400, 300)
+        head_response = s3_client.head_object(
+            Bucket="test-output-bucket",
+            Key="webp/400/user/L1",
+        )
+        assert head_response["CacheControl"] == "public, max-age=86400"
+
+        convert = mocker.spy(ImageConvertProcessor, "convert_object")
+        cached_body, _ = target.render("webp", "400", "user", "L1")
+
+        assert cached_body == body
+        convert.assert_not_called()
+
+    def test_render_config(self, target: ImageRenderer) -> None:
+        processor = target._processor("webp", "400")
+
+        assert processor.config.icc_policy == IccPolicy.KEEP
+        assert processor.config.cache_control == "public, max-age=86400"
+        assert processor.s3 is target.s3
+        assert target._processor("webp", "400") is processor
+
+    def test_render_after_lock(
+        self,
+        target: ImageRenderer,
+        mocker: MockerFixture,
+    ) -> None:
+        # rendered by the previous holder between the check and the lock
+        mocker.patch.object(
+            target,
+            "_get",
+            side_effect=[None, (b"rendered", "image/webp")],
+        )
+        convert = mocker.spy(ImageConvertProcessor, "convert_object")
+
+        assert target.render("webp", "400", "user", "L1") == (
+            b"rendered",
+            "image/webp",
+        )
+        convert.assert_not_called()
+        assert target.lock is not None
+        assert target.lock.acquire("webp/400/user/L1", "other")
+
+    def test_render_coalesced(
+        self,
+        target: ImageRenderer,
+        s3_client: typing.Any,
+    ) -> None:
+        assert target.lock is not None
+        assert target.lock.acquire("webp/400/user/L1", "other")
+
+        with pytest.raises(RenderTimeoutError):
+            target.render("webp", "400", "user", "L1")
+
+        s3_client.put_object(
+            Bucket="test-output-bucket",
+            Key="webp/400/user/L1",
+            Body=b"rendered",
+            ContentType="image/webp",
+        )
+        assert target.render("webp", "400", "user", "L1") == (
+            b"rendered",
+            "image/webp",
+        )
 
     @pytest.mark.parametrize(
-        ("format", "resize"),
+        ("format", "resize", "image_id"),
         [
-            (None, None),
-            (Format.WEBP, 400),
+            ("jpeg", "400", "L1"),
+            ("webp", "400", "L2"),
         ],
     )
-    def test_process_s3_records(
+    def test_render_not_found(
         self,
-        s3_record: typing.Dict[str, typing.Any],
-        output_bucket_name: str,
-        target: typing.Type[ImageConvertProcessor],
-        format: typing.Optional[Format],
-        resize: typing.Optional[int],
+        target: ImageRenderer,
+        format: str,
+        resize: str,
+        image_id: str,
     ) -> None:
-        processor = target(
-            ConvertConfig(
-                bucket_name=output_bucket_name,
-                format=format,
-                resize=resize,
-            )
+        with pytest.raises(ImageNotFoundError):
+            target.render(format, resize, "user", image_id)
+
+
+class TestRenderLock(AwsTestClass):
+    def test_acquire(self, dynamodb: typing.Any) -> None:
+        dynamodb.create_table(
+            TableName="test-lock-table",
+            KeySchema=[{"AttributeName": "Key", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "Key", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
         )
-        processor._process_s3_records([s3_record])
+        target = RenderLock("test-lock-table")
+
+        assert target.acquire("key", "a")
+        assert not target.acquire("key", "b")
+        target.release("key", "b")
+        assert not target.acquire("key", "b")
+        target.release("key", "a")
+        assert target.acquire("key", "b")
+
+        expired = RenderLock("test-lock-table", lease_seconds=-10)
+        assert expired.acquire("other", "a")
+        assert expired.acquire("other", "b")
 
 
 class TestSnsImageConvertProcessor:
@@ -150,12 +1559,123 @@ class TestSnsImageConvertProcessor:
         mocked_process_s3_record = mocker.patch.object(
             target=target,
             attribute="_process_s3_records",
+            return_value=[],
         )
 
         target.process_records(records=records)
 
         mocked_process_s3_record.assert_called_once_with([])
 
+    def sns_record(self, s3_records: typing.List[typing.Any]) -> typing.Any:
+        return {
+            "EventSource": "aws:sns",
+            "Sns": {
+                "Type": "Notification",
+                "MessageId": "95df01b4-ee98-5cb9-9903-4c221d41eb5e",
+                "Message": json.dumps({"Records": s3_records}),
+            },
+        }
+
+    def test_process_records_isolates_failures(
+        self, mocker: MockerFixture
+    ) -> None:
+        sqs_client = mocker.Mock()
+        target = SnsImageConvertProcessor(
+            ConvertConfig(
+                bucket_name="test-bucket",
+                failure_queue_url="https://sqs.example.com/failures",
+            ),
+            sqs_client=sqs_client,
+        )
+        bad = {"s3": {"object": {"key": "bad"}}}
+        good = {"s3": {"object": {"key": "good"}}}
+        mocked_process_s3_record = mocker.patch.object(
+            target=target,
+            attribute="_process_s3_record",
+            side_effect=[ValueError("corrupt"), None],
+        )
+
+        target.process_records(records=[self.sns_record([bad, good])])
+
+        assert mocked_process_s3_record.call_count == 2
+        sqs_client.send_message.assert_called_once()
+        kwargs = sqs_client.send_message.call_args.kwargs
+        assert kwargs["QueueUrl"] == "https://sqs.example.com/failures"
+        assert json.loads(kwargs["MessageBody"]) == {"Records": [bad]}
+        attributes = kwargs["MessageAttributes"]
+        assert attributes["ErrorType"]["StringValue"] == "ValueError"
+        assert attributes["Variant"]["StringValue"] == "original/original"
+
+    def test_process_records_without_failure_queue(
+        self,
+        target: SnsImageConvertProcessor,
+        mocker: MockerFixture,
+    ) -> None:
+        mocked_process_s3_record = mocker.patch.object(
+            target=target,
+            attribute="_process_s3_record",
+            side_effect=[ValueError("corrupt"), None],
+        )
+
+        with pytest.raises(ValueError):
+            target.process_records(
+                records=[
+                    self.sns_record(
+                        [
+                            {"s3": {"object": {"key": "bad"}}},
+                            {"s3": {"object": {"key": "good"}}},
+                        ]
+                    )
+                ]
+            )
+
+        assert mocked_process_s3_record.call_count == 2
+
+    def test_process_records_flushes_once(
+        self,
+        target: SnsImageConvertProcessor,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.object(target=target, attribute="_process_s3_record")
+        mocked_flush = mocker.patch.object(target=target, attribute="flush")
+
+        target.process_records(
+            records=[
+                self.sns_record([{"s3": {"object": {"key": "a"}}}]),
+                self.sns_record([{"s3": {"object": {"key": "b"}}}]),
+            ]
+        )
+
+        mocked_flush.assert_called_once_with()
+
+    def test_process_records_flush_failure(self, mocker: MockerFixture) -> None:
+        sqs_client = mocker.Mock()
+        target = SnsImageConvertProcessor(
+            ConvertConfig(
+                bucket_name="test-bucket",
+                failure_queue_url="https://sqs.example.com/failures",
+            ),
+            sqs_client=sqs_client,
+        )
+        bad = {"s3": {"object": {"key": "bad"}}}
+        good = {"s3": {"object": {"key": "good"}}}
+        mocker.patch.object(
+            target=target,
+            attribute="_process_s3_record",
+            side_effect=[ValueError("corrupt"), None],
+        )
+        mocker.patch.object(
+            target=target, attribute="flush", side_effect=OSError("down")
+        )
+
+        target.process_records(records=[self.sns_record([bad, good])])
+
+        bodies = [
+            json.loads(call.kwargs["MessageBody"])
+            for call in sqs_client.send_message.call_args_list
+        ]
+        assert bodies == [{"Records": [bad]}, {"Records": [good]}]
+
 
 class TestSqsImageConvertProcessor:
     @pytest.fixture
@@ -192,12 +1712,155 @@ class TestSqsImageConvertProcessor:
         mocked_process_s3_record = mocker.patch.object(
             target=target,
             attribute="_process_s3_records",
+            return_value=[],
         )
 
         target.process_records(records=records)
 
         mocked_process_s3_record.assert_called_once_with([])
 
+    def test_process_records_partial_failure(
+        self,
+        target: SqsImageConvertProcessor,
+        mocker: MockerFixture,
+    ) -> None:
+        records = []
+        for key in ("bad", "good"):
+            body = json.dumps({"Records": [{"s3": {"object": {"key": key}}}]})
+            records.append(
+                {
+                    "messageId": key,
+                    "receiptHandle": "MessageReceiptHandle",
+                    "body": body,
+                    "attributes": {
+                        "ApproximateReceiveCount": "1",
+                        "SentTimestamp": "1523232000000",
+                    },
+                    "messageAttributes": {},
+                    "md5OfBody": md5(body.encode()).hexdigest(),
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": "arn:aws:sqs:us-east-1:123456789012:Q",
+                    "awsRegion": "us-east-1",
+                }
+            )
+        mocker.patch.object(
+            target=target,
+            attribute="_process_s3_record",
+            side_effect=[ValueError("corrupt"), None],
+        )
+
+        response = target.process_records(records=records)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "bad"}]}
+
+    def test_process_records_invocation_record(
+        self,
+        target: SqsImageConvertProcessor,
+        mocker: MockerFixture,
+    ) -> None:
+        s3_record = {"s3": {"object": {"key": "original/user/L1"}}}
+        # as Lambda sends an invocation that failed to its destination
+        body = json.dumps(
+            {
+                "version": "1.0",
+                "requestContext": {
+                    "functionArn": "arn:aws:lambda:us-east-1:123456789012:function:F:$LATEST",  # noqa
+                    "condition": "RetriesExhausted",
+                },
+                "requestPayload": {
+                    "Records": [
+                        {
+                            "EventSource": "aws:sns",
+                            "Sns": {
+                                "Message": json.dumps({"Records": [s3_record]})
+                            },
+                        }
+                    ]
+                },
+            }
+        )
+        mocked_process_s3_record = mocker.patch.object(
+            target=target, attribute="_process_s3_record"
+        )
+
+        response = target.process_records(
+            records=[
+                {
+                    "messageId": "invocation",
+                    "receiptHandle": "MessageReceiptHandle",
+                    "body": body,
+                    "attributes": {"SentTimestamp": "1523232000000"},
+                    "messageAttributes": {},
+                    "md5OfBody": md5(body.encode()).hexdigest(),
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": "arn:aws:sqs:us-east-1:123456789012:Q",
+                    "awsRegion": "us-east-1",
+                }
+            ]
+        )
+
+        mocked_process_s3_record.assert_called_once_with(s3_record)
+        assert response == {"batchItemFailures": []}
+
+    def test_process_records_flush_failure(
+        self,
+        target: SqsImageConvertProcessor,
+        mocker: MockerFixture,
+    ) -> None:
+        records = []
+        for key in ("bad", "good", "also-good"):
+            body = json.dumps({"Records": [{"s3": {"object": {"key": key}}}]})
+            records.append(
+                {
+                    "messageId": key,
+                    "receiptHandle": "MessageReceiptHandle",
+                    "body": body,
+                    "attributes": {"SentTimestamp": "1523232000000"},
+                    "messageAttributes": {},
+                    "md5OfBody": md5(body.encode()).hexdigest(),
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": "arn:aws:sqs:us-east-1:123456789012:Q",
+                    "awsRegion": "us-east-1",
+                }
+            )
+        mocker.patch.object(
+            target=target,
+            attribute="_process_s3_record",
+            side_effect=[ValueError("corrupt"), None, None],
+        )
+        error = OSError("down")
+        mocked_flush = mocker.patch.object(
+            target=target, attribute="flush", side_effect=error
+        )
+        mocker.patch(
+            "multilens.constructs.image_convert_function.index.SENTRY_DSN",
+            "https://key@sentry.example.com/1",
+        )
+        mocked_capture = mocker.patch(
+            "multilens.constructs.image_convert_function.index"
+            ".capture_exception"
+        )
+
+        with pytest.raises(BatchProcessingError):
+            target.process_records(records=records)
+
+        mocked_flush.assert_called_once_with()
+        # the corrupt record, then the flush failure of the other two
+        assert [c.args[0] for c in mocked_capture.call_args_list] == [
+            mocker.ANY,
+            error,
+            error,
+        ]
+        assert isinstance(mocked_capture.call_args_list[0].args[0], ValueError)
+        fail_messages: typing.List[
+            typing.Any
+        ] = target.batch_processor.fail_messages
+        assert [record.message_id for record in fail_messages] == [
+            "bad",
+            "good",
+            "also-good",
+        ]
+
 
 class TestImageConvert(AwsTestClass):
     @pytest.fixture
@@ -220,3 +1883,133 @@ class TestImageConvert(AwsTestClass):
             "multilens.constructs.image_convert_function.index.SnsImageConvertProcessor"
         )
         target(lambda_event, lambda_context)
+
+
+class TestRender(AwsTestClass):
+    @pytest.fixture
+    def lambda_event(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "body": None,
+            "resource": "/{format}/{resize}/{user_id}/{image_id}",
+            "path": "/webp/400/user/L1",
+            "httpMethod": "GET",
+            "isBase64Encoded": False,
+            "queryStringParameters": None,
+            "multiValueQueryStringParameters": None,
+            "pathParameters": {
+                "format": "webp",
+                "resize": "400",
+                "user_id": "user",
+                "image_id": "L1",
+            },
+            "stageVariables": None,
+            "headers": {},
+            "multiValueHeaders": {},
+            "requestContext": {
+                "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
+                "path": "/prod/webp/400/user/L1",
+                "resourcePath": "/{format}/{resize}/{user_id}/{image_id}",
+                "httpMethod": "GET",
+                "stage": "prod",
+            },
+        }
+
+    @pytest.fixture
+    def environ(
+        self, mocker: MockerFixture
+    ) -> typing.Generator[None, None, None]:
+        mocker.patch.dict(
+            os.environ,
+            {
+                "BUCKET_NAME": "test-output-bucket",
+                "INPUT_BUCKET_NAME": "test-input-bucket",
+                "APP_RENDER_VARIANTS": json.dumps(
+                    {
+                        "webp/400": ConvertProps(
+                            format="webp", resize="400"
+                        ).environment()
+                    }
+                ),
+                "APP_CACHE_CONTROL": "public, max-age=86400",
+            },
+        )
+        get_renderer.cache_clear()
+        yield
+        get_renderer.cache_clear()
+
+    @pytest.mark.parametrize(
+        ("side_effect", "status_code"),
+        [
+            (None, 200),
+            (ImageNotFoundError, 404),
+            (RenderTimeoutError, 503),
+        ],
+    )
+    def test_render_handler(
+        self,
+        environ: None,
+        lambda_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        side_effect: typing.Optional[typing.Type[Exception]],
+        status_code: int,
+    ) -> None:
+        mocked_class = mocker.patch(
+            "multilens.constructs.image_convert_function.index.ImageRenderer"
+        )
+        mocked_class.return_value.render.return_value = (
+            b"image",
+            "image/webp",
+        )
+        mocked_class.return_value.render.side_effect = side_effect
+
+        response = render_handler(lambda_event, lambda_context)
+
+        assert response["statusCode"] == status_code
+        if status_code == 200:
+            assert response["isBase64Encoded"]
+            assert response["headers"]["Content-Type"] == "image/webp"
+            assert response["headers"]["Cache-Control"] == (
+                "public, max-age=86400"
+            )
+        mocked_class.return_value.render.assert_called_once_with(
+            format="webp",
+            resize="400",
+            user_id="user",
+            image_id="L1",
+            owner=lambda_context.aws_request_id,
+        )
+
+    def test_render_handler_redirect(
+        self,
+        environ: None,
+        lambda_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch(
+            "multilens.constructs.image_convert_function.index.MAX_INLINE_BYTES",
+            1,
+        )
+        mocked_class = mocker.patch(
+            "multilens.constructs.image_convert_function.index.ImageRenderer"
+        )
+        mocked_class.return_value.render.return_value = (
+            b"image",
+            "image/webp",
+        )
+
+        mocked_class.return_value.presigned_url.return_value = (
+            "https://test-output-bucket.s3.amazonaws.com/webp/400/user/L1?X"
+        )
+
+        response = render_handler(lambda_event, lambda_context)
+
+        assert response["statusCode"] == 307
+        # to the stored variant, not back to the render API
+        assert response["headers"]["Location"] == (
+            "https://test-output-bucket.s3.amazonaws.com/webp/400/user/L1?X"
+        )
+        mocked_class.return_value.presigned_url.assert_called_once_with(
+            "webp", "400", "user", "L1"
+        )
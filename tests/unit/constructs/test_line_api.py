@@ -1,5 +1,6 @@
 import json
 import os
+import typing
 
 import aws_cdk as cdk
 import aws_cdk.assertions as assertions
@@ -7,7 +8,9 @@ import pytest
 from aws_cdk import aws_s3 as s3
 from pytest_snapshot.plugin import Snapshot
 
-from multilens.constructs.line_api import LineApi, LineApiCredential
+from multilens.constructs.image_convert import ConvertProps
+from multilens.constructs.image_index import ImageIndex
+from multilens.constructs.line_api import FrontDoor, LineApi, LineApiCredential
 from tests.helpers import ignore_template_assets
 
 
@@ -31,16 +34,24 @@ class TestLineApi:
         self, snapshot: Snapshot, app: cdk.App, env: cdk.Environment
     ) -> None:
         stack = cdk.Stack(app, "Test", env=env)
+        image_index = ImageIndex(stack, "ImageIndex")
         LineApi(
             stack,
             "LineApi",
             line_credential=LineApiCredential(
                 access_token="access_token",
                 secret="secret",
+                login_channel_id="1234567890",
             ),
             bucket_props=s3.BucketProps(),
-            lambda_log_level="DEBUG",
+            index_table=image_index.table,
+            image_bucket=s3.Bucket(stack, "ImageBucket"),
+            deduplicate=True,
+            lambda_log_level="INFO",
+            lambda_log_sample_rate=0.01,
             lambda_sentry_dsn="https://sentry.example.com",
+            lambda_traces_sample_rate=0.05,
+            lambda_traces_slow_ms=2000,
         )
         template_json = ignore_template_assets(
             assertions.Template.from_stack(stack).to_json()
@@ -75,3 +86,218 @@ class TestLineApi:
             json.dumps(template_json, indent=2),
             "line_api_minimal_resource.json",
         )
+
+    def test_previews(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        line_api = LineApi(
+            stack,
+            "LineApi",
+            line_credential=LineApiCredential(
+                access_token="access_token",
+                secret="secret",
+            ),
+            bucket_props=s3.BucketProps(),
+            image_bucket=s3.Bucket(stack, "ImageBucket"),
+            preview_props=[
+                ConvertProps(format="jpeg", resize="400", image_features=True)
+            ],
+        )
+        template = assertions.Template.from_stack(stack)
+
+        assert line_api.preview_layer is not None
+        # and the telemetry layer
+        template.resource_count_is("AWS::Lambda::LayerVersion", 2)
+        variables = template.find_resources("AWS::Lambda::Function")[
+            stack.get_logical_id(
+                line_api.callback_function.node.default_child  # type: ignore
+            )
+        ]["Properties"]["Environment"]["Variables"]
+        previews = json.loads(variables["APP_PREVIEWS"])
+        assert previews == [
+            ConvertProps(
+                format="jpeg", resize="400", image_features=True
+            ).environment()
+        ]
+        assert previews[0]["APP_IMAGE_FEATURES"] == "True"
+
+    def test_previews_require_image_bucket(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        with pytest.raises(ValueError):
+            LineApi(
+                stack,
+                "LineApi",
+                line_credential=LineApiCredential(
+                    access_token="access_token",
+                    secret="secret",
+                ),
+                bucket_props=s3.BucketProps(),
+                preview_props=[ConvertProps(format="jpeg", resize="400")],
+            )
+
+    def test_profiling(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        profile_bucket = s3.Bucket(stack, "ProfileBucket")
+        LineApi(
+            stack,
+            "LineApi",
+            line_credential=LineApiCredential(
+                access_token="access_token",
+                secret="secret",
+            ),
+            bucket_props=s3.BucketProps(),
+            lambda_profile_sample_rate=0.01,
+            profile_bucket=profile_bucket,
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "APP_PROFILE_SAMPLE_RATE": "0.01",
+                            "APP_PROFILE_PREFIX": "profiles/LineApi/",
+                        }
+                    )
+                }
+            },
+        )
+
+    def test_deduplicate_requires_index(
+        self, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        with pytest.raises(ValueError):
+            LineApi(
+                stack,
+                "LineApi",
+                line_credential=LineApiCredential(
+                    access_token="access_token",
+                    secret="secret",
+                ),
+                bucket_props=s3.BucketProps(),
+                deduplicate=True,
+            )
+
+    @pytest.mark.parametrize(
+        "front_door",
+        [FrontDoor.HTTP_API, FrontDoor.FUNCTION_URL],
+        ids=["http_api", "function_url"],
+    )
+    def test_front_door_snapshot(
+        self,
+        snapshot: Snapshot,
+        app: cdk.App,
+        env: cdk.Environment,
+        front_door: FrontDoor,
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_index = ImageIndex(stack, "ImageIndex")
+        line_api = LineApi(
+            stack,
+            "LineApi",
+            line_credential=LineApiCredential(
+                access_token="access_token",
+                secret="secret",
+            ),
+            bucket_props=s3.BucketProps(),
+            index_table=image_index.table,
+            front_door=front_door,
+        )
+        template = assertions.Template.from_stack(stack)
+        template.resource_count_is("AWS::ApiGateway::RestApi", 0)
+        assert line_api.api is None
+        template_json = ignore_template_assets(template.to_json())
+
+        snapshot.assert_match(
+            json.dumps(template_json, indent=2),
+            f"line_api_{front_door.name.lower()}.json",
+        )
+
+    @pytest.mark.parametrize(
+        ("login_channel_id", "user_routes"),
+        [
+            (
+                "1234567890",
+                [
+                    "GET /users/{user_id}/images",
+                    "GET /users/{user_id}/images/{image_id}/similar",
+                ],
+            ),
+            # nothing to sign users in with
+            (None, []),
+        ],
+    )
+    def test_http_api_routes(
+        self,
+        app: cdk.App,
+        env: cdk.Environment,
+        login_channel_id: typing.Optional[str],
+        user_routes: typing.List[str],
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        image_index = ImageIndex(stack, "ImageIndex")
+        LineApi(
+            stack,
+            "LineApi",
+            line_credential=LineApiCredential(
+                access_token="access_token",
+                secret="secret",
+                login_channel_id=login_channel_id,
+            ),
+            bucket_props=s3.BucketProps(),
+            index_table=image_index.table,
+            front_door=FrontDoor.HTTP_API,
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::ApiGatewayV2::Integration",
+            {"IntegrationType": "AWS_PROXY", "PayloadFormatVersion": "2.0"},
+        )
+        route_keys = sorted(
+            resource["Properties"]["RouteKey"]
+            for resource in template.find_resources(
+                "AWS::ApiGatewayV2::Route"
+            ).values()
+        )
+        assert route_keys == user_routes + ["POST /callback"]
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {"APP_PROXY_TYPE": "APIGatewayProxyEventV2"}
+                    )
+                }
+            },
+        )
+
+    def test_function_url(self, app: cdk.App, env: cdk.Environment) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        LineApi(
+            stack,
+            "LineApi",
+            line_credential=LineApiCredential(
+                access_token="access_token",
+                secret="secret",
+            ),
+            bucket_props=s3.BucketProps(),
+            front_door=FrontDoor.FUNCTION_URL,
+        )
+        template = assertions.Template.from_stack(stack)
+
+        template.has_resource_properties(
+            "AWS::Lambda::Url", {"AuthType": "NONE"}
+        )
+        template.has_resource_properties(
+            "AWS::Lambda::Permission",
+            {
+                "Action": "lambda:InvokeFunctionUrl",
+                "Principal": "*",
+                "FunctionUrlAuthType": "NONE",
+            },
+        )
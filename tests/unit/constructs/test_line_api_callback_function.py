@@ -1,18 +1,43 @@
+import base64
+import copy
+import email.message
+import gzip
+import hashlib
+import hmac
+import json
 import os
+import time
 import typing
+import urllib.error
+from io import BytesIO
 
 import pytest
+from aws_lambda_powertools.event_handler.api_gateway import ProxyEventType
 from aws_lambda_powertools.utilities.typing.lambda_context import LambdaContext
 from linebot.exceptions import InvalidSignatureError
 from linebot.models.events import MessageEvent
 from linebot.models.messages import ImageMessage, TextMessage
 from linebot.models.sources import SourceUser
+from PIL import Image
 from pytest_mock import MockerFixture
 
+from multilens.constructs.image_convert import ConvertProps
+from multilens.constructs.image_convert_function import (
+    index as image_convert_index,
+)
+from multilens.constructs.line_api_callback_function import (
+    index as callback_index,
+)
 from multilens.constructs.line_api_callback_function.index import (
+    ImageCatalog,
     LineApiHandler,
+    app,
     lambda_handler,
+    load_image_convert,
+    metrics,
+    verify_id_token,
 )
+from multilens.constructs.telemetry_layer import telemetry
 from tests.helpers import AwsTestClass
 
 
@@ -51,10 +76,11 @@ class TestLineApiHandler(AwsTestClass):
         self,
         target: LineApiHandler,
         bucket_name: str,
+        s3_client: typing.Any,
         mocker: MockerFixture,
     ) -> None:
         target.line_bot_api.get_message_content.return_value = mocker.Mock(
-            content=b"",
+            iter_content=lambda chunk_size: iter([b""]),
             content_type="image/jpeg",
         )
         event = MessageEvent(
@@ -66,15 +92,509 @@ class TestLineApiHandler(AwsTestClass):
             ),
             timestamp=1640962800000,
         )
+        metrics.clear_metrics()
+
+        target._handle_image_message(event)
+
+        head_response = s3_client.head_object(
+            Bucket=bucket_name, Key="original/user_id/Lid"
+        )
+        assert float(head_response["Metadata"]["ingested"]) > 1640962800.0
+        assert "IngestionLatency" in metrics.metric_set
+        metrics.clear_metrics()
+
+    def test_handle_image_messge_with_index(
+        self,
+        target: LineApiHandler,
+        bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        mocker: MockerFixture,
+    ) -> None:
+        target.index_table = dynamodb.Table(index_table_name)
+        target.line_bot_api.get_message_content.return_value = mocker.Mock(
+            iter_content=lambda chunk_size: iter([b"ima", b"ge"]),
+            content_type="image/jpeg",
+        )
+        event = MessageEvent(
+            message=ImageMessage(
+                id="id",
+            ),
+            source=SourceUser(
+                user_id="user_id",
+            ),
+            timestamp=1640962800000,
+        )
+
+        target._handle_image_message(event)
+
+        item = target.index_table.get_item(
+            Key={"UserId": "user_id", "ImageId": "Lid"}
+        )["Item"]
+        assert item["OriginalKey"] == "original/user_id/Lid"
+        assert item["Bytes"] == 5
+        assert item["Created"] == 1640962800000
+        assert item["Variants"] == {}
+        assert item["ContentHash"] == hashlib.sha256(b"image").hexdigest()
+
+    @pytest.mark.parametrize("valid", [True, False])
+    def test_handle_image_messge_with_previews(
+        self,
+        target: LineApiHandler,
+        bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        s3_client: typing.Any,
+        mocker: MockerFixture,
+        valid: bool,
+    ) -> None:
+        mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.load_image_convert",  # noqa
+            return_value=image_convert_index,
+        )
+        s3_client.create_bucket(Bucket="test-image-bucket")
+        target.index_table = dynamodb.Table(index_table_name)
+        target.image_bucket_name = "test-image-bucket"
+        target.previews = [
+            ConvertProps(format="jpeg", resize="400").environment()
+        ]
+        with Image.new("RGB", (800, 600)) as image, BytesIO() as buf:
+            image.save(buf, "PNG")
+            content = buf.getvalue() if valid else b"corrupt"
+        target.line_bot_api.get_message_content.return_value = mocker.Mock(
+            iter_content=lambda chunk_size: iter([content]),
+            content_type="image/png",
+        )
+        event = MessageEvent(
+            message=ImageMessage(
+                id="id",
+            ),
+            source=SourceUser(
+                user_id="user_id",
+            ),
+            timestamp=1640962800000,
+        )
 
         target._handle_image_message(event)
 
+        head_response = s3_client.head_object(
+            Bucket=bucket_name, Key="original/user_id/Lid"
+        )
+        item = target.index_table.get_item(
+            Key={"UserId": "user_id", "ImageId": "Lid"}
+        )["Item"]
+        if not valid:
+            # left to the converter
+            assert "previews" not in head_response["Metadata"]
+            assert item["Variants"] == {}
+            return
+        assert head_response["Metadata"]["previews"] == "jpeg/400"
+        assert item["Variants"]["jpeg/400"]["Key"] == "jpeg/400/user_id/Lid"
+        assert item["OriginalKey"] == "original/user_id/Lid"
+        preview = s3_client.get_object(
+            Bucket="test-image-bucket", Key="jpeg/400/user_id/Lid"
+        )
+        assert preview["ContentType"] == "image/jpeg"
+        with Image.open(preview["Body"]) as image:
+            assert image.size == (400, 300)
+
+    def test_render_previews_config(
+        self,
+        target: LineApiHandler,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.load_image_convert",  # noqa
+            return_value=image_convert_index,
+        )
+        mocked_processor = mocker.patch.object(
+            image_convert_index, "ImageConvertProcessor"
+        )
+        mocked_processor.return_value.variant_name.return_value = "webp/400"
+        target.image_bucket_name = "test-image-bucket"
+        target.preview_cache_control = "public, max-age=86400"
+        target.previews = [
+            ConvertProps(
+                format="webp",
+                resize="400",
+                engine="vips",
+                max_frames=10,
+                auto_orient=False,
+                icc_policy="keep",
+                exif_policy="no-gps",
+            ).environment()
+        ]
+
+        assert target._render_previews(b"image", {"UserId": "user"}) == [
+            "webp/400"
+        ]
+
+        config = mocked_processor.call_args.args[0]
+        assert config == image_convert_index.config_from_environ(
+            {
+                **target.previews[0],
+                "BUCKET_NAME": "test-image-bucket",
+                "APP_CACHE_CONTROL": "public, max-age=86400",
+            }
+        )
+        assert config.engine == image_convert_index.Engine.VIPS
+        assert config.max_frames == 10
+        assert not config.auto_orient
+        assert config.icc_policy == image_convert_index.IccPolicy.KEEP
+        assert config.exif_policy == image_convert_index.ExifPolicy.NO_GPS
+        assert config.index_table_name is None
+
+    def test_handle_image_messge_deduplicated(
+        self,
+        target: LineApiHandler,
+        bucket_name: str,
+        index_table_name: str,
+        dynamodb: typing.Any,
+        s3_client: typing.Any,
+        mocker: MockerFixture,
+    ) -> None:
+        dynamodb.create_table(
+            TableName="test-content-hash-table",
+            KeySchema=[{"AttributeName": "ContentHash", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "ContentHash", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        target.index_table = dynamodb.Table(index_table_name)
+        target.content_hash_table = dynamodb.Table("test-content-hash-table")
+        target.line_bot_api.get_message_content.side_effect = lambda _: (
+            mocker.Mock(
+                iter_content=lambda chunk_size: iter([b"image"]),
+                content_type="image/jpeg",
+            )
+        )
+
+        for user_id, message_id in [("first", "1"), ("second", "2")]:
+            target._handle_image_message(
+                MessageEvent(
+                    message=ImageMessage(id=message_id),
+                    source=SourceUser(user_id=user_id),
+                    timestamp=1640962800000,
+                )
+            )
+
+        response = s3_client.list_objects_v2(Bucket=bucket_name)
+        assert [c["Key"] for c in response["Contents"]] == ["original/first/L1"]
+        item = target.index_table.get_item(
+            Key={"UserId": "second", "ImageId": "L2"}
+        )["Item"]
+        assert item["OriginalKey"] == "original/first/L1"
+        assert item["CanonicalUserId"] == "first"
+        assert item["CanonicalImageId"] == "L1"
+
     def test_handle_default(self, target: LineApiHandler) -> None:
         event = MessageEvent()
 
         target._handle_default(event)
 
 
+def test_load_image_convert(mocker: MockerFixture) -> None:
+    mocker.patch(
+        "multilens.constructs.line_api_callback_function.index.IMAGE_CONVERT_MODULE",  # noqa
+        image_convert_index.__file__,
+    )
+    load_image_convert.cache_clear()
+    try:
+        module = load_image_convert()
+    finally:
+        load_image_convert.cache_clear()
+
+    assert module is not image_convert_index
+    assert module.ImageConvertProcessor.__name__ == "ImageConvertProcessor"
+
+
+def test_load_image_convert_log_volume(mocker: MockerFixture) -> None:
+    mocker.patch(
+        "multilens.constructs.line_api_callback_function.index.IMAGE_CONVERT_MODULE",  # noqa
+        image_convert_index.__file__,
+    )
+    load_image_convert.cache_clear()
+    try:
+        module = load_image_convert()
+    finally:
+        load_image_convert.cache_clear()
+
+    # both log through the one logger, whose records are counted once
+    assert module.telemetry is telemetry
+    assert [
+        f
+        for f in callback_index.logger.filters
+        if isinstance(f, telemetry.LogVolume)
+    ] == [telemetry.log_volume]
+
+
+class TestImageCatalog(AwsTestClass):
+    @pytest.fixture
+    def index_table(self, index_table_name: str, dynamodb: typing.Any):
+        table = dynamodb.Table(index_table_name)
+        for i in range(3):
+            table.put_item(
+                Item={
+                    "UserId": "user",
+                    "ImageId": f"L{i}",
+                    "Created": 1640962800000 + i,
+                    "Width": 1200,
+                    "Height": 800,
+                    "BlurHash": "LEHV6nWB2yk8pyo0adR*.7kCMdnj",
+                    "DominantColor": "#7f6e5d",
+                    "Variants": {
+                        "jpeg/400": {
+                            "Key": f"jpeg/400/user/L{i}",
+                            "ContentType": "image/jpeg",
+                            "Width": 400,
+                            "Height": 267,
+                            "Bytes": 1234,
+                        }
+                    },
+                }
+            )
+        table.put_item(
+            Item={"UserId": "other", "ImageId": "L9", "Created": 1640962800000}
+        )
+        return table
+
+    def test_list_images(self, index_table) -> None:
+        target = ImageCatalog(
+            index_table_name=index_table.name,
+            base_url="https://cdn.example.com/",
+        )
+
+        page = target.list_images("user", limit=2)
+
+        assert [i["image_id"] for i in page["images"]] == ["L2", "L1"]
+        assert page["images"][0] == {
+            "image_id": "L2",
+            "created": 1640962800002,
+            "width": 1200,
+            "height": 800,
+            "blurhash": "LEHV6nWB2yk8pyo0adR*.7kCMdnj",
+            "dominant_color": "#7f6e5d",
+            "variant": "jpeg/400",
+            "url": "https://cdn.example.com/jpeg/400/user/L2",
+            "content_type": "image/jpeg",
+            "variant_width": 400,
+            "variant_height": 267,
+            "bytes": 1234,
+            "byte_range": None,
+        }
+        assert page["next_cursor"]
+
+        page = target.list_images("user", limit=2, cursor=page["next_cursor"])
+
+        assert [i["image_id"] for i in page["images"]] == ["L0"]
+        assert page["next_cursor"] is None
+
+    def test_list_images_order(self, index_table) -> None:
+        # message ids grow in length, "L999" sorts after "L1000" as a string
+        for image_id, created in (
+            ("L999", 1640962800003),
+            ("L1000", 1640962800004),
+        ):
+            index_table.put_item(
+                Item={
+                    "UserId": "user",
+                    "ImageId": image_id,
+                    "Created": created,
+                    "Variants": {},
+                }
+            )
+        target = ImageCatalog(index_table_name=index_table.name)
+
+        page = target.list_images("user", limit=3)
+
+        assert [i["image_id"] for i in page["images"]] == [
+            "L1000",
+            "L999",
+            "L2",
+        ]
+        page = target.list_images("user", cursor=page["next_cursor"])
+
+        assert [i["image_id"] for i in page["images"]] == ["L1", "L0"]
+
+    def test_list_images_packed(self, index_table) -> None:
+        index_table.update_item(
+            Key={"UserId": "user", "ImageId": "L1"},
+            UpdateExpression="SET Variants.#variant = :variant",
+            ExpressionAttributeNames={"#variant": "jpeg/400"},
+            ExpressionAttributeValues={
+                ":variant": {
+                    "Key": "packs/jpeg/400/user/segment",
+                    "Offset": 1000,
+                    "ContentType": "image/jpeg",
+                    "Bytes": 1234,
+                }
+            },
+        )
+        target = ImageCatalog(
+            index_table_name=index_table.name,
+            base_url="https://cdn.example.com",
+        )
+
+        images = target.list_images("user")["images"]
+
+        assert images[1]["url"] == (
+            "https://cdn.example.com/packs/jpeg/400/user/segment"
+        )
+        assert images[1]["byte_range"] == "bytes=1000-2233"
+        assert images[0]["byte_range"] is None
+
+    def test_list_images_alias(self, index_table) -> None:
+        index_table.put_item(
+            Item={
+                "UserId": "other",
+                "ImageId": "L8",
+                "Created": 1640962800001,
+                "CanonicalUserId": "user",
+                "CanonicalImageId": "L0",
+                "Variants": {},
+            }
+        )
+        target = ImageCatalog(
+            index_table_name=index_table.name,
+            base_url="https://cdn.example.com",
+        )
+
+        page = target.list_images("other")
+
+        assert [i["url"] for i in page["images"]] == [
+            "https://cdn.example.com/jpeg/400/user/L0",
+            None,
+        ]
+
+    def test_list_images_presigned(self, index_table, s3_client) -> None:
+        target = ImageCatalog(
+            index_table_name=index_table.name,
+            bucket_name="test-bucket",
+        )
+
+        page = target.list_images("user", variant="webp/400")
+        assert page["images"][0]["url"] is None
+
+        page = target.list_images("user")
+        assert "Signature=" in page["images"][0]["url"]
+
+    @pytest.mark.parametrize(
+        ("limit", "cursor"),
+        [
+            (0, None),
+            (None, "not a cursor"),
+            (
+                None,
+                base64.urlsafe_b64encode(
+                    json.dumps({"UserId": "other", "ImageId": "L9"}).encode()
+                ).decode(),
+            ),
+            (
+                None,
+                # issued before the listing moved to the Created index
+                base64.urlsafe_b64encode(
+                    json.dumps({"UserId": "user", "ImageId": "L1"}).encode()
+                ).decode(),
+            ),
+        ],
+    )
+    def test_list_images_invalid(
+        self,
+        index_table,
+        limit: typing.Optional[int],
+        cursor: typing.Optional[str],
+    ) -> None:
+        target = ImageCatalog(index_table_name=index_table.name)
+
+        with pytest.raises(ValueError):
+            target.list_images("user", limit=limit, cursor=cursor)
+
+    def test_find_similar(self, index_table) -> None:
+        hashes = {
+            "L0": "0123456789abcdef",
+            "L1": "0123456789abcdee",
+            "L2": "0123456789abcd10",
+        }
+        for image_id, phash in hashes.items():
+            index_table.update_item(
+                Key={"UserId": "user", "ImageId": image_id},
+                UpdateExpression=(
+                    "SET PHash = :h, PHashBand0 = :b0, PHashBand1 = :b1,"
+                    " PHashBand2 = :b2, PHashBand3 = :b3"
+                ),
+                ExpressionAttributeValues={
+                    ":h": phash,
+                    **{
+                        f":b{i}": f"user:{phash[i * 4 : i * 4 + 4]}"
+                        for i in range(4)
+                    },
+                },
+            )
+        target = ImageCatalog(
+            index_table_name=index_table.name,
+            base_url="https://cdn.example.com",
+        )
+
+        result = target.find_similar("user", "L0")
+
+        assert [(i["image_id"], i["distance"]) for i in result["images"]] == [
+            ("L1", 1)
+        ]
+        assert (
+            result["images"][0]["url"]
+            == "https://cdn.example.com/jpeg/400/user/L1"
+        )
+
+        result = target.find_similar("user", "L0", max_distance=10)
+
+        assert [(i["image_id"], i["distance"]) for i in result["images"]] == [
+            ("L1", 1),
+            ("L2", 8),
+        ]
+
+        with pytest.raises(LookupError):
+            target.find_similar("other", "L9")
+        with pytest.raises(ValueError):
+            target.find_similar("user", "L0", max_distance=64)
+
+
+class TestVerifyIdToken:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self, mocker: MockerFixture) -> None:
+        mocker.patch.dict(callback_index._verified_tokens, clear=True)
+
+    def test_verified(self, mocker: MockerFixture) -> None:
+        urlopen = mocker.patch(
+            "urllib.request.urlopen",
+            return_value=BytesIO(
+                json.dumps({"sub": "user", "exp": time.time() + 60}).encode()
+            ),
+        )
+
+        assert verify_id_token("id-token", "1234567890") == "user"
+        # again from the cache
+        assert verify_id_token("id-token", "1234567890") == "user"
+        urlopen.assert_called_once()
+        (request,), _ = urlopen.call_args
+        assert request.full_url == "https://api.line.me/oauth2/v2.1/verify"
+        assert request.data == b"id_token=id-token&client_id=1234567890"
+
+    def test_invalid(self, mocker: MockerFixture) -> None:
+        mocker.patch(
+            "urllib.request.urlopen",
+            side_effect=urllib.error.HTTPError(
+                "https://api.line.me/oauth2/v2.1/verify",
+                400,
+                "Bad Request",
+                email.message.Message(),
+                BytesIO(b'{"error": "invalid_request"}'),
+            ),
+        )
+
+        assert verify_id_token("id-token", "1234567890") is None
+
+
 class TestLineApi(AwsTestClass):
     @pytest.fixture
     def target(self):
@@ -191,6 +711,41 @@ class TestLineApi(AwsTestClass):
             json_body={"message": "OK"},
         )
 
+    def test_lambda_handler_base64(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        lambda_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        # the REST API treats every media type as binary, so the webhook
+        # arrives base64 encoded and is signed over the decoded body
+        body = json.dumps({"destination": "U0", "events": []})
+        signature = base64.b64encode(
+            hmac.new(b"secret", body.encode(), hashlib.sha256).digest()
+        ).decode()
+        mocker.patch.dict(
+            os.environ,
+            {"CHANNEL_ACCESS_TOKEN": "token", "CHANNEL_SECRET": "secret"},
+        )
+        event = copy.deepcopy(lambda_event)
+        event["body"] = base64.b64encode(body.encode()).decode()
+        event["isBase64Encoded"] = True
+        event["headers"]["X-Line-Signature"] = signature
+        event["multiValueHeaders"]["X-Line-Signature"] = [signature]
+
+        response = target(event, lambda_context)
+
+        self.assert_lambda_response(
+            response=response,
+            status_code=200,
+            content_type="application/json",
+            json_body={"message": "OK"},
+        )
+
     def test_lambda_handler_error(
         self,
         target: typing.Callable[
@@ -216,3 +771,267 @@ class TestLineApi(AwsTestClass):
             content_type="application/json",
             json_body={"message": "Invalid signature"},
         )
+
+    @pytest.fixture
+    def list_event(
+        self, lambda_event: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+        event = copy.deepcopy(lambda_event)
+        event.update(
+            {
+                "body": None,
+                "resource": "/users/{user_id}/images",
+                "path": "/users/user/images",
+                "httpMethod": "GET",
+                "pathParameters": {"user_id": "user"},
+                "queryStringParameters": {"limit": "10"},
+            }
+        )
+        event["headers"]["Authorization"] = "Bearer id-token"
+        event["multiValueHeaders"]["Authorization"] = ["Bearer id-token"]
+        return event
+
+    @pytest.fixture
+    def similar_event(
+        self, list_event: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+        event = copy.deepcopy(list_event)
+        event.update(
+            {
+                "resource": "/users/{user_id}/images/{image_id}/similar",
+                "path": "/users/user/images/L0/similar",
+                "pathParameters": {"user_id": "user", "image_id": "L0"},
+                "queryStringParameters": {},
+            }
+        )
+        return event
+
+    @pytest.fixture
+    def mocked_verify(self, mocker: MockerFixture) -> typing.Any:
+        mocker.patch.dict(
+            os.environ,
+            {
+                "INDEX_TABLE_NAME": "test-index",
+                "APP_LOGIN_CHANNEL_ID": "1234567890",
+            },
+        )
+        return mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.verify_id_token",  # noqa
+            return_value="user",
+        )
+
+    def test_lambda_handler_list_images(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        list_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        mocked_verify: typing.Any,
+    ) -> None:
+        mocked_class = mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.ImageCatalog"  # noqa
+        )
+        mocked_class.return_value.list_images.return_value = {
+            "images": [],
+            "next_cursor": None,
+        }
+
+        response = target(list_event, lambda_context)
+
+        assert response["statusCode"] == 200
+        assert response["headers"]["Cache-Control"] == "private, max-age=60"
+        assert response["headers"]["Content-Encoding"] == "gzip"
+        body = gzip.decompress(base64.b64decode(response["body"]))
+        assert json.loads(body) == {"images": [], "next_cursor": None}
+        mocked_class.return_value.list_images.assert_called_once_with(
+            user_id="user", variant=None, limit=10, cursor=None
+        )
+        mocked_verify.assert_called_once_with("id-token", "1234567890")
+
+    def test_lambda_handler_list_images_invalid(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        list_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        mocked_verify: typing.Any,
+    ) -> None:
+        mocked_class = mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.ImageCatalog"  # noqa
+        )
+        mocked_class.return_value.list_images.side_effect = ValueError(
+            "invalid cursor"
+        )
+
+        response = target(list_event, lambda_context)
+
+        assert response["statusCode"] == 400
+
+    def test_lambda_handler_list_images_disabled(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        list_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.dict(os.environ, {"INDEX_TABLE_NAME": ""})
+
+        response = target(list_event, lambda_context)
+
+        assert response["statusCode"] == 404
+
+    @pytest.mark.parametrize("event_name", ["list_event", "similar_event"])
+    def test_lambda_handler_without_login_channel(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        request: pytest.FixtureRequest,
+        event_name: str,
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.dict(
+            os.environ,
+            {"INDEX_TABLE_NAME": "test-index", "APP_LOGIN_CHANNEL_ID": ""},
+        )
+
+        response = target(request.getfixturevalue(event_name), lambda_context)
+
+        assert response["statusCode"] == 404
+
+    @pytest.mark.parametrize("event_name", ["list_event", "similar_event"])
+    @pytest.mark.parametrize(
+        ("authorization", "signed_in", "status_code"),
+        [
+            (None, "user", 401),
+            ("Basic dXNlcjpwYXNz", "user", 401),
+            ("Bearer id-token", None, 401),
+            ("Bearer id-token", "other", 403),
+        ],
+    )
+    def test_lambda_handler_unauthorized(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        request: pytest.FixtureRequest,
+        event_name: str,
+        authorization: typing.Optional[str],
+        signed_in: typing.Optional[str],
+        status_code: int,
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        mocked_verify: typing.Any,
+    ) -> None:
+        mocked_verify.return_value = signed_in
+        mocked_class = mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.ImageCatalog"  # noqa
+        )
+        event = request.getfixturevalue(event_name)
+        del event["headers"]["Authorization"]
+        del event["multiValueHeaders"]["Authorization"]
+        if authorization:
+            event["headers"]["Authorization"] = authorization
+            event["multiValueHeaders"]["Authorization"] = [authorization]
+
+        response = target(event, lambda_context)
+
+        assert response["statusCode"] == status_code
+        mocked_class.assert_not_called()
+
+    def test_lambda_handler_similar_images(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        similar_event: typing.Dict[str, typing.Any],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        mocked_verify: typing.Any,
+    ) -> None:
+        mocked_class = mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.ImageCatalog"  # noqa
+        )
+        mocked_class.return_value.find_similar.return_value = {"images": []}
+
+        response = target(similar_event, lambda_context)
+
+        assert response["statusCode"] == 200
+        mocked_class.return_value.find_similar.assert_called_once_with(
+            user_id="user", image_id="L0", max_distance=3, variant=None
+        )
+
+    @pytest.mark.parametrize(
+        "proxy_type",
+        [
+            ProxyEventType.APIGatewayProxyEventV2,
+            ProxyEventType.LambdaFunctionUrlEvent,
+        ],
+    )
+    def test_lambda_handler_v2_event(
+        self,
+        target: typing.Callable[
+            [typing.Dict[str, typing.Any], LambdaContext],
+            typing.Dict[str, typing.Any],
+        ],
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+        proxy_type: ProxyEventType,
+    ) -> None:
+        mocker.patch.object(app, "_proxy_type", proxy_type)
+        mocked_class = mocker.patch(
+            "multilens.constructs.line_api_callback_function.index.LineApiHandler"  # noqa
+        )
+        event = {
+            "version": "2.0",
+            "routeKey": "POST /callback",
+            "rawPath": "/callback",
+            "rawQueryString": "",
+            "headers": {
+                "content-type": "application/json",
+                "x-line-signature": "xxxxxxxx",
+            },
+            "requestContext": {
+                "accountId": "123456789012",
+                "apiId": "1234567890",
+                "domainName": "1234567890.lambda-url.us-east-1.on.aws",
+                "http": {
+                    "method": "POST",
+                    "path": "/callback",
+                    "protocol": "HTTP/1.1",
+                    "sourceIp": "127.0.0.1",
+                    "userAgent": "Custom User Agent String",
+                },
+                "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
+                "routeKey": "POST /callback",
+                "stage": "$default",
+                "timeEpoch": 1428582896000,
+            },
+            "body": "eyJ0ZXN0IjoiYm9keSJ9",
+            "isBase64Encoded": True,
+        }
+
+        response = target(event, lambda_context)
+
+        self.assert_lambda_response(
+            response=response,
+            status_code=200,
+            content_type="application/json",
+            json_body={"message": "OK"},
+        )
+        mocked_class.return_value.handler.handle.assert_called_once_with(
+            '{"test":"body"}', "xxxxxxxx"
+        )
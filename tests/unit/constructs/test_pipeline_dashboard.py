@@ -0,0 +1,41 @@
+import json
+import os
+
+import aws_cdk as cdk
+import aws_cdk.assertions as assertions
+import pytest
+from pytest_snapshot.plugin import Snapshot
+
+from multilens.constructs.pipeline_dashboard import PipelineDashboard
+from tests.helpers import ignore_template_assets
+
+
+class TestPipelineDashboard:
+    @pytest.fixture
+    def environ(self) -> None:
+        return
+
+    @pytest.fixture()
+    def app(self, environ) -> cdk.App:
+        return cdk.App()
+
+    @pytest.fixture
+    def env(self, environ) -> cdk.Environment:
+        return cdk.Environment(
+            account=os.getenv("CDK_DEFAULT_ACCOUNT"),
+            region=os.getenv("CDK_DEFAULT_REGION"),
+        )
+
+    def test_snapshot(
+        self, snapshot: Snapshot, app: cdk.App, env: cdk.Environment
+    ) -> None:
+        stack = cdk.Stack(app, "Test", env=env)
+        PipelineDashboard(stack, "PipelineDashboard", variants=["jpeg/400"])
+        template_json = ignore_template_assets(
+            assertions.Template.from_stack(stack).to_json()
+        )
+
+        snapshot.assert_match(
+            json.dumps(template_json, indent=2),
+            "pipeline_dashboard.json",
+        )
@@ -0,0 +1,234 @@
+import logging
+import marshal
+import os
+import pickle
+import typing
+
+import pytest
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from pytest_mock import MockerFixture
+
+from multilens.constructs.telemetry_layer.telemetry import (
+    TRACES_SAMPLE_RATE,
+    init_sentry,
+    logger,
+    metrics,
+    report_slow,
+    sample_transaction,
+    sampled_debug_logging,
+    sampled_profiling,
+)
+from tests.helpers import AwsTestClass
+
+
+class TestSampleTransaction:
+    def sqs_event(self, receive_count: str) -> typing.Dict[str, typing.Any]:
+        return {
+            "Records": [
+                {
+                    "messageId": "a",
+                    "attributes": {"ApproximateReceiveCount": "1"},
+                },
+                {
+                    "messageId": "b",
+                    "attributes": {"ApproximateReceiveCount": receive_count},
+                },
+            ]
+        }
+
+    @pytest.mark.parametrize(
+        ("event", "sample_rate"),
+        [
+            ({"httpMethod": "GET"}, TRACES_SAMPLE_RATE),
+            ({"Records": [{"Sns": {}}]}, TRACES_SAMPLE_RATE),
+            (None, TRACES_SAMPLE_RATE),
+        ],
+    )
+    def test_sampled(self, event: typing.Any, sample_rate: float) -> None:
+        assert sample_transaction({"aws_event": event}) == sample_rate
+
+    def test_redelivered(self) -> None:
+        assert sample_transaction({"aws_event": self.sqs_event("1")}) == (
+            TRACES_SAMPLE_RATE
+        )
+        assert sample_transaction({"aws_event": self.sqs_event("2")}) == 1.0
+
+
+class TestInitSentry:
+    @pytest.fixture
+    def sentry_sdk(self, mocker: MockerFixture) -> typing.Any:
+        return mocker.patch(
+            "multilens.constructs.telemetry_layer.telemetry.sentry_sdk"
+        )
+
+    def test_init(self, sentry_sdk: typing.Any, mocker: MockerFixture) -> None:
+        sentry_sdk.Hub.current.client = None
+
+        init_sentry("https://key@sentry.example.com/1")
+
+        sentry_sdk.init.assert_called_once_with(
+            dsn="https://key@sentry.example.com/1",
+            integrations=mocker.ANY,
+            traces_sampler=sample_transaction,
+        )
+
+    def test_initialized(self, sentry_sdk: typing.Any) -> None:
+        # by the function that loaded the module first
+        init_sentry("https://key@sentry.example.com/1")
+
+        sentry_sdk.init.assert_not_called()
+
+
+class TestReportSlow:
+    @pytest.mark.parametrize(
+        ("seconds", "sampled", "reported"),
+        [(0.5, False, False), (5.0, False, True), (5.0, True, False)],
+    )
+    def test_handler(
+        self,
+        seconds: float,
+        sampled: bool,
+        reported: bool,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch("time.monotonic", side_effect=[100.0, 100.0 + seconds])
+        mocker.patch(
+            "multilens.constructs.telemetry_layer.telemetry._sampled",
+            return_value=sampled,
+        )
+        capture_message = mocker.patch("sentry_sdk.capture_message")
+
+        @report_slow(1000)
+        def handler(event, context):
+            return "done"
+
+        assert handler({}, None) == "done"
+        assert capture_message.called == reported
+
+
+class TestSampledProfiling(AwsTestClass):
+    @pytest.fixture
+    def profile_bucket(self, s3_client) -> str:
+        bucket_name = "test-profile-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        return bucket_name
+
+    @pytest.mark.parametrize("sample_rate", ["", "0"])
+    def test_not_sampled(
+        self,
+        sample_rate: str,
+        s3_client,
+        profile_bucket: str,
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.dict(
+            os.environ,
+            {
+                "APP_PROFILE_SAMPLE_RATE": sample_rate,
+                "APP_PROFILE_BUCKET": profile_bucket,
+            },
+        )
+        profile = mocker.patch("cProfile.Profile")
+
+        @sampled_profiling
+        def handler(event, context):
+            return "done"
+
+        assert handler({}, lambda_context) == "done"
+        profile.assert_not_called()
+        assert "Contents" not in s3_client.list_objects_v2(
+            Bucket=profile_bucket
+        )
+
+    def test_sampled(
+        self,
+        s3_client,
+        profile_bucket: str,
+        lambda_context: LambdaContext,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.dict(
+            os.environ,
+            {
+                "APP_PROFILE_SAMPLE_RATE": "1",
+                "APP_PROFILE_BUCKET": profile_bucket,
+                "APP_PROFILE_PREFIX": "profiles/ImageConvert/jpeg_400/",
+            },
+        )
+
+        @sampled_profiling
+        def handler(event, context):
+            return [bytes(1024) for _ in range(16)]
+
+        metrics.clear_metrics()
+        with pytest.raises(ValueError):
+
+            @sampled_profiling
+            def failing(event, context):
+                raise ValueError("profiled anyway")
+
+            failing({}, lambda_context)
+        assert len(handler({}, lambda_context)) == 16
+
+        keys = [
+            content["Key"]
+            for content in s3_client.list_objects_v2(Bucket=profile_bucket)[
+                "Contents"
+            ]
+        ]
+        assert sorted({os.path.splitext(key)[1] for key in keys}) == [
+            ".pstats",
+            ".tracemalloc",
+        ]
+        assert all(
+            key.startswith("profiles/ImageConvert/jpeg_400/")
+            and lambda_context.aws_request_id in key
+            for key in keys
+        )
+        stats_key = next(key for key in keys if key.endswith(".pstats"))
+        stats = marshal.loads(
+            s3_client.get_object(Bucket=profile_bucket, Key=stats_key)[
+                "Body"
+            ].read()
+        )
+        assert any(name == "handler" for _, _, name in stats)
+        snapshot_key = next(key for key in keys if key.endswith(".tracemalloc"))
+        snapshot = pickle.loads(
+            s3_client.get_object(Bucket=profile_bucket, Key=snapshot_key)[
+                "Body"
+            ].read()
+        )
+        assert snapshot.statistics("lineno")
+        assert metrics.metric_set["ProfileSampled"]["Value"] == [1, 1]
+        metrics.clear_metrics()
+
+
+class TestSampledDebugLogging:
+    @pytest.mark.parametrize(
+        ("sample_rate", "level", "records"),
+        [("1", "DEBUG", 2), ("", "INFO", 1)],
+    )
+    def test_handler(
+        self,
+        sample_rate: str,
+        level: str,
+        records: int,
+        mocker: MockerFixture,
+    ) -> None:
+        mocker.patch.dict(os.environ, {"APP_DEBUG_SAMPLE_RATE": sample_rate})
+        levels = []
+
+        @sampled_debug_logging
+        def handler(event, context):
+            levels.append(logging.getLevelName(logger.getEffectiveLevel()))
+            logger.debug({"large": "payload"})
+            logger.info("converted")
+
+        metrics.clear_metrics()
+        handler({}, None)
+
+        assert levels == [level]
+        assert metrics.metric_set["LogRecords"]["Value"] == [records]
+        assert ("DebugSampled" in metrics.metric_set) == (level == "DEBUG")
+        metrics.clear_metrics()
@@ -36,6 +36,7 @@ class TestMultilensStack:
             line_credential=LineApiCredential(
                 access_token="access_token",
                 secret="secret",
+                login_channel_id="1234567890",
             ),
             env=env,
         )
@@ -0,0 +1,229 @@
+import typing
+from io import SEEK_SET, BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from multilens.constructs.image_convert_function.index import (
+    ConvertConfig,
+    Format,
+    KeyLayout,
+    variant_key,
+)
+from multilens.tools.backfill import Backfill, Checkpoint, main
+from tests.helpers import AwsTestClass
+
+
+class TestCheckpoint:
+    def test_resume(self, tmp_path: Path) -> None:
+        path = str(tmp_path / "checkpoint")
+        checkpoint = Checkpoint(path)
+        checkpoint.add("original/user/L1")
+        checkpoint.add("original/user/L1")
+
+        resumed = Checkpoint(path)
+
+        assert "original/user/L1" in resumed
+        assert len(resumed) == 1
+
+    def test_in_memory(self) -> None:
+        checkpoint = Checkpoint()
+        checkpoint.add("key")
+
+        assert "key" in checkpoint
+
+
+class TestBackfill(AwsTestClass):
+    @pytest.fixture
+    def input_bucket_name(self, s3_client) -> str:
+        bucket_name = "test-input-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        for i in range(3):
+            with Image.new(
+                mode="RGB", size=(200, 200), color=(i, i, i)
+            ) as image, BytesIO() as buf:
+                image.save(buf, "JPEG")
+                buf.seek(SEEK_SET)
+                s3_client.upload_fileobj(
+                    Bucket=bucket_name,
+                    Key=f"original/user/L{i}",
+                    Fileobj=buf,
+                    ExtraArgs={
+                        "ContentType": "image/jpeg",
+                        "Metadata": {"UserId": "user", "ImageId": f"L{i}"},
+                    },
+                )
+        return bucket_name
+
+    @pytest.fixture
+    def output_bucket_name(self, s3_client) -> str:
+        bucket_name = "test-output-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key="webp/100/user/L0",
+            Body=b"existing",
+        )
+        return bucket_name
+
+    @pytest.fixture
+    def config(self, output_bucket_name: str) -> ConvertConfig:
+        return ConvertConfig(
+            bucket_name=output_bucket_name,
+            format=Format.WEBP,
+            resize=100,
+        )
+
+    def output_keys(
+        self, s3_client: typing.Any, bucket_name: str
+    ) -> typing.List[str]:
+        response = s3_client.list_objects_v2(Bucket=bucket_name)
+        return sorted(c["Key"] for c in response.get("Contents", []))
+
+    def test_run(
+        self,
+        s3_client: typing.Any,
+        input_bucket_name: str,
+        output_bucket_name: str,
+        config: ConvertConfig,
+        tmp_path: Path,
+    ) -> None:
+        checkpoint = Checkpoint(str(tmp_path / "checkpoint"))
+        backfill = Backfill(
+            input_bucket=input_bucket_name,
+            config=config,
+            workers=2,
+            checkpoint=checkpoint,
+            s3_client=s3_client,
+        )
+
+        stats = backfill.run()
+
+        assert (stats.listed, stats.converted, stats.skipped) == (3, 2, 1)
+        assert stats.failed == 0
+        assert self.output_keys(s3_client, output_bucket_name) == [
+            "webp/100/user/L0",
+            "webp/100/user/L1",
+            "webp/100/user/L2",
+        ]
+        assert len(checkpoint) == 3
+
+        resumed = Backfill(
+            input_bucket=input_bucket_name,
+            config=config,
+            checkpoint=Checkpoint(str(tmp_path / "checkpoint")),
+            s3_client=s3_client,
+        ).run()
+
+        assert (resumed.converted, resumed.skipped) == (0, 3)
+
+    def test_run_overwrite(
+        self,
+        s3_client: typing.Any,
+        input_bucket_name: str,
+        output_bucket_name: str,
+        config: ConvertConfig,
+    ) -> None:
+        stats = Backfill(
+            input_bucket=input_bucket_name,
+            config=config,
+            overwrite=True,
+            s3_client=s3_client,
+        ).run()
+
+        assert stats.converted == 3
+        response = s3_client.get_object(
+            Bucket=output_bucket_name,
+            Key="webp/100/user/L0",
+        )
+        assert response["ContentType"] == "image/webp"
+
+    def test_run_sharded(
+        self,
+        s3_client: typing.Any,
+        input_bucket_name: str,
+        output_bucket_name: str,
+    ) -> None:
+        s3_client.put_object(
+            Bucket=output_bucket_name,
+            Key=variant_key("webp/100", "user", "L1", KeyLayout.SHARDED),
+            Body=b"existing",
+        )
+        config = ConvertConfig(
+            bucket_name=output_bucket_name,
+            format=Format.WEBP,
+            resize=100,
+            key_layout=KeyLayout.SHARDED,
+        )
+
+        stats = Backfill(
+            input_bucket=input_bucket_name,
+            config=config,
+            s3_client=s3_client,
+        ).run()
+
+        assert (stats.converted, stats.skipped) == (2, 1)
+        assert self.output_keys(s3_client, output_bucket_name) == sorted(
+            ["webp/100/user/L0"]
+            + [
+                variant_key("webp/100", "user", f"L{i}", KeyLayout.SHARDED)
+                for i in range(3)
+            ]
+        )
+
+    def test_run_failure(
+        self,
+        s3_client: typing.Any,
+        input_bucket_name: str,
+        config: ConvertConfig,
+    ) -> None:
+        s3_client.put_object(
+            Bucket=input_bucket_name,
+            Key="original/user/broken",
+            Body=b"not an image",
+        )
+
+        stats = Backfill(
+            input_bucket=input_bucket_name,
+            config=config,
+            s3_client=s3_client,
+        ).run()
+
+        assert stats.failed == 1
+
+    def test_invalid_workers(self, config: ConvertConfig) -> None:
+        with pytest.raises(ValueError):
+            Backfill(input_bucket="test", config=config, workers=0)
+
+    def test_main(
+        self,
+        s3_client: typing.Any,
+        input_bucket_name: str,
+        output_bucket_name: str,
+    ) -> None:
+        code = main(
+            [
+                "--input-bucket",
+                input_bucket_name,
+                "--output-bucket",
+                output_bucket_name,
+                "--format",
+                "jpeg",
+                "--resize",
+                "50",
+                "--cache-control",
+                "public, max-age=86400",
+            ]
+        )
+
+        assert code == 0
+        response = s3_client.list_objects_v2(
+            Bucket=output_bucket_name, Prefix="jpeg/50/"
+        )
+        assert len(response["Contents"]) == 3
+        for content in response["Contents"]:
+            head_response = s3_client.head_object(
+                Bucket=output_bucket_name, Key=content["Key"]
+            )
+            assert head_response["CacheControl"] == "public, max-age=86400"
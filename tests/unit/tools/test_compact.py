@@ -0,0 +1,209 @@
+import typing
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from multilens.constructs.image_convert_function.index import (
+    ConvertConfig,
+    Format,
+    ImageConvertProcessor,
+    read_pack_index,
+)
+from multilens.tools.compact import Compactor, main
+from tests.helpers import AwsTestClass
+
+
+class TestCompactor(AwsTestClass):
+    @pytest.fixture
+    def processor(
+        self, s3_client: typing.Any, index_table_name: str
+    ) -> ImageConvertProcessor:
+        s3_client.create_bucket(Bucket="test-input-bucket")
+        s3_client.create_bucket(Bucket="test-output-bucket")
+        for i in range(3):
+            with Image.new(
+                mode="RGB", size=(200, 100), color=(i, i, i)
+            ) as image, BytesIO() as buf:
+                image.save(buf, "JPEG")
+                s3_client.put_object(
+                    Bucket="test-input-bucket",
+                    Key=f"original/user/L{i}",
+                    Body=buf.getvalue(),
+                )
+        return ImageConvertProcessor(
+            ConvertConfig(
+                bucket_name="test-output-bucket",
+                format=Format.JPEG,
+                resize=50,
+                index_table_name=index_table_name,
+                pack=True,
+            ),
+            s3_client=s3_client,
+        )
+
+    def convert(self, processor: ImageConvertProcessor, image_id: str) -> None:
+        # a segment per flush, like a converter batch each
+        processor.convert_object(
+            "test-input-bucket",
+            f"original/user/{image_id}",
+            {"userid": "user", "imageid": image_id},
+        )
+        processor.flush()
+
+    def segments(
+        self, s3_client: typing.Any
+    ) -> typing.Dict[str, typing.List[str]]:
+        segments = {}
+        response = s3_client.list_objects_v2(Bucket="test-output-bucket")
+        for content in response.get("Contents", []):
+            tags = s3_client.get_object_tagging(
+                Bucket="test-output-bucket", Key=content["Key"]
+            )["TagSet"]
+            if not tags:
+                segments[content["Key"]] = [
+                    e.image_id
+                    for e in read_pack_index(
+                        s3_client, "test-output-bucket", content["Key"]
+                    )
+                ]
+        return segments
+
+    def test_run(
+        self,
+        s3_client: typing.Any,
+        dynamodb: typing.Any,
+        index_table_name: str,
+        processor: ImageConvertProcessor,
+    ) -> None:
+        for image_id in ["L0", "L1", "L2", "L1"]:
+            self.convert(processor, image_id)
+        assert len(self.segments(s3_client)) == 4
+
+        stats = Compactor(
+            "test-output-bucket",
+            index_table_name,
+            "jpeg/50",
+            grace_seconds=0,
+            s3_client=s3_client,
+        ).run()
+
+        assert (stats.users, stats.compacted, stats.written) == (1, 4, 1)
+        # the first conversion of L1 is no longer indexed
+        assert (stats.moved, stats.dropped) == (3, 1)
+        segments = self.segments(s3_client)
+        assert [sorted(ids) for ids in segments.values()] == [
+            ["L0", "L1", "L2"]
+        ]
+        key = next(iter(segments))
+        table = dynamodb.Table(index_table_name)
+        for image_id in ["L0", "L1", "L2"]:
+            variant = table.get_item(
+                Key={"UserId": "user", "ImageId": image_id}
+            )["Item"]["Variants"]["jpeg/50"]
+            assert variant["Key"] == key
+            data = s3_client.get_object(
+                Bucket="test-output-bucket",
+                Key=key,
+                Range=(
+                    f"bytes={variant['Offset']}-"
+                    f"{variant['Offset'] + variant['Bytes'] - 1}"
+                ),
+            )["Body"].read()
+            with Image.open(BytesIO(data)) as image:
+                assert image.size == (50, 25)
+
+        # the merged segment is left alone
+        stats = Compactor(
+            "test-output-bucket",
+            index_table_name,
+            "jpeg/50",
+            grace_seconds=0,
+            s3_client=s3_client,
+        ).run()
+        assert (stats.written, stats.compacted, stats.dropped) == (0, 0, 0)
+        assert self.segments(s3_client) == segments
+
+    def test_run_index_update_pending(
+        self,
+        s3_client: typing.Any,
+        dynamodb: typing.Any,
+        index_table_name: str,
+        processor: ImageConvertProcessor,
+    ) -> None:
+        self.convert(processor, "L0")
+        self.convert(processor, "L1")
+        # the segment of L2 is written, its index update not yet
+        processor.convert_object(
+            "test-input-bucket",
+            "original/user/L2",
+            {"userid": "user", "imageid": "L2"},
+        )
+        assert processor.packer is not None
+        processor.packer.flush()
+
+        stats = Compactor(
+            "test-output-bucket",
+            index_table_name,
+            "jpeg/50",
+            grace_seconds=0,
+            s3_client=s3_client,
+        ).run()
+        assert processor.index is not None
+        processor.index.flush()
+
+        assert (stats.compacted, stats.moved, stats.pending) == (2, 2, 1)
+        segments = self.segments(s3_client)
+        variant = dynamodb.Table(index_table_name).get_item(
+            Key={"UserId": "user", "ImageId": "L2"}
+        )["Item"]["Variants"]["jpeg/50"]
+        assert segments[variant["Key"]] == ["L2"]
+
+    def test_run_grace(
+        self,
+        s3_client: typing.Any,
+        index_table_name: str,
+        processor: ImageConvertProcessor,
+    ) -> None:
+        self.convert(processor, "L0")
+        self.convert(processor, "L1")
+
+        stats = Compactor(
+            "test-output-bucket",
+            index_table_name,
+            "jpeg/50",
+            s3_client=s3_client,
+        ).run()
+
+        assert (stats.compacted, stats.written) == (0, 0)
+        assert len(self.segments(s3_client)) == 2
+
+    def test_main(
+        self,
+        s3_client: typing.Any,
+        index_table_name: str,
+        processor: ImageConvertProcessor,
+    ) -> None:
+        self.convert(processor, "L0")
+        self.convert(processor, "L1")
+
+        assert (
+            main(
+                [
+                    "--bucket",
+                    "test-output-bucket",
+                    "--index-table",
+                    index_table_name,
+                    "--variant",
+                    "jpeg/50",
+                    "--user",
+                    "user",
+                    "--grace-seconds",
+                    "0",
+                ]
+            )
+            == 0
+        )
+        assert [sorted(ids) for ids in self.segments(s3_client).values()] == [
+            ["L0", "L1"]
+        ]
@@ -0,0 +1,82 @@
+import base64
+import hashlib
+import hmac
+
+from multilens.tools.harness import (
+    HarnessConfig,
+    PipelineHarness,
+    StageStats,
+    main,
+    sign,
+)
+
+
+class TestStageStats:
+    def test_from_samples(self) -> None:
+        stats = StageStats.from_samples([i / 100 for i in range(100, 0, -1)])
+
+        assert stats.count == 100
+        assert stats.percentiles == {50: 0.5, 95: 0.95, 99: 0.99}
+        assert stats.max == 1.0
+
+    def test_empty(self) -> None:
+        stats = StageStats.from_samples([])
+
+        assert stats.count == 0
+        assert stats.percentiles[99] == 0.0
+
+
+def test_sign() -> None:
+    expected = base64.b64encode(
+        hmac.new(b"secret", b"body", hashlib.sha256).digest()
+    ).decode()
+
+    assert sign("secret", "body") == expected
+
+
+class TestPipelineHarness:
+    def test_run(self) -> None:
+        harness = PipelineHarness(
+            HarnessConfig(
+                events=4,
+                image_ratio=0.5,
+                image_sizes={(64, 48): 1.0, (120, 90): 1.0},
+                variants=["jpeg/32", "webp/original"],
+                seed=3,
+            )
+        )
+
+        report = harness.run()
+
+        images = report.stages["webhook.image"].count
+        assert 0 < images < 4
+        assert report.stages["webhook.text"].count == 4 - images
+        assert report.images == images
+        assert report.variants == images * 2
+        assert report.failed == 0
+        assert report.stages["end_to_end"].count == images
+        # one sample per converted image, not per batch
+        assert report.stages["convert.jpeg/32"].count == images
+        assert report.stages["convert.webp/original"].count == images
+        assert report.stages["flush.jpeg/32"].count > 0
+        assert "end_to_end" in report.format()
+
+    def test_main(self, capsys) -> None:
+        assert (
+            main(
+                [
+                    "--events",
+                    "2",
+                    "--image-ratio",
+                    "1",
+                    "--image-size",
+                    "32x32",
+                    "--variant",
+                    "jpeg/16",
+                    "--no-index",
+                ]
+            )
+            == 0
+        )
+
+        assert "2 images" in capsys.readouterr().out